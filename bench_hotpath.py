@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+tools/call 热路径基准测试
+
+通过 JSON-RPC stdio 驱动 server.py / server_linux.py，docker 换成 fake_docker.py，
+不需要 Docker daemon。每个场景起一个新的 server 进程，按给定并发持续发请求，统计：
+
+    - 延迟 p50 / p95 / p99（从写入请求到读到响应）
+    - 吞吐（请求数 / 墙钟时间）
+    - server 进程峰值 RSS（/proc/<pid>/status 的 VmHWM）
+
+用来衡量分发、路径转换、输出处理这些环节的回归。每次 docker 调用都会起一个 Python 解释器跑 fake_docker.py，
+这部分固定开销也算在延迟里，对比时保持参数一致即可。示例：
+
+    python bench_hotpath.py
+    python bench_hotpath.py --server linux --requests 500 --concurrency 16 --latency-ms 5
+    python bench_hotpath.py --stderr-kb 512 --pool 0 > bench_output.txt
+    python bench_hotpath.py --engine-api    # docker 换成 fake_docker_api.py（unix socket 上的 Engine API）
+    python bench_hotpath.py --server linux --hosts 3    # 3 个假 daemon，走 FFMPEG_MCP_DOCKER_HOSTS 多机调度
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (场景名, 工具名, arguments)；tools/list 用 None 作工具名
+SCENARIOS = {
+    "windows": [
+        ("tools/list", None, None),
+        ("ffmpeg-win", "ffmpeg-win", {
+            "basedir": "D:/",
+            "args": ["-y", "-i", "D:/videos/input.mp4", "-vf", "scale=1280:-2", "-c:v", "libx264",
+                     "-crf", "23", "D:/videos/output.mp4"]
+        }),
+        ("imagemagick-win", "imagemagick-win", {"args": "D:/images/input.png -resize 50% D:/images/output.png"}),
+        ("file-exists-win", "file-exists-win", {"path": "D:/videos/output.mp4"}),
+        ("file-exists-win (10 paths)", "file-exists-win", {"paths": [f"D:/videos/clip{i}.mp4" for i in range(10)]}),
+        ("probe-win", "probe-win", {"path": "D:/videos/input.mp4"})
+    ],
+    "linux": [
+        ("tools/list", None, None),
+        ("ffmpeg", "ffmpeg", {
+            "args": ["-y", "-i", "/home/media/inputs/input.mp4", "-vf", "scale=1280:-2", "-c:v", "libx264",
+                     "-crf", "23", "/home/media/outputs/output.mp4"]
+        }),
+        ("imagemagick", "imagemagick", {"args": "/home/media/inputs/input.png -resize 50% /home/media/outputs/output.png"}),
+        ("file_exists", "file_exists", {"path": "/home/media/outputs/output.mp4"}),
+        ("file_exists (10 paths)", "file_exists", {"paths": [f"/home/media/outputs/clip{i}.mp4" for i in range(10)]}),
+        ("probe", "probe", {"path": "/home/media/inputs/input.mp4"})
+    ]
+}
+
+SERVER_SCRIPTS = {"windows": "server.py", "linux": "server_linux.py"}
+
+def _fake_docker_dir():
+    """临时目录里放一个叫 docker 的入口，指向 fake_docker.py"""
+    bindir = tempfile.mkdtemp(prefix="ffmpeg-mcp-bench-")
+    target = os.path.join(bindir, "docker")
+    with open(target, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(HERE, "fake_docker.py")}" "$@"\n')
+    os.chmod(target, 0o755)
+    return bindir
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+class ServerProcess:
+    """一个 server 子进程：后台线程读响应，按 id 唤醒等待者"""
+
+    def __init__(self, script, env):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, script)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env=env, text=True, bufsize=1
+        )
+        self._ids = itertools.count(1)
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if "id" not in msg:
+                continue  # notifications/progress
+            with self._lock:
+                waiter = self._waiters.pop(msg["id"], None)
+            if waiter is not None:
+                waiter[1] = msg
+                waiter[0].set()
+
+    def call(self, method, params=None, timeout=120):
+        rid = next(self._ids)
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._waiters[rid] = waiter
+        request = {"jsonrpc": "2.0", "id": rid, "method": method, "params": params or {}}
+        with self._write_lock:
+            self.proc.stdin.write(json.dumps(request) + "\n")
+            self.proc.stdin.flush()
+        if not waiter[0].wait(timeout):
+            raise TimeoutError(f"no response to {method} within {timeout}s")
+        return waiter[1]
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=30)
+        except Exception:
+            self.proc.kill()
+
+def run_scenario(script, tool, arguments, requests, concurrency, env):
+    server = ServerProcess(script, env)
+    try:
+        server.call("initialize", {"protocolVersion": "2024-11-05", "capabilities": {}})
+        if tool is None:
+            method, params = "tools/list", {}
+        else:
+            method, params = "tools/call", {"name": tool, "arguments": arguments}
+        # 预热一次（worker 池起容器、import 缓存等），不计入统计
+        server.call(method, params)
+
+        latencies = []
+        errors = 0
+        counter = itertools.count()
+        lock = threading.Lock()
+
+        def drive():
+            nonlocal errors
+            while next(counter) < requests:
+                started = time.perf_counter()
+                response = server.call(method, params)
+                elapsed = time.perf_counter() - started
+                failed = "error" in response
+                if not failed and tool is not None:
+                    text = response["result"]["content"][0]["text"]
+                    failed = json.loads(text).get("success") is False
+                with lock:
+                    latencies.append(elapsed)
+                    errors += failed
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=drive) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+        rss = _peak_rss_kb(server.proc.pid)
+    finally:
+        server.close()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "throughput_rps": round(len(latencies) / wall, 1) if wall else 0.0,
+        "peak_rss_mb": round(rss / 1024, 1) if rss else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MCP tools/call hot path against a fake docker")
+    parser.add_argument("--server", choices=["windows", "linux", "both"], default="both")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--latency-ms", type=float, default=20, help="simulated docker run/exec startup latency")
+    parser.add_argument("--stdout-kb", type=int, default=0, help="extra stdout per docker call")
+    parser.add_argument("--stderr-kb", type=int, default=4, help="stderr volume per docker call")
+    parser.add_argument("--pool", type=int, default=2, help="FFMPEG_MCP_POOL_SIZE for the servers (0 = cold runs)")
+    parser.add_argument("--engine-api", action="store_true",
+                        help="talk to fake_docker_api.py over a unix socket instead of forking the fake docker CLI")
+    parser.add_argument("--hosts", type=int, default=1,
+                        help="start this many fake Engine API daemons and dispatch across them (implies --engine-api)")
+    parser.add_argument("--only", help="run only scenarios whose name contains this text")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    opts = parser.parse_args()
+
+    bindir = _fake_docker_dir()
+    env = dict(os.environ)
+    env.update({
+        "PATH": bindir + os.pathsep + env.get("PATH", ""),
+        "FAKE_DOCKER_LATENCY_MS": str(opts.latency_ms),
+        "FAKE_DOCKER_STDOUT_KB": str(opts.stdout_kb),
+        "FAKE_DOCKER_STDERR_KB": str(opts.stderr_kb),
+        "FFMPEG_MCP_POOL_SIZE": str(opts.pool),
+        # 不限流，量的是 server 本身的开销
+        "FFMPEG_MCP_CONCURRENCY": "ffmpeg-win=0,imagemagick-win=0,probe-win=0,ffmpeg=0,imagemagick=0,probe=0",
+        "FFMPEG_MCP_PROBE_CACHE_DIR": os.path.join(bindir, "probe-cache"),
+        "PYTHONDONTWRITEBYTECODE": "1"
+    })
+    engines = []
+    if opts.engine_api or opts.hosts > 1:
+        socks = [os.path.join(bindir, f"docker{i}.sock") for i in range(max(1, opts.hosts))]
+        for sock in socks:
+            engines.append(subprocess.Popen([sys.executable, os.path.join(HERE, "fake_docker_api.py"), sock],
+                                            env=env, stderr=subprocess.DEVNULL))
+        for sock, engine in zip(socks, engines):
+            while not os.path.exists(sock) and engine.poll() is None:
+                time.sleep(0.05)
+        if len(socks) == 1:
+            env["DOCKER_HOST"] = "unix://" + socks[0]
+        else:
+            env["FFMPEG_MCP_DOCKER_HOSTS"] = ",".join("unix://" + sock for sock in socks)
+    else:
+        # 别碰到本机真的 /var/run/docker.sock
+        env["FFMPEG_MCP_DOCKER_API"] = "0"
+
+    servers = ["windows", "linux"] if opts.server == "both" else [opts.server]
+    rows = []
+    try:
+        for name in servers:
+            for label, tool, arguments in SCENARIOS[name]:
+                if opts.only and opts.only not in label:
+                    continue
+                stats = run_scenario(SERVER_SCRIPTS[name], tool, arguments, opts.requests, opts.concurrency, env)
+                rows.append(dict(stats, server=name, scenario=label))
+                if not opts.json:
+                    sys.stderr.write(f"{name:8} {label:28} done\n")
+    finally:
+        for engine in engines:
+            engine.kill()
+            engine.wait()
+        shutil.rmtree(bindir, ignore_errors=True)
+
+    if opts.json:
+        print(json.dumps({"options": vars(opts), "results": rows}, indent=2))
+        return
+    print(f"requests={opts.requests} concurrency={opts.concurrency} latency={opts.latency_ms}ms "
+          f"stdout={opts.stdout_kb}KB stderr={opts.stderr_kb}KB pool={opts.pool} "
+          f"docker={'engine-api' if engines else 'cli'} hosts={max(1, opts.hosts)}")
+    header = f"{'server':8} {'scenario':28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'RSS MB':>7} {'err':>4}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        rss = f"{row['peak_rss_mb']:.1f}" if row["peak_rss_mb"] is not None else "-"
+        print(f"{row['server']:8} {row['scenario']:28} {row['p50_ms']:9.2f} {row['p95_ms']:9.2f} "
+              f"{row['p99_ms']:9.2f} {row['throughput_rps']:8.1f} {rss:>7} {row['errors']:4d}")
+
+if __name__ == "__main__":
+    main()
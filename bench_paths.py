@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+server.py 路径翻译微基准
+
+对比旧的逐参数 re.match 写法和现在的 translate_ffmpeg_args（预编译 + 记忆化），
+输入是一个几百个参数、filter_complex 里嵌着 D:/ 路径的典型调用。示例：
+
+    python bench_paths.py
+    python bench_paths.py --overlays 200 --number 2000
+"""
+
+import argparse
+import re
+import timeit
+
+import server
+
+def legacy_convert(arg):
+    """旧实现：每个参数现编正则，只认整个参数是路径的情况"""
+    arg = arg.replace("\\", "/")
+    match = re.match(r'^([A-Za-z]):/(.*)', arg)
+    if match:
+        subpath = match.group(2)
+        return f"/work/{subpath}" if subpath else "/work"
+    return arg
+
+def build_args(overlays):
+    """N 个叠加图层 + 一条字幕的滤镜图，参数个数约 4N"""
+    args = ["-y", "-i", "D:/videos/master.mp4"]
+    chains = []
+    for i in range(overlays):
+        args += ["-i", f"D:/assets/overlay_{i:03d}.png"]
+        src = "0:v" if i == 0 else f"v{i - 1}"
+        chains.append(f"[{src}][{i + 1}:v]overlay=x={i}:y={i}:enable='between(t,{i},{i + 1})'[v{i}]")
+    chains.append(f"[v{overlays - 1}]subtitles='D\\:/subs/master subs.srt',movie=D\\:/assets/logo.png[out]")
+    args += ["-filter_complex", ";".join(chains), "-map", "[out]", "-map", "0:a?",
+             "-c:v", "libx264", "-preset", "medium", "-crf", "20", "-c:a", "copy", "D:/videos/output.mp4"]
+    return args
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark Windows path translation in server.py")
+    parser.add_argument("--overlays", type=int, default=100, help="overlay inputs in the filter graph")
+    parser.add_argument("--number", type=int, default=500, help="calls per measurement")
+    opts = parser.parse_args()
+
+    args = build_args(opts.overlays)
+    legacy = [legacy_convert(a) for a in args]
+    current, _, _ = server.translate_ffmpeg_args(args, "D:/")
+    graph = args.index("-filter_complex") + 1
+    print(f"{len(args)} args, filter_complex {len(args[graph])} chars")
+    print(f"embedded paths left untranslated: legacy={legacy[graph].count(':/')} current={current[graph].count(':/')}")
+
+    def cold():
+        server.convert_any_windows_path.cache_clear()
+        server._translate_arg.cache_clear()
+        server.translate_ffmpeg_args(args, "D:/")
+
+    rows = [
+        ("legacy re.match per arg", lambda: [legacy_convert(a) for a in args]),
+        ("translate_ffmpeg_args (cold cache)", cold),
+        ("translate_ffmpeg_args (warm cache)", lambda: server.translate_ffmpeg_args(args, "D:/"))
+    ]
+    for label, fn in rows:
+        best = min(timeit.repeat(fn, number=opts.number, repeat=5)) / opts.number
+        print(f"{label:36} {best * 1e6:10.1f} us/call")
+
+if __name__ == "__main__":
+    main()
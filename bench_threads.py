@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+并发编码的 CPU 分配基准
+
+同时跑 K 个 libx264 编码（输入是 lavfi testsrc2，不读盘），对比两种分配方式的总吞吐：
+
+    - free:  每个 ffmpeg 都按全部核数开线程（以前的行为）
+    - split: 每个 ffmpeg 用 -threads 核数/K（server 的 CpuBudget 现在的做法），加 --cpuset 时再用 taskset 绑到不同的核
+
+需要真实的 ffmpeg：--ffmpeg 是命令前缀，本机 ffmpeg 直接用默认值，走容器时传 docker run 前缀
+（绑核在容器里用 --cpuset-cpus 实现，这时 --ffmpeg 必须以 "docker run" 开头）。示例：
+
+    python bench_threads.py --jobs 4
+    python bench_threads.py --jobs 4 --ffmpeg "docker run --rm zuozuoliang999/ffmpeg:8.1-cli" --cpuset
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+def _encode_args(seconds, size, preset, threads):
+    args = ["-hide_banner", "-nostats", "-loglevel", "error"]
+    if threads:
+        args += ["-filter_threads", str(threads), "-threads", str(threads)]
+    args += ["-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={seconds}"]
+    if threads:
+        args += ["-threads", str(threads)]
+    return args + ["-c:v", "libx264", "-preset", preset, "-f", "null", "-"]
+
+def _command(prefix, args, cpus):
+    """按前缀拼出完整命令；cpus 非空时绑核"""
+    if not cpus:
+        return prefix + args
+    cpuset = ",".join(map(str, cpus))
+    if prefix[:2] == ["docker", "run"]:
+        return prefix[:2] + ["--cpuset-cpus", cpuset] + prefix[2:] + args
+    return ["taskset", "-c", cpuset] + prefix + args
+
+def run_round(prefix, jobs, cores, mode, opts):
+    """同时起 jobs 个编码，返回 (墙钟秒数, 失败数)"""
+    share = max(1, cores // jobs)
+    commands = []
+    for k in range(jobs):
+        threads = share if mode != "free" else 0
+        cpus = [(k * share + c) % cores for c in range(share)] if mode == "split+cpuset" else []
+        commands.append(_command(prefix, _encode_args(opts.seconds, opts.size, opts.preset, threads), cpus))
+
+    failures = []
+
+    def one(cmd):
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            failures.append(proc.stderr.strip()[-300:])
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=one, args=(cmd,)) for cmd in commands]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare aggregate x264 throughput of oversubscribed vs split threads")
+    parser.add_argument("--jobs", type=int, default=4, help="concurrent encodes")
+    parser.add_argument("--cores", type=int, default=os.cpu_count() or 1, help="cores to split between the jobs")
+    parser.add_argument("--seconds", type=int, default=20, help="length of each synthetic clip")
+    parser.add_argument("--size", default="1920x1080", help="frame size of the synthetic clip")
+    parser.add_argument("--preset", default="medium", help="libx264 preset")
+    parser.add_argument("--ffmpeg", default="ffmpeg", help='command prefix, e.g. "docker run --rm IMAGE"')
+    parser.add_argument("--cpuset", action="store_true", help="also run split mode pinned to disjoint cores")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds per mode, best one is reported")
+    opts = parser.parse_args()
+
+    prefix = shlex.split(opts.ffmpeg)
+    modes = ["free", "split"] + (["split+cpuset"] if opts.cpuset else [])
+    frames = opts.jobs * opts.seconds * 30
+    print(f"jobs={opts.jobs} cores={opts.cores} clip={opts.size}@30fps x {opts.seconds}s preset={opts.preset}")
+    header = f"{'mode':14} {'threads/job':>11} {'wall s':>8} {'fps total':>10} {'err':>4}"
+    print(header)
+    print("-" * len(header))
+    baseline = None
+    for mode in modes:
+        best, errors = None, 0
+        for _ in range(opts.rounds):
+            wall, failures = run_round(prefix, opts.jobs, opts.cores, mode, opts)
+            errors += len(failures)
+            if failures:
+                print(f"  {mode}: {failures[0]}")
+            best = wall if best is None else min(best, wall)
+        baseline = baseline or best
+        threads = "auto" if mode == "free" else str(max(1, opts.cores // opts.jobs))
+        print(f"{mode:14} {threads:>11} {best:8.2f} {frames / best:10.1f} {errors:4d}"
+              + ("" if mode == "free" else f"   x{baseline / best:.2f}"))
+
+if __name__ == "__main__":
+    main()
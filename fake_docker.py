@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+假的 docker 可执行文件，给 bench_hotpath.py 用（Engine API 版本见 fake_docker_api.py）
+
+不需要 Docker daemon：按参数模拟 run/exec/inspect/rm，ffmpeg 会输出 -progress 块，
+ffprobe 输出 JSON，busybox 的 stat 脚本每个路径回一行 "size mtime"，
+imagemagick_batch 的 sh 脚本用一个空操作的 magick 函数真实执行。
+
+环境变量:
+    FAKE_DOCKER_LATENCY_MS  每次 run/exec 的启动延迟（默认 50，模拟容器冷启动/exec 开销）
+    FAKE_DOCKER_STDOUT_KB   额外写到 stdout 的数据量（默认 0）
+    FAKE_DOCKER_STDERR_KB   额外写到 stderr 的数据量（默认 4，模拟 ffmpeg 的日志）
+    FAKE_DOCKER_EXIT        ffmpeg/magick 的退出码（默认 0）
+    FAKE_DOCKER_PIPE_KB     pipeline 第一步写到 stdout 管道的数据量（默认 1024）；中间步把 stdin 原样转到 stdout
+    FAKE_DOCKER_NO_IMAGES   为 1 时 docker image inspect 报 No such image，docker pull 耗时 10 倍启动延迟（模拟刚部署）
+    FAKE_DOCKER_DOWN        为 1 时每条命令都报连不上 daemon（模拟多 daemon 里挂掉的一台）
+    FAKE_DOCKER_STATE       状态目录（给测试用）：每条命令追加到 calls.log，run -d 起的容器各留一个文件；
+                            删掉文件就是容器挂了，之后 inspect 报不在、exec 报 No such container
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+LATENCY = float(os.environ.get("FAKE_DOCKER_LATENCY_MS", "50")) / 1000
+STDOUT_KB = int(os.environ.get("FAKE_DOCKER_STDOUT_KB", "0"))
+STDERR_KB = int(os.environ.get("FAKE_DOCKER_STDERR_KB", "4"))
+EXIT_CODE = int(os.environ.get("FAKE_DOCKER_EXIT", "0"))
+NO_IMAGES = os.environ.get("FAKE_DOCKER_NO_IMAGES", "0") == "1"
+PIPE_KB = int(os.environ.get("FAKE_DOCKER_PIPE_KB", "1024"))
+DOWN = os.environ.get("FAKE_DOCKER_DOWN", "0") == "1"
+STATE = os.environ.get("FAKE_DOCKER_STATE", "")
+
+def _record(argv):
+    if STATE:
+        with open(os.path.join(STATE, "calls.log"), "a") as f:
+            f.write(json.dumps(argv) + "\n")
+
+def _alive(cid):
+    return not STATE or os.path.exists(os.path.join(STATE, cid))
+
+def _split(argv):
+    """拆出 docker run/exec 的 (镜像或容器, entrypoint, 容器里的 argv)"""
+    if argv[0] == "exec":
+        return argv[1], None, argv[2:]
+    entrypoint = None
+    i = 1
+    while i < len(argv) and argv[i].startswith("-"):
+        if argv[i] == "--entrypoint":
+            entrypoint = argv[i + 1]
+        i += 1 if argv[i] in ("--rm", "-d", "-i", "-t") else 2
+    return argv[i], entrypoint, argv[i + 1:]
+
+def _filler(stream, kb, text):
+    line = (text * (1024 // len(text) + 1))[:1023] + "\n"
+    for _ in range(kb):
+        stream.write(line)
+
+def _pipe_io(cmd):
+    """(从 stdin 读, 往 stdout 写)：ffmpeg 的 -i - / pipe:0，magick 的 ppm:- 这类；输出是最后一个参数"""
+    reads = any(a in ("-", "pipe:", "pipe:0") or a.endswith(":-") for a in cmd[:-1])
+    writes = bool(cmd) and (cmd[-1] in ("-", "pipe:", "pipe:1") or cmd[-1].endswith(":-"))
+    return reads, writes
+
+def emulate(kind, target, entrypoint, cmd, out, err, stdin=None):
+    """
+    容器里跑一条命令：kind 是 run/exec，out/err 是文本流，返回退出码
+
+    fake_docker_api.py 在进程内直接调用它，CLI 和 Engine API 两条路径的输出一致。
+    """
+    if entrypoint is None:
+        # exec 时第一个参数就是可执行文件；run 时用镜像自带的 entrypoint
+        if kind == "exec" or "busybox" in target:
+            entrypoint, cmd = cmd[0], cmd[1:]
+        else:
+            entrypoint = "magick" if "imagemagick" in target else "ffmpeg"
+
+    reads, writes = _pipe_io(cmd) if entrypoint in ("ffmpeg", "magick") else (False, False)
+    if reads or writes:
+        # pipeline 的一步：读完 stdin（中间步原样转发），或者第一步自己产出 PIPE_KB 的"帧"
+        total = 0
+        if reads and stdin is not None:
+            for chunk in iter(lambda: stdin.read(65536), ""):
+                total += len(chunk)
+                if writes:
+                    out.write(chunk)
+        elif writes:
+            _filler(out, PIPE_KB, "p")
+        err.write(f"{entrypoint}: piped {total} bytes in\n")
+        return EXIT_CODE
+
+    if entrypoint == "ffprobe":
+        if "-show_format" in cmd:
+            out.write(json.dumps({
+                "format": {"filename": cmd[-1], "duration": "60.000000", "format_name": "mov,mp4,m4a,3gp,3g2,mj2"},
+                "streams": [
+                    {"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080},
+                    {"index": 1, "codec_type": "audio", "codec_name": "aac", "sample_rate": "48000"}
+                ]
+            }) + "\n")
+        else:
+            for i in range(0, 1500):
+                out.write(f"{i * 0.04:.6f},{'K_' if i % 50 == 0 else '__'}\n")
+        return 0
+
+    if entrypoint == "sh" and "magick" in cmd[1]:
+        # imagemagick_batch 的脚本: 换一个什么都不做的 magick 函数真跑一遍 (带 --fail 的操作模拟失败)
+        fake = 'magick() { for a; do [ "$a" = --fail ] && { echo "magick: unrecognized option --fail" >&2; return 1; }; done; return 0; }\n'
+        proc = subprocess.run(["sh", "-c", fake + cmd[1]], capture_output=True, text=True)
+        out.write(proc.stdout)
+        err.write(proc.stderr)
+        return proc.returncode
+
+    if entrypoint == "sh":
+        # busybox stat 脚本: sh -c SCRIPT sh path...
+        for _ in cmd[3:]:
+            out.write("1048576 1700000000\n")
+        return 0
+
+    if entrypoint == "ffmpeg":
+        if cmd == ["-version"]:
+            out.write("ffmpeg version 8.1 Copyright (c) 2000-2025 the FFmpeg developers\n")
+            return 0
+        err.write("  Duration: 00:01:00.00, start: 0.000000, bitrate: 4000 kb/s\n")
+        if "-progress" in cmd:
+            for i in range(1, 5):
+                out.write(f"frame={i * 375}\nfps=250.0\nout_time_us={i * 15000000}\n"
+                          f"speed=10.0x\nprogress={'end' if i == 4 else 'continue'}\n")
+                out.flush()
+    _filler(out, STDOUT_KB, "o")
+    if "-benchmark" in cmd:
+        err.write(f"bench: utime={LATENCY * 4:.3f}s stime={LATENCY / 2:.3f}s rtime={LATENCY:.3f}s\n"
+                  "bench: maxrss=65536KiB\n")
+    _filler(err, STDERR_KB, "frame=  100 fps=250 q=28.0 size=    1024kB time=00:00:04.00 ")
+    return EXIT_CODE
+
+def main():
+    argv = sys.argv[1:]
+    if not argv:
+        sys.exit(1)
+    _record(argv)
+    if DOWN:
+        sys.stderr.write("Cannot connect to the Docker daemon at unix:///var/run/docker.sock. "
+                         "Is the docker daemon running?\n")
+        sys.exit(1)
+    if argv[0] == "run" and "-d" in argv:
+        cid = uuid.uuid4().hex
+        if STATE:
+            open(os.path.join(STATE, cid), "w").close()
+        print(cid)
+        return
+    if argv[0] == "inspect":
+        for arg in argv[1:]:
+            if not arg.startswith("-") and "{{" not in arg:
+                if _alive(arg):
+                    print(arg, "true")
+                else:
+                    sys.stderr.write(f"Error: No such object: {arg}\n")
+        return
+    if argv[0] == "rm" and STATE:
+        for arg in argv[1:]:
+            if not arg.startswith("-") and _alive(arg):
+                os.remove(os.path.join(STATE, arg))
+        return
+    if argv[0] == "info":
+        print(os.cpu_count() or 1)
+        return
+    if argv[0] == "image" and NO_IMAGES:
+        sys.stderr.write(f"Error: No such image: {argv[-1]}\n")
+        sys.exit(1)
+    if argv[0] == "pull" and NO_IMAGES:
+        time.sleep(LATENCY * 10)
+        return
+    if argv[0] in ("rm", "kill", "stop", "pull", "image"):
+        return
+    if argv[0] not in ("run", "exec"):
+        sys.exit(1)
+
+    time.sleep(LATENCY)
+    target, entrypoint, cmd = _split(argv)
+    if argv[0] == "exec" and not _alive(target):
+        sys.stderr.write(f"Error response from daemon: No such container: {target}\n")
+        sys.exit(1)
+    # run -i / exec -i 才把 stdin 交给容器里的命令
+    stdin = sys.stdin if "-i" in argv[:argv.index(target)] else None
+    code = emulate(argv[0], target, entrypoint, cmd, sys.stdout, sys.stderr, stdin)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+假的 Docker Engine API（unix socket 或 TCP），给 bench_hotpath.py 和本地调试用
+
+实现 server 用到的那几个接口：容器 create/start/attach（可带 stdin）/wait/inspect/delete、exec create/start/inspect、
+image inspect / pull、info。attach 和 exec start 按 Engine API 的方式 hijack 连接，输出按 8 字节帧头复用 stdout/stderr；
+容器里"跑"的命令和 fake_docker.py 一样（同一个 emulate()，同样读 FAKE_DOCKER_* 环境变量）。示例：
+
+    python fake_docker_api.py /tmp/fake-docker.sock &
+    DOCKER_HOST=unix:///tmp/fake-docker.sock python server_linux.py
+
+多 daemon 调度：起几个假 daemon，用 FFMPEG_MCP_DOCKER_HOSTS 配给 server，--ncpu 让它们报不同的核数：
+
+    python fake_docker_api.py /tmp/a.sock --ncpu 4 &
+    python fake_docker_api.py 127.0.0.1:2375 --ncpu 8 &
+    FFMPEG_MCP_DOCKER_HOSTS=unix:///tmp/a.sock=4,tcp://127.0.0.1:2375=8 python server_linux.py
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import fake_docker
+
+_LOCK = threading.Lock()
+_CONTAINERS = {}
+_EXECS = {}
+_PULLED = set()
+_NCPU = [os.cpu_count() or 1]
+
+class _Container:
+    def __init__(self, name, config):
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.name = name
+        self.config = config
+        self.running = False
+        self.exit_code = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.attached = False
+
+class _FrameWriter(io.TextIOBase):
+    """把文本写成 Engine API 的复用流帧"""
+
+    def __init__(self, wfile, stream, lock):
+        self.wfile = wfile
+        self.stream = stream
+        self.lock = lock
+
+    def write(self, text):
+        data = text.encode()
+        if data:
+            with self.lock:
+                self.wfile.write(bytes([self.stream, 0, 0, 0]) + len(data).to_bytes(4, "big") + data)
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.wfile.flush()
+
+def _lookup(ref):
+    with _LOCK:
+        for c in _CONTAINERS.values():
+            if c.id.startswith(ref) or c.name == ref:
+                return c
+    return None
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _hijack(self, run):
+        """101 之后把连接当原始流，run(out, err) 写完就关"""
+        self.wfile.write(b"HTTP/1.1 101 UPGRADED\r\nContent-Type: application/vnd.docker.multiplexed-stream\r\n"
+                         b"Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n")
+        self.wfile.flush()
+        lock = threading.Lock()
+        try:
+            run(_FrameWriter(self.wfile, 1, lock), _FrameWriter(self.wfile, 2, lock))
+            self.wfile.flush()
+        except OSError:
+            pass
+        self.close_connection = True
+
+    def _image_present(self, image):
+        return not fake_docker.NO_IMAGES or image in _PULLED
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        m = re.fullmatch(r"(?:/v[\d.]+)?/containers/([^/]+)/json", path)
+        if m:
+            c = _lookup(unquote(m.group(1)))
+            if c is None:
+                return self._send(404, {"message": f"No such container: {unquote(m.group(1))}"})
+            return self._send(200, {"Id": c.id, "Name": "/" + c.name, "State": {"Running": c.running}})
+        m = re.fullmatch(r"(?:/v[\d.]+)?/images/(.+)/json", path)
+        if m:
+            image = unquote(m.group(1))
+            if not self._image_present(image):
+                return self._send(404, {"message": f"No such image: {image}"})
+            return self._send(200, {"Id": "sha256:" + uuid.uuid5(uuid.NAMESPACE_URL, image).hex})
+        m = re.fullmatch(r"(?:/v[\d.]+)?/exec/([^/]+)/json", path)
+        if m and m.group(1) in _EXECS:
+            return self._send(200, {"ExitCode": _EXECS[m.group(1)]["exit_code"], "Running": False})
+        if path.endswith("/info"):
+            return self._send(200, {"NCPU": _NCPU[0]})
+        if path.endswith("/_ping"):
+            return self._send(200, "OK")
+        self._send(404, {"message": f"page not found: {path}"})
+
+    def do_DELETE(self):
+        m = re.fullmatch(r"(?:/v[\d.]+)?/containers/([^/]+)", urlsplit(self.path).path)
+        c = _lookup(unquote(m.group(1))) if m else None
+        if c is None:
+            return self._send(404, {"message": "No such container"})
+        with _LOCK:
+            _CONTAINERS.pop(c.id, None)
+        c.running = False
+        c.exited.set()
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        path = re.sub(r"^/v[\d.]+", "", url.path)
+        query = parse_qs(url.query)
+        body = self._body()
+
+        if path == "/images/create":
+            image = query["fromImage"][0] + ":" + query.get("tag", ["latest"])[0]
+            time.sleep(fake_docker.LATENCY * 10 if fake_docker.NO_IMAGES else 0)
+            _PULLED.add(image)
+            return self._send(200, {"status": f"Status: Downloaded newer image for {image}"})
+
+        if path == "/containers/create":
+            if not self._image_present(body.get("Image", "")):
+                return self._send(404, {"message": f"No such image: {body.get('Image')}"})
+            name = query.get("name", [""])[0] or uuid.uuid4().hex[:12]
+            c = _Container(name, body)
+            with _LOCK:
+                _CONTAINERS[c.id] = c
+            return self._send(201, {"Id": c.id, "Warnings": []})
+
+        m = re.fullmatch(r"/containers/([^/]+)/(start|attach|wait|exec)", path)
+        if m:
+            c = _lookup(unquote(m.group(1)))
+            if c is None:
+                return self._send(404, {"message": f"No such container: {unquote(m.group(1))}"})
+            action = m.group(2)
+            if action == "start":
+                c.running = True
+                # 没 attach 的容器（worker 的 sleep）一直"运行"到被删
+                c.started.set()
+                return self._send(204)
+            if action == "attach":
+                c.attached = True
+
+                # stdin=1 时连接剩下的字节就是容器的 stdin，客户端半关连接即 EOF（pipeline 的中间步）
+                stdin = None
+                if query.get("stdin") == ["1"] and c.config.get("OpenStdin"):
+                    stdin = io.TextIOWrapper(self.rfile, encoding="utf-8", newline="")
+
+                def run(out, err):
+                    c.started.wait()
+                    time.sleep(fake_docker.LATENCY)
+                    entrypoint = (c.config.get("Entrypoint") or [None])[0]
+                    try:
+                        c.exit_code = fake_docker.emulate("run", c.config["Image"], entrypoint,
+                                                          c.config.get("Cmd") or [], out, err, stdin)
+                    finally:
+                        if stdin is not None:
+                            stdin.detach()
+                        c.running = False
+                        c.exited.set()
+
+                return self._hijack(run)
+            if action == "wait":
+                c.exited.wait()
+                return self._send(200, {"StatusCode": c.exit_code if c.exit_code is not None else 137})
+            if not c.running:
+                return self._send(409, {"message": f"Container {c.id} is not running"})
+            exec_id = uuid.uuid4().hex
+            _EXECS[exec_id] = {"container": c, "cmd": body.get("Cmd") or [], "exit_code": None}
+            return self._send(201, {"Id": exec_id})
+
+        m = re.fullmatch(r"/exec/([^/]+)/start", path)
+        if m and m.group(1) in _EXECS:
+            ex = _EXECS[m.group(1)]
+
+            def run(out, err):
+                time.sleep(fake_docker.LATENCY)
+                ex["exit_code"] = fake_docker.emulate("exec", ex["container"].id, None, ex["cmd"], out, err)
+
+            return self._hijack(run)
+
+        self._send(404, {"message": f"page not found: {path}"})
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler 要一个 (host, port) 形式的 client_address
+        request, _ = super().get_request()
+        return request, ("fake-docker", 0)
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def get_request(self):
+        request, address = super().get_request()
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return request, address
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Docker Engine API on a unix socket or TCP port")
+    parser.add_argument("socket", help="unix socket path, or host:port to listen on TCP")
+    parser.add_argument("--ncpu", type=int, help="NCPU reported by /info (default: this machine's core count)")
+    opts = parser.parse_args()
+    if opts.ncpu:
+        _NCPU[0] = opts.ncpu
+    if not opts.socket.startswith("/") and ":" in opts.socket:
+        host, _, port = opts.socket.rpartition(":")
+        server = TCPServer((host, int(port)), Handler)
+        sys.stderr.write(f"fake docker engine listening on tcp://{opts.socket}\n")
+        server.serve_forever()
+        return
+    if os.path.exists(opts.socket):
+        os.remove(opts.socket)
+    server = Server(opts.socket, Handler)
+    sys.stderr.write(f"fake docker engine listening on {opts.socket}\n")
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(opts.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2704 @@
+"""
+FFmpeg MCP Server 公共部分: server.py (Windows 版) 和 server_linux.py (Linux 云端版) 都从这里导入.
+
+两边只在路径怎么进容器上不同 (盘符转换 + 按盘挂卷 / 同路径挂 /home/media), 其余的都在这里, 不再各抄一份:
+- stdio 上的 JSON-RPC 输出, 进度通知
+- Docker Engine API 客户端, daemon (DockerHost) 和它的镜像预检, 常驻 worker 池
+- 跑一次容器: 输出截断/落盘、超时和取消 (CancelToken)、核数分配 (CpuBudget)、-threads / -preset 注入
+- ffmpeg 进度解析, 批量并行, smart cut 的规划和执行, 容器间管道
+- 并发槽 (JobScheduler)、后台任务 (JobTable)、指标 (Metrics)、probe 缓存
+
+要换卷映射的地方都显式收 run_opts (docker run 的 -v 参数) 和 host, 由各自的 server 给出.
+"""
+
+import atexit
+import bisect
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlsplit
+
+FFMPEG_IMAGE = "zuozuoliang999/ffmpeg:8.1-cli"
+IMAGEMAGICK_IMAGE = "zuozuoliang999/imagemagick:latest"
+BUSYBOX_IMAGE = "zuozuoliang999/busybox:latest"
+
+# docker exec 进常驻 worker 时要显式给出可执行文件 (cold run 靠镜像 entrypoint)
+IMAGE_BINARIES = {FFMPEG_IMAGE: "ffmpeg", IMAGEMAGICK_IMAGE: "magick", BUSYBOX_IMAGE: None}
+
+# 常驻 worker 池: 每个镜像 (每种卷映射) 预先起 N 个容器, 任务通过 docker exec 进去跑, 省掉每次 create/start/rm
+# FFMPEG_MCP_POOL_SIZE=0 关闭, 全部回到 docker run --rm 冷启动
+POOL_SIZE = int(os.environ.get("FFMPEG_MCP_POOL_SIZE", "2"))
+POOL_MAX_JOBS = int(os.environ.get("FFMPEG_MCP_POOL_MAX_JOBS", "100"))
+POOL_MAX_AGE = float(os.environ.get("FFMPEG_MCP_POOL_MAX_AGE_MIN", "30")) * 60
+POOL_HEALTH_INTERVAL = float(os.environ.get("FFMPEG_MCP_POOL_HEALTH_INTERVAL", "30"))
+POOL_LABEL = "ffmpeg-mcp.worker"
+
+# Docker Engine API: 直接在 docker.sock 上说 HTTP, 不再每次 fork docker CLI (启动 + 读配置 50-150ms).
+# auto = socket 在就用, 连不上时自动退回 CLI; 0 = 总是用 CLI. DOCKER_HOST 是 unix:// 时用它指的 socket,
+# 是 tcp:// / npipe:// 之类时只走 CLI (Windows 上直接跑就是这种情况)
+DOCKER_API = os.environ.get("FFMPEG_MCP_DOCKER_API", "auto").lower() not in ("0", "false", "no", "off")
+_DOCKER_HOST = os.environ.get("DOCKER_HOST", "")
+DOCKER_SOCKET = _DOCKER_HOST[len("unix://"):] if _DOCKER_HOST.startswith("unix://") else (
+    "" if _DOCKER_HOST else "/var/run/docker.sock")
+# 连不上的 daemon 隔多少秒再参与调度 (多台 daemon 时)
+HOST_RETRY = float(os.environ.get("FFMPEG_MCP_HOST_RETRY_S", "30"))
+# tcp:// daemon 的建连超时: 机器挂了时 SYN 可能一直没回应
+CONNECT_TIMEOUT = float(os.environ.get("FFMPEG_MCP_CONNECT_TIMEOUT", "5"))
+
+# 子进程输出只保留开头 HEAD_KB + 结尾 TAIL_KB, 中间丢掉并记字节数: -loglevel debug / showinfo 刷出几十 MB 时
+# 内存和响应大小都有上限, 开头的报错 (Error response from daemon, 参数错误) 和结尾的总结都还在
+STDERR_HEAD_KB = int(os.environ.get("FFMPEG_MCP_STDERR_HEAD_KB", "16"))
+STDERR_TAIL_KB = int(os.environ.get("FFMPEG_MCP_STDERR_TAIL_KB", "64"))
+STDOUT_HEAD_KB = int(os.environ.get("FFMPEG_MCP_STDOUT_HEAD_KB", "64"))
+STDOUT_TAIL_KB = int(os.environ.get("FFMPEG_MCP_STDOUT_TAIL_KB", "64"))
+# 输出被截断时把完整内容写到这个目录 (建议放卷里), 结果里返回路径; 不设就只截断
+LOG_DIR = os.environ.get("FFMPEG_MCP_LOG_DIR", "").replace("\\", "/").rstrip("/")
+LOG_RETENTION = float(os.environ.get("FFMPEG_MCP_LOG_RETENTION_H", "72")) * 3600
+
+# 启动预检: initialize 时后台 docker image inspect 三个镜像, 缺的直接 pull, 再把 worker 池起满并各跑一次 -version
+PREFLIGHT = os.environ.get("FFMPEG_MCP_PREFLIGHT", "1").lower() in ("1", "true", "yes", "on")
+PREFLIGHT_PULL = os.environ.get("FFMPEG_MCP_PREFLIGHT_PULL", "1").lower() in ("1", "true", "yes", "on")
+PREFLIGHT_PULL_TIMEOUT = int(os.environ.get("FFMPEG_MCP_PREFLIGHT_PULL_TIMEOUT", "1800"))
+# 预检还没跑完时, 用到该镜像的调用最多先等这么久 (秒), 之后才开始算自己的超时
+PREFLIGHT_WAIT = float(os.environ.get("FFMPEG_MCP_PREFLIGHT_WAIT", "600"))
+
+# 按核数给 ffmpeg 分 CPU: 同时在跑的 ffmpeg 平分核数, 注入 -threads / -filter_threads, 冷启动容器再加
+# --cpus / --cpuset-cpus (CPUSET=0 只加 --cpus), 不再每个 ffmpeg 都以为自己独占整台机器. CPU_TUNE=0 关闭
+CPU_TUNE = os.environ.get("FFMPEG_MCP_CPU_TUNE", "1").lower() in ("1", "true", "yes", "on")
+CPU_PIN = os.environ.get("FFMPEG_MCP_CPUSET", "1").lower() in ("1", "true", "yes", "on")
+# 总核数: 不设就用 docker info 的 NCPU (worker 容器实际跑在哪台机器), 拿不到再看本进程的 affinity 和 cgroup 配额
+CPUS_OVERRIDE = os.environ.get("FFMPEG_MCP_CPUS", "")
+# x264 / x265 / SVT-AV1 的 -preset 默认档位 (工具参数 tier 可单次覆盖): latency / balanced / quality, 空 = 不动
+DEFAULT_TIER = os.environ.get("FFMPEG_MCP_TIER", "").lower()
+
+# 后台任务 (job_submit): 默认超时, 结束后保留多久/最多保留几个
+JOB_TIMEOUT = int(os.environ.get("FFMPEG_MCP_JOB_TIMEOUT", str(6 * 3600)))
+JOB_RETENTION = float(os.environ.get("FFMPEG_MCP_JOB_RETENTION_MIN", "60")) * 60
+JOB_MAX_FINISHED = int(os.environ.get("FFMPEG_MCP_JOB_MAX_FINISHED", "200"))
+
+# 指标导出 (Prometheus 文本格式): 每次调用后原子写到文件, 和/或在端口上提供 /metrics; 都不设就只有 stats 工具
+METRICS_FILE = os.environ.get("FFMPEG_MCP_METRICS_FILE", "")
+METRICS_PORT = int(os.environ.get("FFMPEG_MCP_METRICS_PORT", "0"))
+
+# 同时在处理 (包括在 JobScheduler 里排队) 的 tools/call 上限, 满了直接回 busy; 0 = 不限
+MAX_INFLIGHT = int(os.environ.get("FFMPEG_MCP_MAX_INFLIGHT", "64"))
+
+_STDOUT_LOCK = threading.Lock()
+
+
+def send(payload: dict) -> None:
+    # tools/call 在各自线程里并发执行, 响应整行加锁写出, 避免交错
+    line = json.dumps(payload, separators=(",", ":"))
+    with _STDOUT_LOCK:
+        print(line, flush=True)
+
+
+def send_error(rid, code: int, message: str) -> None:
+    send({"jsonrpc": "2.0", "id": rid, "error": {"code": code, "message": message}})
+
+
+def send_result(rid, result: dict) -> None:
+    send({"jsonrpc": "2.0", "id": rid, "result": result})
+
+
+def send_tool_result(rid, result: dict) -> None:
+    """tools/call 的结果包成一段文本内容; 紧凑 JSON, 不转义中文."""
+    send_result(rid, {"content": [{"type": "text", "text": json.dumps(result, ensure_ascii=False, separators=(",", ":"))}]})
+
+
+def _log(message: str) -> None:
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+class DockerAPIError(Exception):
+    """daemon 返回 4xx/5xx, status 是 HTTP 状态码."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class DockerAPIUnavailable(Exception):
+    """socket 连不上 (不存在 / 没权限 / daemon 没起), 调用方退回 CLI."""
+
+
+def _api_message(data: bytes) -> str:
+    try:
+        return json.loads(data)["message"]
+    except (ValueError, KeyError, TypeError):
+        return data.decode("utf-8", errors="replace").strip()
+
+
+def _docker_connect(address: str, timeout: float | None) -> socket.socket:
+    """address 是 unix socket 路径, 或者 tcp daemon 的 host:port."""
+    if "/" in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError as e:
+            sock.close()
+            raise DockerAPIUnavailable(f"{address}: {e}") from e
+        return sock
+    host, _, port = address.rpartition(":")
+    try:
+        sock = socket.create_connection((host, int(port)), CONNECT_TIMEOUT if timeout is None
+                                        else min(timeout, CONNECT_TIMEOUT))
+    except (OSError, ValueError) as e:
+        raise DockerAPIUnavailable(f"{address}: {e}") from e
+    sock.settimeout(timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _engine_address(url: str) -> str:
+    """DOCKER_HOST 形式的地址 -> _docker_connect 的 address; 认不出来返回空串 (只走 CLI)."""
+    if url.startswith("unix://"):
+        return url[len("unix://"):]
+    if url.startswith(("tcp://", "http://")):
+        return urlsplit(url).netloc
+    return ""
+
+
+class _DockerHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, address: str, timeout: float | None):
+        super().__init__("docker", timeout=timeout)
+        self.address = address
+
+    def connect(self) -> None:
+        self.sock = _docker_connect(self.address, self.timeout)
+
+
+class _Attached:
+    """一条 hijack 过的 attach / exec start 连接: 按 8 字节帧头拆出 stdout(1) / stderr(2), wait() 取退出码."""
+
+    def __init__(self, sock: socket.socket, fp, wait):
+        self._sock = sock
+        self._fp = fp
+        self._wait = wait
+        self._aborted = False
+
+    def frames(self):
+        while True:
+            header = self._fp.read(8)
+            if len(header) < 8:
+                return
+            payload = self._fp.read(int.from_bytes(header[4:8], "big"))
+            if payload:
+                yield header[0], payload
+
+    def stdout_reader(self, on_stderr):
+        """每次返回一帧 stdout 的读函数 (b"" 为结束), 夹在中间的 stderr 帧交给 on_stderr."""
+        frames = self.frames()
+
+        def read() -> bytes:
+            for stream, payload in frames:
+                if stream != 2:
+                    return payload
+                on_stderr(payload)
+            return b""
+
+        return read
+
+    def send(self, data) -> int:
+        """写容器的 stdin (attach 时要带 stdin), 返回写了多少."""
+        return self._sock.send(data)
+
+    def close_stdin(self) -> None:
+        # 半关连接: daemon 把 EOF 交给容器 (StdinOnce), 输出照常读
+        with contextlib.suppress(OSError):
+            self._sock.shutdown(socket.SHUT_WR)
+
+    def abort(self) -> None:
+        # 只断流, 容器 / exec 里的进程由调用方删容器处理 (和杀 CLI 一样)
+        self._aborted = True
+        with contextlib.suppress(OSError):
+            self._sock.shutdown(socket.SHUT_RDWR)
+
+    def wait(self) -> int:
+        # 和被 SIGKILL 的 CLI 一样报 -9 (Windows 上没有 signal.SIGKILL)
+        return -9 if self._aborted else self._wait()
+
+    def close(self) -> None:
+        with contextlib.suppress(OSError):
+            self._fp.close()
+            self._sock.close()
+
+
+class DockerEngine:
+    """Docker Engine API 客户端 (unix socket 或 tcp:// 上的 HTTP/1.1, 不支持 TLS).
+
+    控制请求 (create / start / wait / inspect / delete) 走 keep-alive 连接池, 跨调用复用; attach 和 exec start
+    会把连接 hijack 成原始流, 每次单开一条. 只认本文件自己拼出来的几种 docker 命令 (spec / run_cli),
+    其余一律交回 CLI; socket 连不上就整体关掉, 之后全走 CLI.
+    """
+
+    IDLE_MAX = 8
+
+    def __init__(self, address: str, enabled: bool):
+        self.address = address
+        if "/" in address:
+            enabled = enabled and hasattr(socket, "AF_UNIX") and os.path.exists(address)
+        self.enabled = enabled and bool(address)
+        self._idle: list = []
+        self._lock = threading.Lock()
+
+    def disable(self, error) -> None:
+        if self.enabled:
+            self.enabled = False
+            _log(f"docker engine API unavailable ({error}), falling back to docker CLI")
+
+    def request(self, method: str, url: str, body=None, timeout: float | None = 60) -> bytes:
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        for attempt in (0, 1):
+            conn = None
+            if attempt == 0:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = _DockerHTTPConnection(self.address, timeout)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, url, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused:
+                    continue  # 空闲太久被 daemon 关掉的 keep-alive 连接, 换新连接重试一次
+                raise
+            keep = not resp.will_close
+            if keep:
+                with self._lock:
+                    keep = len(self._idle) < self.IDLE_MAX
+                    if keep:
+                        self._idle.append(conn)
+            if not keep:
+                conn.close()
+            if resp.status >= 400:
+                raise DockerAPIError(resp.status, _api_message(data))
+            return data
+        raise AssertionError("unreachable")
+
+    def _json(self, method: str, url: str, body=None, timeout: float | None = 60):
+        data = self.request(method, url, body, timeout)
+        return json.loads(data) if data else None
+
+    def _hijack(self, url: str, body=None, timeout: float | None = None) -> tuple:
+        sock = _docker_connect(self.address, timeout)
+        payload = json.dumps(body).encode() if body is not None else b""
+        try:
+            sock.sendall((f"POST {url} HTTP/1.1\r\nHost: docker\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(payload)}\r\nConnection: Upgrade\r\nUpgrade: tcp\r\n\r\n").encode()
+                         + payload)
+            fp = sock.makefile("rb")
+            status = int((fp.readline().split() + [b"0", b"0"])[1])
+            length = 0
+            for line in iter(fp.readline, b""):
+                if line in (b"\r\n", b"\n"):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip() or 0)
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        if status >= 400 or status == 0:
+            data = fp.read(length) if length else b""
+            fp.close()
+            sock.close()
+            raise DockerAPIError(status, _api_message(data) or f"HTTP {status}")
+        return sock, fp
+
+    def pull(self, image: str, timeout: float | None = 1800) -> None:
+        repo, tag = image, "latest"
+        if ":" in image.rsplit("/", 1)[-1]:
+            repo, tag = image.rsplit(":", 1)
+        data = self.request("POST", f"/images/create?fromImage={quote(repo, safe='')}&tag={quote(tag, safe='')}",
+                            timeout=timeout)
+        for line in data.splitlines():
+            with contextlib.suppress(ValueError):
+                message = json.loads(line)
+                if isinstance(message, dict) and message.get("error"):
+                    raise DockerAPIError(500, message["error"])
+
+    def remove(self, cid: str) -> None:
+        try:
+            self.request("DELETE", f"/containers/{quote(cid, safe='')}?force=1")
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+
+    def create(self, spec: dict) -> str:
+        """建容器 (还没 start), 返回 ID; 镜像不在本地时和 CLI 一样先拉."""
+        host_config = {"Binds": spec["binds"]}
+        if spec["detach"] and spec["rm"]:
+            host_config["AutoRemove"] = True
+        if spec["cpus"]:
+            host_config["NanoCpus"] = int(spec["cpus"] * 1e9)
+        if spec["cpuset"]:
+            host_config["CpusetCpus"] = spec["cpuset"]
+        config = {"Image": spec["image"], "Cmd": spec["cmd"] or None, "Labels": spec["labels"],
+                  "AttachStdout": not spec["detach"], "AttachStderr": not spec["detach"], "HostConfig": host_config}
+        if spec["stdin"]:
+            config.update(AttachStdin=True, OpenStdin=True, StdinOnce=True)
+        if spec["entrypoint"] is not None:
+            config["Entrypoint"] = [spec["entrypoint"]]
+        if spec["workdir"]:
+            config["WorkingDir"] = spec["workdir"]
+        if spec["env"]:
+            config["Env"] = spec["env"]
+        url = "/containers/create" + (f"?name={quote(spec['name'], safe='')}" if spec["name"] else "")
+        try:
+            return self._json("POST", url, config)["Id"]
+        except DockerAPIError as e:
+            if e.status != 404 or "image" not in str(e).lower():
+                raise
+        self.pull(spec["image"])
+        return self._json("POST", url, config)["Id"]
+
+    def attach(self, spec: dict, timeout: float | None = None) -> _Attached:
+        """按 spec 起 exec 或前台容器并接上输出流."""
+        if spec["kind"] == "exec":
+            exec_id = self._json("POST", f"/containers/{quote(spec['cid'], safe='')}/exec",
+                                 {"AttachStdout": True, "AttachStderr": True, "Cmd": spec["cmd"]})["Id"]
+            sock, fp = self._hijack(f"/exec/{exec_id}/start", {"Detach": False, "Tty": False}, timeout)
+            return _Attached(sock, fp, lambda: self._json("GET", f"/exec/{exec_id}/json")["ExitCode"])
+
+        cid = self.create(spec)
+        try:
+            stdin = "&stdin=1" if spec["stdin"] else ""
+            sock, fp = self._hijack(f"/containers/{cid}/attach?stream=1&stdout=1&stderr=1{stdin}", None, timeout)
+            try:
+                self.request("POST", f"/containers/{cid}/start")
+            except Exception:
+                fp.close()
+                sock.close()
+                raise
+        except Exception:
+            with contextlib.suppress(Exception):
+                self.remove(cid)
+            raise
+
+        def wait() -> int:
+            try:
+                return self._json("POST", f"/containers/{cid}/wait")["StatusCode"]
+            finally:
+                if spec["rm"]:
+                    self.remove(cid)
+
+        return _Attached(sock, fp, wait)
+
+    @staticmethod
+    def spec(argv: list) -> dict | None:
+        """本文件拼出来的 docker run / exec 命令 -> API 参数; 有不认识的选项返回 None, 交给 CLI."""
+        if len(argv) < 3 or argv[0] != "docker":
+            return None
+        if argv[1] == "exec":
+            return None if argv[2].startswith("-") else {"kind": "exec", "cid": argv[2], "cmd": argv[3:]}
+        if argv[1] != "run":
+            return None
+        spec = {"kind": "run", "rm": False, "detach": False, "stdin": False, "name": "", "labels": {}, "binds": [],
+                "env": [], "workdir": "", "entrypoint": None, "cpus": None, "cpuset": ""}
+        flags = {"--rm": "rm", "-d": "detach", "-i": "stdin"}
+        i = 2
+        while i < len(argv) and argv[i].startswith("-"):
+            opt = argv[i]
+            if opt in flags:
+                spec[flags[opt]] = True
+                i += 1
+                continue
+            if i + 1 >= len(argv):
+                return None
+            value = argv[i + 1]
+            if opt == "--name":
+                spec["name"] = value
+            elif opt == "--label":
+                key, _, label = value.partition("=")
+                spec["labels"][key] = label
+            elif opt == "-v":
+                spec["binds"].append(value)
+            elif opt == "-e":
+                # 和 CLI 一样: 只写变量名时取本进程的值, 本进程没有就不传
+                if "=" in value or value in os.environ:
+                    spec["env"].append(value if "=" in value else f"{value}={os.environ[value]}")
+            elif opt == "-w":
+                spec["workdir"] = value
+            elif opt == "--entrypoint":
+                spec["entrypoint"] = value
+            elif opt == "--cpus":
+                spec["cpus"] = float(value)
+            elif opt == "--cpuset-cpus":
+                spec["cpuset"] = value
+            else:
+                return None
+            i += 2
+        if i >= len(argv):
+            return None
+        spec.update(image=argv[i], cmd=argv[i + 1:])
+        return spec
+
+    def run_cli(self, argv: list, timeout: float) -> subprocess.CompletedProcess | None:
+        """短 docker 命令的 API 版本, stdout 格式和 CLI 一致; 不认识的命令返回 None."""
+        cmd = argv[1:]
+        if cmd[:2] == ["rm", "-f"]:
+            for cid in cmd[2:]:
+                self.remove(cid)
+            return subprocess.CompletedProcess(argv, 0, "", "")
+        if cmd[:3] == ["inspect", "-f", "{{.Id}} {{.State.Running}}"]:
+            lines, missing = [], []
+            for cid in cmd[3:]:
+                try:
+                    info = self._json("GET", f"/containers/{quote(cid, safe='')}/json", timeout=timeout)
+                except DockerAPIError as e:
+                    if e.status != 404:
+                        raise
+                    missing.append(f"Error: No such object: {cid}\n")
+                    continue
+                lines.append(f"{info['Id']} {str(bool(info['State']['Running'])).lower()}\n")
+            return subprocess.CompletedProcess(argv, 1 if missing else 0, "".join(lines), "".join(missing))
+        if cmd[:4] == ["image", "inspect", "-f", "{{.Id}}"] and len(cmd) == 5:
+            try:
+                info = self._json("GET", f"/images/{quote(cmd[4], safe='')}/json", timeout=timeout)
+            except DockerAPIError as e:
+                if e.status != 404:
+                    raise
+                return subprocess.CompletedProcess(argv, 1, "", f"Error: No such image: {cmd[4]}\n")
+            return subprocess.CompletedProcess(argv, 0, info["Id"] + "\n", "")
+        if cmd == ["info", "-f", "{{.NCPU}}"]:
+            return subprocess.CompletedProcess(argv, 0, f"{self._json('GET', '/info', timeout=timeout)['NCPU']}\n", "")
+        if cmd[:1] == ["pull"] and len(cmd) == 2:
+            self.pull(cmd[1], timeout)
+            return subprocess.CompletedProcess(argv, 0, "", "")
+        spec = self.spec(argv)
+        if spec is None:
+            return None
+        if spec["kind"] == "run" and spec["detach"]:
+            cid = self.create(spec)
+            self.request("POST", f"/containers/{cid}/start", timeout=timeout)
+            return subprocess.CompletedProcess(argv, 0, cid + "\n", "")
+        attached = self.attach(spec, timeout)
+        out, err = [], []
+        try:
+            for stream, payload in attached.frames():
+                (err if stream == 2 else out).append(payload)
+            returncode = attached.wait()
+        finally:
+            attached.close()
+        return subprocess.CompletedProcess(argv, returncode, b"".join(out).decode("utf-8", errors="replace"),
+                                           b"".join(err).decode("utf-8", errors="replace"))
+
+
+def _docker_cli(argv: list, host: "DockerHost", timeout: float = 60) -> subprocess.CompletedProcess:
+    """在 host 上跑一条短 docker 命令, 返回值同 subprocess.run(capture_output=True, text=True);
+    Engine API 能处理的 (rm / inspect / pull / run -d / exec) 不 fork CLI."""
+    if host.engine.enabled:
+        try:
+            proc = host.engine.run_cli(argv, timeout)
+        except DockerAPIUnavailable as e:
+            message = host.unreachable(e)
+            if message is not None:
+                return subprocess.CompletedProcess(argv, 1, "", message)
+            proc = None
+        except DockerAPIError as e:
+            return subprocess.CompletedProcess(argv, 1, "", f"Error response from daemon: {e}\n")
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(argv, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            return subprocess.CompletedProcess(argv, 1, "", f"docker engine API: {e}\n")
+        if proc is not None:
+            return proc
+    return subprocess.run(argv, capture_output=True, text=True, timeout=timeout, env=host.env)
+
+
+def _daemon_unreachable(text: str) -> bool:
+    """docker CLI (或者 _docker_cli / _api_source 仿照它) 报的 daemon 连不上: 命令根本没跑起来, 可以换一台重试."""
+    text = text.lstrip()
+    if text.startswith("docker: "):
+        text = text[len("docker: "):]
+    return text.startswith(("Cannot connect to the Docker daemon", "error during connect"))
+
+
+def _remove_containers(cids: list, host: "DockerHost") -> None:
+    if not cids:
+        return
+    try:
+        _docker_cli(["docker", "rm", "-f"] + cids, timeout=60, host=host)
+    except Exception as e:
+        _log(f"worker cleanup failed: {e}")
+
+
+class _Worker:
+    __slots__ = ("cid", "host", "born", "jobs", "broken")
+
+    def __init__(self, cid: str, host: "DockerHost"):
+        self.cid = cid
+        self.host = host
+        self.born = time.monotonic()
+        self.jobs = 0
+        # 被 pin 住共享使用时 (ffmpeg_batch 的 single_container), exec 出错只打标记, 由持有者归还时回收
+        self.broken = False
+
+    def expired(self) -> bool:
+        return self.jobs >= POOL_MAX_JOBS or time.monotonic() - self.born >= POOL_MAX_AGE
+
+
+class WorkerPool:
+    """一个 (daemon, 镜像, docker run 参数) 对应一个池, 池里是 sleep 保活的常驻容器.
+
+    - acquire() 默认非阻塞: 有空闲 worker 就给, 没有返回 None 让调用方走冷启动, 同时后台补齐到 size;
+      acquire(wait=N) 最多等 N 秒新 worker 起来
+    - 每个 worker 跑满 POOL_MAX_JOBS 次或活过 POOL_MAX_AGE 后回收重建
+    - 后台定期 docker inspect 空闲 worker, 挂掉的直接剔除
+    - 连续起不来 (比如镜像里没有 sleep) 就冷却一段时间, 期间全部走冷启动
+    """
+
+    SPAWN_FAILURE_LIMIT = 3
+    SPAWN_COOLDOWN = 300.0
+
+    def __init__(self, image: str, run_opts: list, host: "DockerHost", size: int = POOL_SIZE):
+        self.image = image
+        self.host = host
+        self.run_opts = list(run_opts)
+        self.size = size
+        self._idle: list = []
+        self._busy: set = set()
+        self._starting = 0
+        self._failures = 0
+        self._disabled_until = 0.0
+        self._last_health = time.monotonic()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def acquire(self, wait: float = 0.0) -> "_Worker | None":
+        if self.size <= 0 or self._closed:
+            return None
+        now = time.monotonic()
+        if now - self._last_health >= POOL_HEALTH_INTERVAL:
+            self._last_health = now
+            threading.Thread(target=self.health_check, daemon=True).start()
+        if wait > 0:
+            self.fill()
+        with self._ready:
+            if wait > 0 and not self._idle:
+                self._ready.wait_for(lambda: self._idle or self._closed or not self._starting, timeout=wait)
+            worker = self._idle.pop() if self._idle else None
+            if worker is not None:
+                self._busy.add(worker)
+        self.fill()
+        return worker
+
+    def release(self, worker: _Worker, healthy: bool = True) -> None:
+        worker.jobs += 1
+        with self._lock:
+            self._busy.discard(worker)
+            keep = healthy and not self._closed and not worker.expired()
+            if keep:
+                self._idle.append(worker)
+        if not keep:
+            threading.Thread(target=_remove_containers, args=([worker.cid], self.host), daemon=True).start()
+            self.fill()
+
+    def fill(self) -> int:
+        """后台补齐到 size 个 worker, 返回本次新起的数量."""
+        with self._lock:
+            if self._closed or time.monotonic() < self._disabled_until:
+                return 0
+            need = self.size - len(self._idle) - len(self._busy) - self._starting
+            if need <= 0:
+                return 0
+            self._starting += need
+        for _ in range(need):
+            threading.Thread(target=self._spawn, daemon=True).start()
+        return need
+
+    def _spawn(self) -> None:
+        # sleep 时长略大于最大寿命: 即使 server 崩溃没来得及清理, 孤儿容器也会自己退出 (--rm)
+        keepalive = str(int(POOL_MAX_AGE) + 60)
+        name = f"ffmpeg-mcp-worker-{uuid.uuid4().hex[:12]}"
+        cmd = (["docker", "run", "-d", "--rm", "--name", name, "--label", f"{POOL_LABEL}=1"]
+               + self.run_opts + ["--entrypoint", "sleep", self.image, keepalive])
+        cid = ""
+        try:
+            proc = _docker_cli(cmd, timeout=300, host=self.host)
+            if proc.returncode == 0:
+                cid = proc.stdout.strip()
+                if cid not in self._running([cid]):
+                    cid = ""
+            else:
+                _log(f"worker spawn failed ({self.image}): {proc.stderr.strip()}")
+        except Exception as e:
+            _log(f"worker spawn failed ({self.image}): {e}")
+
+        with self._lock:
+            self._starting -= 1
+            self._ready.notify_all()
+            if cid and not self._closed:
+                self._failures = 0
+                self._idle.append(_Worker(cid, self.host))
+                return
+            if not cid:
+                self._failures += 1
+                if self._failures >= self.SPAWN_FAILURE_LIMIT:
+                    self._failures = 0
+                    self._disabled_until = time.monotonic() + self.SPAWN_COOLDOWN
+                    _log(f"worker pool for {self.image} disabled for {int(self.SPAWN_COOLDOWN)}s")
+        if cid:
+            _remove_containers([cid], self.host)
+
+    def _running(self, cids: list) -> set:
+        try:
+            proc = _docker_cli(["docker", "inspect", "-f", "{{.Id}} {{.State.Running}}"] + cids, timeout=30,
+                               host=self.host)
+        except Exception:
+            return set()
+        alive = set()
+        for line in proc.stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == "true":
+                alive.update(c for c in cids if parts[0].startswith(c) or c.startswith(parts[0]))
+        return alive
+
+    def health_check(self) -> None:
+        with self._lock:
+            idle = [w for w in self._idle]
+        if not idle:
+            return
+        alive = self._running([w.cid for w in idle])
+        dead = []
+        with self._lock:
+            for w in idle:
+                if w.cid not in alive and w in self._idle:
+                    self._idle.remove(w)
+                    dead.append(w.cid)
+                elif w.expired() and w in self._idle:
+                    self._idle.remove(w)
+                    dead.append(w.cid)
+        if dead:
+            _remove_containers(dead, self.host)
+            self.fill()
+
+    def stats(self) -> dict:
+        """空闲 / 使用中 / 启动中的 worker 数, 冷却中时带剩余秒数."""
+        with self._lock:
+            report = {"size": self.size, "idle": len(self._idle), "busy": len(self._busy), "starting": self._starting}
+            cooldown = self._disabled_until - time.monotonic()
+        if cooldown > 0:
+            report["disabled_s"] = round(cooldown, 1)
+        return report
+
+    def shutdown(self) -> list:
+        with self._lock:
+            self._closed = True
+            cids = [w.cid for w in self._idle] + [w.cid for w in self._busy]
+            self._idle.clear()
+            self._busy.clear()
+        return cids
+
+
+# (daemon, 镜像, docker run 参数) -> WorkerPool
+_POOLS: dict = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool_for(image: str, run_opts: list, host: "DockerHost") -> WorkerPool:
+    key = (host.name, image, tuple(run_opts))
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = WorkerPool(image, run_opts, host)
+        return pool
+
+
+@atexit.register
+def _shutdown_pools() -> None:
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    by_host: dict = {}
+    for pool in pools:
+        by_host.setdefault(pool.host.name, (pool.host, []))[1].extend(pool.shutdown())
+    for host, cids in by_host.values():
+        _remove_containers(cids, host)
+
+
+class Preflight:
+    """启动预检: 检查镜像, 缺的就拉, 再预热 worker.
+
+    刚部署完第一次调用要在 subprocess 里顺带 pull / 解压镜像层, 超时经常把第一个真任务杀掉, 以前只能手动跑
+    pull-all.sh. 现在 initialize 时每个镜像一个后台线程并行检查, 不阻塞握手; 镜像就绪后按 warm_opts (每项是一组
+    docker run 参数, 即一种卷映射) 把 worker 池起满, 在每个 worker 里跑一次 -version 把可执行文件和动态库读进
+    页缓存, 第一个用户请求就是稳态延迟. 预检还没跑完时, 用到该镜像的调用先在 wait() 里等它. 每台 daemon 各有一个.
+    """
+
+    def __init__(self, images: list, host: "DockerHost", warm_opts: list = ()):
+        self.host = host
+        self.warm_opts = [list(opts) for opts in warm_opts]
+        self._lock = threading.Lock()
+        self._started: float | None = None
+        self._status = {image: {"state": "pending"} for image in images}
+        self._done = {image: threading.Event() for image in images}
+
+    def start(self) -> bool:
+        """只在第一次 initialize 时启动, 返回是否真的启动了."""
+        with self._lock:
+            if self._started is not None or not PREFLIGHT:
+                return False
+            self._started = time.time()
+        for image in self._status:
+            threading.Thread(target=self._check, args=(image,), daemon=True).start()
+        return True
+
+    def wait(self, image: str) -> None:
+        """预检正在处理这个镜像时等它结束 (最多 PREFLIGHT_WAIT 秒)."""
+        done = self._done.get(image)
+        if done is None or self._started is None or done.is_set():
+            return
+        done.wait(PREFLIGHT_WAIT)
+
+    def image_missing(self, image: str) -> bool:
+        """预检确认这台没有这个镜像, 或者还在拉."""
+        with self._lock:
+            return self._status.get(image, {}).get("state") in ("missing", "pulling")
+
+    def _set(self, image: str, **fields) -> None:
+        with self._lock:
+            self._status[image].update(fields)
+
+    def _check(self, image: str) -> None:
+        started = time.monotonic()
+        self._set(image, state="checking")
+        ready = False
+        try:
+            proc = _docker_cli(["docker", "image", "inspect", "-f", "{{.Id}}", image], timeout=60, host=self.host)
+            if proc.returncode == 0:
+                ready = True
+            elif "no such image" not in proc.stderr.lower():
+                # daemon 连不上之类, 拉也没用
+                self._set(image, state="error", error=proc.stderr.strip()[-500:])
+            elif not PREFLIGHT_PULL:
+                self._set(image, state="missing", error="image not present and FFMPEG_MCP_PREFLIGHT_PULL=0")
+            else:
+                self._set(image, state="pulling")
+                pull_started = time.monotonic()
+                proc = _docker_cli(["docker", "pull", image], timeout=PREFLIGHT_PULL_TIMEOUT, host=self.host)
+                self._set(image, pulled=True, pull_s=round(time.monotonic() - pull_started, 2))
+                ready = proc.returncode == 0
+                if not ready:
+                    self._set(image, state="missing", error=proc.stderr.strip()[-500:])
+        except Exception as e:
+            self._set(image, state="error", error=str(e))
+        self._set(image, check_s=round(time.monotonic() - started, 2))
+        if ready:
+            self._set(image, state="ready")
+        self._done[image].set()
+        if ready:
+            self._warm(image)
+
+    def _warm(self, image: str) -> None:
+        binary = IMAGE_BINARIES.get(image)
+        if not binary or POOL_SIZE <= 0 or not self.warm_opts:
+            return
+        started = time.monotonic()
+        warmed = 0
+        for run_opts in self.warm_opts:
+            pool = _pool_for(image, run_opts, self.host)
+            workers = [w for w in (pool.acquire(wait=PREFLIGHT_WAIT) for _ in range(POOL_SIZE)) if w is not None]
+            for worker in workers:
+                try:
+                    proc = _docker_cli(["docker", "exec", worker.cid, binary, "-version"], timeout=120,
+                                       host=self.host)
+                    healthy = proc.returncode == 0
+                except Exception:
+                    healthy = False
+                warmed += healthy
+                # 预热不算任务次数
+                worker.jobs -= 1
+                pool.release(worker, healthy)
+        self._set(image, warm_workers=warmed, warm_s=round(time.monotonic() - started, 2))
+
+    def status(self) -> dict:
+        """各镜像状态 + 这台 daemon 上的 worker 池情况, 给 server status 工具用."""
+        with self._lock:
+            images = {image: dict(info) for image, info in self._status.items()}
+            started = self._started
+        with _POOLS_LOCK:
+            pools = [(key[1:], pool) for key, pool in _POOLS.items() if key[0] == self.host.name]
+        report = {
+            "preflight": "disabled" if not PREFLIGHT else ("not started" if started is None else "started"),
+            "ready": all(info["state"] == "ready" for info in images.values()),
+            "images": images,
+            "pools": [dict(pool.stats(), image=image, mounts=[o for o in opts if o != "-v"])
+                      for (image, opts), pool in pools],
+        }
+        if started is not None:
+            report["started_at"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started))
+        return report
+
+
+class DockerHost:
+    """一台 docker daemon: 自己的 Engine API 客户端、CLI 用的环境 (DOCKER_HOST)、镜像预检, 以及调度用的计数.
+
+    warm_opts 是预检时要起满 worker 的那几种 docker run 参数 (卷映射), 见 Preflight.
+    """
+
+    def __init__(self, url: str, weight: float = 1.0, address: str | None = None, env: dict | None = None,
+                 warm_opts: list = ()):
+        self.name = url
+        self.weight = weight
+        self.engine = DockerEngine(_engine_address(url) if address is None else address, DOCKER_API)
+        self.env = env
+        self.preflight = Preflight([FFMPEG_IMAGE, IMAGEMAGICK_IMAGE, BUSYBOX_IMAGE], self, warm_opts)
+        # 只有一台时 API 连不上退回 CLI (和以前一样); 多台时算这台挂了, 换一台
+        self.failover = False
+        self.active = 0
+        self.dispatched = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error = ""
+
+    def unreachable(self, error) -> str | None:
+        """Engine API 连不上: 单台时关掉 API 返回 None (调用方走 CLI); 多台时记下故障, 返回和 CLI 一样的报错."""
+        if not self.failover:
+            self.engine.disable(error)
+            return None
+        self.mark_down(str(error))
+        return f"Cannot connect to the Docker daemon at {self.name}: {error}\n"
+
+    def mark_down(self, error: str) -> None:
+        if self.down_until <= time.monotonic():
+            _log(f"docker host {self.name} unreachable, retrying in {int(HOST_RETRY)}s: {error.strip()[:200]}")
+        self.failures += 1
+        self.last_error = error.strip()[-300:]
+        self.down_until = time.monotonic() + HOST_RETRY
+
+    def mark_up(self) -> None:
+        if self.down_until:
+            self.down_until = 0.0
+            _log(f"docker host {self.name} is back")
+
+    def stats(self) -> dict:
+        report = {"host": self.name, "weight": self.weight, "active": self.active, "dispatched": self.dispatched,
+                  "failures": self.failures, "api": self.engine.enabled}
+        down = self.down_until - time.monotonic()
+        if down > 0:
+            report.update(down_s=round(down, 1), last_error=self.last_error)
+        return report
+
+
+class _TailBuffer:
+    """只保留最后 limit 字节的缓冲, dropped 记录被丢掉的字节数."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.dropped = 0
+        self._chunks: deque = deque()
+        self._size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        # 整块丢掉最老的, 丢完还够 limit 才丢; 剩下的零头从第一块里切
+        while len(self._chunks) > 1 and self._size - len(self._chunks[0]) >= self.limit:
+            old = self._chunks.popleft()
+            self._size -= len(old)
+            self.dropped += len(old)
+        if self._size > self.limit:
+            cut = self._size - self.limit
+            self._chunks[0] = self._chunks[0][cut:]
+            self._size -= cut
+            self.dropped += cut
+
+    def getvalue(self) -> str:
+        return b"".join(self._chunks).decode("utf-8", errors="replace")
+
+
+class _HeadTailBuffer:
+    """保留前 head 字节和最后 tail 字节, 中间丢掉的记在 dropped.
+
+    spill 不为空时, 第一次要丢数据的那一刻把已有内容写进这个文件, 之后的输出继续追加, 文件里是完整日志;
+    没被截断的调用不落盘.
+    """
+
+    def __init__(self, head: int, tail: int, spill: str | None = None):
+        self.head_limit = head
+        self.spill = spill
+        self.log_path = None
+        self._head = bytearray()
+        self._tail = _TailBuffer(tail)
+        self._log = None
+
+    @property
+    def dropped(self) -> int:
+        return self._tail.dropped
+
+    def write(self, chunk: bytes) -> None:
+        if self._log is not None:
+            self._log.write(chunk)
+        elif self.spill and len(self._head) + self._tail._size + len(chunk) > self.head_limit + self._tail.limit:
+            self._open_log(chunk)
+        room = self.head_limit - len(self._head)
+        if room > 0:
+            self._head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self._tail.write(chunk)
+
+    def _open_log(self, chunk: bytes) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.spill), exist_ok=True)
+            log = open(self.spill, "wb")
+            log.write(bytes(self._head))
+            log.write(b"".join(self._tail._chunks))
+            log.write(chunk)
+        except OSError as e:
+            _log(f"full log unavailable: {e}")
+            self.spill = None
+            return
+        self._log = log
+        self.log_path = self.spill
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+
+    def getvalue(self) -> str:
+        tail = b"".join(self._tail._chunks)
+        if not self.dropped:
+            return (bytes(self._head) + tail).decode("utf-8", errors="replace")
+        head = bytes(self._head).decode("utf-8", errors="replace")
+        return f"{head}\n... [{self.dropped} bytes dropped] ...\n{tail.decode('utf-8', errors='replace')}"
+
+
+_LOG_PRUNED = [0.0]
+
+
+def _log_stem() -> str | None:
+    """本次调用完整日志的路径前缀 (不设 LOG_DIR 时 None); 顺带每小时清一次过期日志."""
+    if not LOG_DIR:
+        return None
+    now = time.time()
+    if now - _LOG_PRUNED[0] >= 3600:
+        _LOG_PRUNED[0] = now
+        with contextlib.suppress(OSError):
+            for name in os.listdir(LOG_DIR):
+                path = f"{LOG_DIR}/{name}"
+                if name.endswith(".log") and os.stat(path).st_mtime < now - LOG_RETENTION:
+                    os.remove(path)
+    return f"{LOG_DIR}/{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class CancelToken:
+    """取消句柄: cancel() 依次调用注册过的回调 (杀 docker CLI 进程组, 删掉容器), 之后注册的立即执行."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks: list = []
+        self._lock = threading.Lock()
+
+    def register(self, callback) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in reversed(callbacks):
+            try:
+                callback()
+            except Exception as e:
+                _log(f"cancel callback failed: {e}")
+
+
+class _OutputCapture:
+    """一次调用的 stdout / stderr: 进首尾缓冲或交给回调, 记第一次/最后一次有输出的时间和字节数."""
+
+    def __init__(self, on_stdout_line=None, on_stderr=None):
+        stem = _log_stem()
+        self.stderr_buf = _HeadTailBuffer(STDERR_HEAD_KB * 1024, STDERR_TAIL_KB * 1024, stem and stem + ".stderr.log")
+        self.stdout_buf = _HeadTailBuffer(STDOUT_HEAD_KB * 1024, STDOUT_TAIL_KB * 1024, stem and stem + ".stdout.log")
+        self.on_stdout_line = on_stdout_line
+        self.on_stderr = on_stderr
+        self._partial = b""
+        # 第一次/最后一次有输出的时间: 之前算启动 (建容器 + 进程初始化), 之后算收尾 (容器停止/删除, CLI 退出)
+        self.marks = {"first": None, "last": None, "stdout": 0, "stderr": 0}
+
+    def _mark(self, stream: str, size: int) -> None:
+        now = time.monotonic()
+        if self.marks["first"] is None:
+            self.marks["first"] = now
+        self.marks["last"] = now
+        self.marks[stream] += size
+
+    def stdout(self, chunk: bytes) -> None:
+        self._mark("stdout", len(chunk))
+        if self.on_stdout_line is None:
+            self.stdout_buf.write(chunk)
+            return
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.on_stdout_line(line.decode("utf-8", errors="replace") + "\n")
+
+    def stderr(self, chunk: bytes) -> None:
+        self._mark("stderr", len(chunk))
+        self.stderr_buf.write(chunk)
+        if self.on_stderr is not None:
+            self.on_stderr(chunk)
+
+    def close(self) -> None:
+        if self._partial and self.on_stdout_line is not None:
+            self.on_stdout_line(self._partial.decode("utf-8", errors="replace"))
+        self._partial = b""
+        self.stderr_buf.close()
+        self.stdout_buf.close()
+
+    def result(self, returncode: int, started: float, ended: float, timed_out: bool, cancelled: bool) -> dict:
+        marks = self.marks
+        return {
+            "returncode": returncode,
+            "stdout": self.stdout_buf.getvalue(),
+            "stderr": self.stderr_buf.getvalue(),
+            "stderr_dropped": self.stderr_buf.dropped,
+            "stdout_dropped": self.stdout_buf.dropped,
+            "stderr_log": self.stderr_buf.log_path,
+            "stdout_log": self.stdout_buf.log_path,
+            "timed_out": timed_out and not cancelled,
+            "cancelled": cancelled,
+            "metrics": {
+                "start_s": round((marks["first"] or ended) - started, 4),
+                "run_s": round((marks["last"] or ended) - (marks["first"] or ended), 4),
+                "teardown_s": round(ended - (marks["last"] or ended), 4),
+                "stdout_bytes": marks["stdout"],
+                "stderr_bytes": marks["stderr"],
+            },
+        }
+
+
+def _kill_group(proc: subprocess.Popen) -> None:
+    """整个进程组一起杀, 免得子进程拿着管道不放; 没有进程组 (Windows) 时只杀它自己."""
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+
+def _cli_source(cmd: list, capture: _OutputCapture, env: dict | None = None) -> tuple:
+    """fork docker CLI: (读输出的函数列表, kill, wait, close)."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=True, env=env)
+
+    def pump(stream, sink) -> None:
+        for chunk in iter(lambda: stream.read1(65536), b""):
+            sink(chunk)
+
+    def close() -> None:
+        proc.stdout.close()
+        proc.stderr.close()
+
+    pumps = [lambda: pump(proc.stdout, capture.stdout), lambda: pump(proc.stderr, capture.stderr)]
+    return pumps, lambda: _kill_group(proc), proc.wait, close
+
+
+def _api_source(cmd: list, capture: _OutputCapture, host: DockerHost) -> tuple | None:
+    """docker run / exec 直接走 Engine API, 一条流里按帧拆 stdout/stderr; 处理不了返回 None."""
+    spec = host.engine.spec(cmd) if host.engine.enabled else None
+    if spec is None:
+        return None
+    code = 1 if spec["kind"] == "exec" else 125
+    try:
+        attached = host.engine.attach(spec)
+    except DockerAPIUnavailable as e:
+        message = host.unreachable(e)
+        if message is None:
+            return None
+        capture.stderr(message.encode())
+        return [], lambda: None, lambda: code, lambda: None
+    except (DockerAPIError, OSError, http.client.HTTPException) as e:
+        # 和 CLI 一样把 daemon 的报错写进 stderr, _exec_failed 靠它判断 worker 已经没了
+        capture.stderr(f"Error response from daemon: {e}\n".encode())
+        return [], lambda: None, lambda: code, lambda: None
+
+    def pump() -> None:
+        for stream, payload in attached.frames():
+            (capture.stderr if stream == 2 else capture.stdout)(payload)
+
+    return [pump], attached.abort, attached.wait, attached.close
+
+
+def _run_process(cmd: list, timeout: int, on_stdout_line, on_stderr, cancel: CancelToken | None,
+                 host: DockerHost) -> dict:
+    """流式跑一条 docker run / exec: stdout 逐行交给 on_stdout_line, 不给就和 stderr 一样进首尾缓冲 (截断时可落完整日志).
+
+    Engine API 可用时不 fork CLI, 直接在 socket 上 create/attach/start/wait (见 DockerEngine).
+    """
+    capture = _OutputCapture(on_stdout_line, on_stderr)
+    started = time.monotonic()
+    pumps, kill_source, wait, close = _api_source(cmd, capture, host) or _cli_source(cmd, capture, host.env)
+    timed_out = threading.Event()
+    cancelled = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        kill_source()
+
+    def abort() -> None:
+        cancelled.set()
+        kill_source()
+
+    readers = [threading.Thread(target=pump, daemon=True) for pump in pumps[1:]]
+    for reader in readers:
+        reader.start()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    if cancel is not None:
+        cancel.register(abort)
+    try:
+        if pumps:
+            pumps[0]()
+        returncode = wait()
+        for reader in readers:
+            reader.join()
+        ended = time.monotonic()
+    finally:
+        timer.cancel()
+        if cancel is not None:
+            cancel.unregister(abort)
+        close()
+        capture.close()
+    return capture.result(returncode, started, ended, timed_out.is_set(), cancelled.is_set())
+
+
+def _exec_failed(proc: dict) -> bool:
+    # 126/127 = 容器里找不到/跑不了可执行文件; daemon 报错 = 容器已经没了; 连不上 daemon 时冷启动也会失败, 由调度换一台
+    return (proc["returncode"] in (126, 127) or proc["stderr"].startswith("Error response from daemon")
+            or _daemon_unreachable(proc["stderr"]))
+
+
+def _output_limits(result: dict, proc: dict) -> None:
+    """被截断的输出: 丢了多少字节, 完整日志在哪."""
+    for key in ("stderr_dropped", "stdout_dropped"):
+        if proc.get(key):
+            result[f"{key}_bytes"] = proc[key]
+    for key in ("stderr_log", "stdout_log"):
+        if proc.get(key):
+            result[key] = proc[key]
+
+
+def _run_result(proc: dict, docker_cmd: list, runner: str, timeout: int) -> dict:
+    if proc["cancelled"]:
+        result = {"success": False, "output": proc["stdout"], "error": "Cancelled\n" + proc["stderr"], "cancelled": True}
+    elif proc["timed_out"]:
+        result = {"success": False, "output": proc["stdout"], "error": f"Command timeout ({timeout}s)\n" + proc["stderr"],
+                  "timeout": True}
+    else:
+        result = {"success": proc["returncode"] == 0, "output": proc["stdout"], "error": proc["stderr"]}
+    result.update({"command": " ".join(docker_cmd), "runner": runner, "metrics": dict(proc["metrics"])})
+    _output_limits(result, proc)
+    return result
+
+
+def _docker_run_leased(host: DockerHost, image: str, cmd_args: list, run_opts: list, entrypoint: str | None,
+                       timeout: int, on_stdout_line, on_stderr, worker: _Worker | None,
+                       cancel: CancelToken | None) -> dict:
+    """在 host 上跑一次容器, run_opts 是卷映射之类的 docker run 参数 (常驻 worker 按它分池).
+
+    优先 docker exec 进常驻 worker, 池空 / worker 异常时回退 docker run --rm. worker 不为空时在这个 (调用方
+    pin 住的) worker 里 exec, 用完不归还. 超时或 cancel 时只杀 docker CLI 不够, 容器里的进程还会继续跑:
+    warm 路径把整个 worker 删掉, 冷启动路径给容器起名, 按名字 docker rm -f.
+
+    ffmpeg 从 CPU_BUDGET 领这台 daemon 的一份核数: 注入 -threads / -filter_threads, 冷启动容器再加
+    --cpus / --cpuset-cpus (常驻 worker 已经在跑, 只能靠线程数).
+
+    返回 success / output (stdout) / error (stderr) / command / runner / metrics; 超时另带 timeout=True,
+    取消另带 cancelled=True.
+    """
+    lease = CPU_BUDGET.acquire(host) if image == FFMPEG_IMAGE and entrypoint is None else None
+    if lease is None:
+        return _docker_exec_or_run(host, image, cmd_args, run_opts, entrypoint, timeout, on_stdout_line, on_stderr,
+                                   worker, cancel)
+    try:
+        result = _docker_exec_or_run(host, image, _thread_args(cmd_args, lease["threads"]), run_opts, entrypoint,
+                                     timeout, on_stdout_line, on_stderr, worker, cancel, lease["opts"])
+    finally:
+        CPU_BUDGET.release(lease)
+    if "metrics" in result:
+        result["metrics"]["threads"] = lease["threads"]
+    return result
+
+
+def _docker_exec_or_run(host: DockerHost, image: str, cmd_args: list, run_opts: list, entrypoint: str | None,
+                        timeout: int, on_stdout_line, on_stderr, worker: _Worker | None, cancel: CancelToken | None,
+                        cpu_opts: list = ()) -> dict:
+    """_docker_run_leased 的执行部分, cpu_opts 只加在冷启动的 docker run 上."""
+    host.preflight.wait(image)
+
+    pool = _pool_for(image, run_opts, host)
+    pinned = worker is not None
+    acquire_started = time.monotonic()
+    if not pinned:
+        worker = pool.acquire()
+    acquire = round(time.monotonic() - acquire_started, 4)
+
+    def finish(healthy: bool) -> None:
+        if pinned:
+            worker.broken = worker.broken or not healthy
+        else:
+            pool.release(worker, healthy)
+
+    if worker is not None and not worker.broken:
+        binary = entrypoint or IMAGE_BINARIES.get(image)
+        docker_cmd = ["docker", "exec", worker.cid] + ([binary] if binary else []) + cmd_args
+        kill_worker = lambda: _remove_containers([worker.cid], host)  # noqa: E731
+        if cancel is not None:
+            cancel.register(kill_worker)
+        try:
+            proc = _run_process(docker_cmd, timeout, on_stdout_line, on_stderr, cancel, host)
+        except Exception as e:
+            finish(False)
+            _log(f"warm exec failed, falling back to cold run: {e}")
+        else:
+            if proc["timed_out"] or proc["cancelled"]:
+                # docker CLI 被杀了但容器里的进程还在跑, 整个 worker 回收掉
+                finish(False)
+                return _with_acquire(_run_result(proc, docker_cmd, "warm", timeout), acquire)
+            if not _exec_failed(proc):
+                finish(True)
+                return _with_acquire(_run_result(proc, docker_cmd, "warm", timeout), acquire)
+            finish(False)
+            _log(f"warm worker {worker.cid[:12]} unhealthy, falling back to cold run: {proc['stderr'].strip()}")
+        finally:
+            if cancel is not None:
+                cancel.unregister(kill_worker)
+        if cancel is not None and cancel.cancelled:
+            return {"success": False, "output": "", "error": "Cancelled", "cancelled": True,
+                    "command": " ".join(docker_cmd), "runner": "warm"}
+
+    name = f"ffmpeg-mcp-run-{uuid.uuid4().hex[:12]}"
+    base = ["docker", "run", "--rm", "--name", name] + list(run_opts) + list(cpu_opts)
+    if entrypoint is not None:
+        base.extend(["--entrypoint", entrypoint])
+    docker_cmd = base + [image] + cmd_args
+    kill_container = lambda: _remove_containers([name], host)  # noqa: E731
+    if cancel is not None:
+        cancel.register(kill_container)
+
+    try:
+        proc = _run_process(docker_cmd, timeout, on_stdout_line, on_stderr, cancel, host)
+    except Exception as e:
+        return {"success": False, "output": "", "error": str(e), "command": " ".join(docker_cmd), "runner": "cold"}
+    finally:
+        if cancel is not None:
+            cancel.unregister(kill_container)
+    if proc["timed_out"]:
+        _remove_containers([name], host)
+    return _with_acquire(_run_result(proc, docker_cmd, "cold", timeout), acquire)
+
+
+def _with_acquire(result: dict, acquire: float) -> dict:
+    result["metrics"] = dict(acquire_s=acquire, **result["metrics"])
+    return result
+
+
+_DURATION_RE = re.compile(rb"Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)")
+
+
+class FFmpegProgress:
+    """解析 ffmpeg -progress 输出, 每个 progress= 块结束时回调 notify(progress, total, message).
+
+    progress/total 单位是秒 (out_time); total 取 stderr 里第一个 Duration, 拿不到就不带.
+    """
+
+    def __init__(self, notify=None):
+        self.notify = notify
+        self.total: float | None = None
+        self.last: dict = {}
+        self._block: dict = {}
+        self._head = b""
+        self._sent = -1.0
+
+    def feed_stderr(self, chunk: bytes) -> None:
+        if self.total is not None or len(self._head) > 65536:
+            return
+        self._head += chunk
+        match = _DURATION_RE.search(self._head)
+        if match:
+            h, m, sec = match.groups()
+            self.total = int(h) * 3600 + int(m) * 60 + float(sec)
+
+    def feed_line(self, line: str) -> None:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return
+        if key != "progress":
+            self._block[key] = value
+            return
+        self.last, self._block = self._block, {}
+        self._report(end=value == "end")
+
+    def position(self) -> float | None:
+        # out_time_ms 其实也是微秒 (ffmpeg 历史遗留), 优先用 out_time_us
+        raw = self.last.get("out_time_us") or self.last.get("out_time_ms")
+        try:
+            return max(int(raw), 0) / 1_000_000
+        except (TypeError, ValueError):
+            return None
+
+    def _report(self, end: bool) -> None:
+        pos = self.position()
+        if self.notify is None or pos is None:
+            return
+        if end and self.total is not None:
+            pos = max(pos, self.total)
+        if pos <= self._sent:
+            return
+        self._sent = pos
+        total = self.total if self.total is not None and pos <= self.total else None
+        message = f"time={pos:.2f}s fps={self.last.get('fps', '?')} speed={self.last.get('speed', '?').strip()}"
+        self.notify(round(pos, 3), total, message)
+
+    def stats(self) -> dict:
+        keys = ("frame", "fps", "bitrate", "total_size", "out_time", "speed")
+        return {k: self.last[k].strip() for k in keys if k in self.last}
+
+
+_BENCH_TIME_RE = re.compile(r"bench: utime=([\d.]+)s stime=([\d.]+)s rtime=([\d.]+)s")
+
+
+_BENCH_RSS_RE = re.compile(r"bench: maxrss=(\d+)\s*(?:KiB|kB)")
+
+
+def _bench_metrics(stderr: str) -> dict:
+    """ffmpeg -benchmark 在结束时打印容器内进程的 CPU 时间和峰值内存, 比 docker CLI 自己的 rusage 有意义."""
+    metrics = {}
+    match = _BENCH_TIME_RE.search(stderr)
+    if match:
+        metrics["cpu_user_s"] = float(match.group(1))
+        metrics["cpu_sys_s"] = float(match.group(2))
+    match = _BENCH_RSS_RE.search(stderr)
+    if match:
+        metrics["max_rss_kb"] = int(match.group(1))
+    return metrics
+
+
+def _progress_supported(args: list) -> bool:
+    # 用户自己指定了 -progress, 或者 stdout 被当作输出 (- / pipe:1) 时不注入
+    return "-progress" not in args and not any(a in ("-", "pipe:", "pipe:1") for a in args)
+
+
+# ffmpeg 里不带值的开关; 其余 "-xxx" 一律当作后面跟一个值
+_FFMPEG_FLAGS = {
+    "-y", "-n", "-nostdin", "-stdin", "-hide_banner", "-nostats", "-stats", "-an", "-vn", "-sn", "-dn",
+    "-shortest", "-re", "-copyts", "-start_at_zero", "-benchmark", "-benchmark_all", "-ignore_unknown",
+    "-copy_unknown", "-noautorotate", "-autorotate", "-accurate_seek", "-noaccurate_seek", "-xerror",
+    "-debug_ts", "-dump", "-hex", "-report", "-autoscale", "-noautoscale", "-vstats", "-psnr", "-qphist",
+    "-copyinkf", "-fix_sub_duration", "-fix_sub_duration_heartbeat", "-find_stream_info", "-print_graphs",
+}
+
+
+# 长得像选项名的值 (-c:v / -map ...); -5、-1.5dB 这类负数不算
+_OPTION_NAME_RE = re.compile(r"-[A-Za-z]")
+
+
+def _ffmpeg_io_indexes(args: list, values: list | None = None) -> tuple:
+    """ffmpeg argv 里输入 (-i 的值) 和输出文件的下标; 传了 values 时顺带收集其它选项的值的下标."""
+    inputs, outputs = [], []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-i" and i + 1 < len(args):
+            inputs.append(i + 1)
+            i += 2
+        elif arg.startswith("-") and arg != "-":
+            if arg in _FFMPEG_FLAGS:
+                i += 1
+                continue
+            if values is not None and i + 1 < len(args):
+                values.append(i + 1)
+            i += 2
+        else:
+            outputs.append(i)
+            i += 1
+    return inputs, outputs
+
+
+def _cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def _cgroup_cpu_limit() -> float | None:
+    """cgroup v2 cpu.max / v1 cfs_quota_us 给出的核数上限, 没限制时 None."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+_HOST_CPUS: dict = {}
+
+
+def _host_cpus(host: DockerHost) -> int:
+    """这台 daemon 上 worker 容器能用的总核数 (每台只算一次)."""
+    if host.name in _HOST_CPUS:
+        return _HOST_CPUS[host.name]
+    count = 0
+    if CPUS_OVERRIDE:
+        count = max(1, int(float(CPUS_OVERRIDE)))
+    else:
+        with contextlib.suppress(Exception):
+            proc = _docker_cli(["docker", "info", "-f", "{{.NCPU}}"], timeout=30, host=host)
+            if proc.returncode == 0 and proc.stdout.strip().isdigit():
+                count = int(proc.stdout.strip())
+    if not count:
+        limit = _cgroup_cpu_limit()
+        count = min(_cpu_count(), max(1, int(limit))) if limit else _cpu_count()
+    _HOST_CPUS[host.name] = count
+    return count
+
+
+class CpuBudget:
+    """把每台 daemon 的核数分给它上面同时在跑的 ffmpeg.
+
+    每个任务开始时按在跑的任务数 (含自己) 平分: share = total // n, 至少 1 核; cpuset 挑当前占用最少的 share 个核,
+    任务之间尽量不抢同一批核. 已经在跑的任务不会被收回核数, 任务数上涨那一阵会略超卖, 之后的新任务按新份额拿.
+    """
+
+    def __init__(self):
+        self._usage: dict = {}
+        self._active: dict = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host: DockerHost) -> dict | None:
+        if not CPU_TUNE:
+            return None
+        total = _host_cpus(host)
+        with self._lock:
+            usage = self._usage.get(host.name)
+            if usage is None or len(usage) != total:
+                usage = self._usage[host.name] = [0] * total
+            active = self._active[host.name] = self._active.get(host.name, 0) + 1
+            share = max(1, total // active)
+            cpus = sorted(sorted(range(total), key=lambda c: (usage[c], c))[:share])
+            for c in cpus:
+                usage[c] += 1
+        opts = ["--cpus", str(share)] + (["--cpuset-cpus", ",".join(map(str, cpus))] if CPU_PIN else [])
+        return {"threads": share, "cpus": cpus, "opts": opts, "host": host.name}
+
+    def release(self, lease: dict) -> None:
+        with self._lock:
+            self._active[lease["host"]] -= 1
+            usage = self._usage[lease["host"]]
+            for c in lease["cpus"]:
+                if c < len(usage):
+                    usage[c] -= 1
+
+
+CPU_BUDGET = CpuBudget()
+
+
+def _thread_args(args: list, threads: int) -> list:
+    """按分到的核数给 ffmpeg argv 补线程参数: 全局 -filter_threads / -filter_complex_threads,
+    每个 -i 前 (解码) 和每个输出前 (编码) 各一个 -threads; 用户自己写了的那一项不动."""
+    value = str(threads)
+    prefix = [opt for name in ("-filter_threads", "-filter_complex_threads") if name not in args
+              for opt in (name, value)]
+    if "-threads" in args:
+        return prefix + args
+    values = []
+    inputs, outputs = _ffmpeg_io_indexes(args, values)
+    # 表里没有的无值开关会把下一个选项名当成自己的值吞掉, 这时输入/输出的位置都不可信, 只补开头的全局参数
+    if any(_OPTION_NAME_RE.match(args[i]) for i in values):
+        return prefix + args
+    marks = {i - 1 for i in inputs} | set(outputs)
+    out = list(prefix)
+    for i, arg in enumerate(args):
+        if i in marks:
+            out += ["-threads", value]
+        out.append(arg)
+    return out
+
+
+# -preset 档位: latency = 尽快出结果, balanced = 编码器默认, quality = 同码率画质更好 (更慢).
+# 只管纯 CPU 编码器, 硬件编码器 (nvenc / qsv / vaapi) 的 preset 含义不同, 不动
+PRESET_TIERS = {
+    "libx264": {"latency": "veryfast", "balanced": "medium", "quality": "slow"},
+    "libx265": {"latency": "veryfast", "balanced": "medium", "quality": "slow"},
+    "libsvtav1": {"latency": "10", "balanced": "8", "quality": "5"},
+}
+
+
+_VIDEO_CODEC_OPTS = ("-c:v", "-codec:v", "-vcodec")
+
+
+def _preset_args(args: list, tier: str | None) -> list:
+    """按档位在每个 -c:v <CPU 编码器> 后面补 -preset; 已经写了 -preset 的不动. 未知档位抛 ValueError."""
+    tier = (DEFAULT_TIER if tier is None else tier or "").lower()
+    if not tier:
+        return args
+    if tier not in ("latency", "balanced", "quality"):
+        raise ValueError(f"unknown tier {tier!r}, expected latency / balanced / quality")
+    if any(a == "-preset" or a.startswith("-preset:") for a in args):
+        return args
+    out = []
+    for i, arg in enumerate(args):
+        out.append(arg)
+        prev = args[i - 1] if i else ""
+        if (prev in _VIDEO_CODEC_OPTS or prev.startswith("-c:v:")) and arg in PRESET_TIERS:
+            out += ["-preset", PRESET_TIERS[arg][tier]]
+    return out
+
+
+def _run_batch(jobs: list, max_parallel: int | None, run, notify=None, cancel: CancelToken | None = None,
+               worker: _Worker | None = None, scheduler: "JobScheduler | None" = None, tool: str = "") -> dict:
+    """并行跑一批 ffmpeg argv, 单个失败不影响其它任务, 按输入顺序返回每个任务的结果和耗时.
+
+    run(argv) -> run_ffmpeg 的结果; worker 是调用方为 single_container pin 住的常驻容器, 这里只用来报告.
+    给了 scheduler 时每个任务在 tool (直接调用 ffmpeg 的那个工具) 的并发槽里跑, 和直接调用共用一个上限,
+    并行度也不超过这个上限.
+    """
+    # 每个 ffmpeg 自己也会多线程, 默认并行度取核数一半
+    parallel = max(1, _cpu_count() // 2)
+    if max_parallel:
+        parallel = min(parallel, max(1, int(max_parallel)))
+    if scheduler is not None and scheduler.limits.get(tool, 0) > 0:
+        parallel = min(parallel, scheduler.limits[tool])
+    parallel = max(1, min(parallel, len(jobs)))
+
+    results: list = [None] * len(jobs)
+    pending = deque(range(len(jobs)))
+    lock = threading.Lock()
+    done = 0
+
+    def run_job(i: int) -> dict:
+        job = jobs[i]
+        argv = job.get("args") if isinstance(job, dict) else job
+        if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+            return {"index": i, "success": False, "error": "job must be an argv list of strings or {\"args\": [...]}"}
+        slot = scheduler.slot(tool) if scheduler is not None else contextlib.nullcontext()
+        with slot:
+            if cancel is not None and cancel.cancelled:
+                return {"index": i, "success": False, "error": "Cancelled", "cancelled": True}
+            started = time.monotonic()
+            r = run(argv)
+        entry = {
+            "index": i,
+            "success": r.get("success", False),
+            "elapsed": round(time.monotonic() - started, 3),
+            "runner": r.get("runner"),
+            "command": r.get("command"),
+        }
+        if isinstance(job, dict) and "name" in job:
+            entry["name"] = job["name"]
+        if not entry["success"]:
+            entry["error"] = r.get("error", "")
+        for key in ("stats", "cache", "cancelled", "staging", "host"):
+            if key in r:
+                entry[key] = r[key]
+        return entry
+
+    def drain() -> None:
+        nonlocal done
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i = pending.popleft()
+            results[i] = run_job(i)
+            with lock:
+                done += 1
+                finished = done
+            if notify is not None:
+                notify(finished, len(jobs), f"{finished}/{len(jobs)} jobs finished")
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=drain, daemon=True) for _ in range(parallel)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    succeeded = sum(1 for r in results if r and r["success"])
+    return {
+        "success": succeeded == len(jobs),
+        "total": len(jobs),
+        "succeeded": succeeded,
+        "failed": len(jobs) - succeeded,
+        "parallel": parallel,
+        "single_container": worker.cid if worker is not None else None,
+        "elapsed": round(time.monotonic() - started, 3),
+        "job_time_total": round(sum(r.get("elapsed", 0) for r in results if r), 3),
+        "results": results,
+    }
+
+
+# smart cut 重编码边界 GOP 用的编码器: 要和源视频流同编码, 才能和 stream copy 的中段 concat 到一起
+_SMART_CUT_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
+
+# 拼接后只剩第一段的 extradata, 而重编码的边界和 copy 的中段参数集 (SPS/PPS/VPS) 不同:
+# 每段都把参数集写进关键帧 (copy 段转 Annex B 时补上, 编码段 dump_extra), 解码器到段首自己换参数集
+_SMART_CUT_ANNEXB = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+
+_SMART_CUT_PROFILES = {
+    "baseline": "baseline", "constrained baseline": "baseline", "main": "main", "high": "high",
+    "high 10": "high10", "high 4:2:2": "high422", "high 4:4:4 predictive": "high444", "main 10": "main10",
+}
+
+
+_SMART_CUT_COLOR_OPTS = (("color_primaries", "-color_primaries"), ("color_transfer", "-color_trc"),
+                         ("color_space", "-colorspace"), ("color_range", "-color_range"))
+
+
+def _frame_duration(stream: dict) -> float:
+    """视频流一帧的时长 (秒), 拿不到帧率时按 25fps."""
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        num, _, den = str(stream.get(key) or "").partition("/")
+        with contextlib.suppress(ValueError, ZeroDivisionError):
+            fps = float(num) / float(den or 1)
+            if fps > 0:
+                return 1 / fps
+    return 1 / 25
+
+
+def _parse_ranges(ranges: list, duration: float) -> list:
+    """[[start, end], {"start", "end"}, ...] -> [(start, end), ...]; end 省略 = 到结尾. 不合法抛 ValueError."""
+    parsed = []
+    for r in ranges:
+        start, end = (r.get("start", 0), r.get("end")) if isinstance(r, dict) else (list(r) + [None])[:2]
+        start = max(0.0, float(start or 0))
+        end = duration if end is None else min(float(end), duration)
+        if end <= start:
+            raise ValueError(f"empty range: start {start} >= end {end} (duration {duration:.3f})")
+        parsed.append((start, end))
+    if not parsed:
+        raise ValueError("ranges must not be empty")
+    return parsed
+
+
+def _smart_cut_plan(keyframes: list, start: float, end: float, duration: float, tolerance: float) -> list:
+    """一个区间拆成 [(mode, start, end|None), ...], mode 为 copy / encode.
+
+    区间里第一个关键帧之前、最后一个关键帧之后的不完整 GOP 重编码, 中间整 GOP 的部分 stream copy;
+    切点离关键帧不到 tolerance (半帧) 时视为正好落在关键帧上. 切到文件结尾的区间尾部不用重编码 (end 记 None).
+    区间里没有完整 GOP 时整段重编码.
+    """
+    i = bisect.bisect_left(keyframes, start - tolerance)
+    first = keyframes[i] if i < len(keyframes) else None
+    if end >= duration - tolerance:
+        last, copy_end = duration, None
+    else:
+        j = bisect.bisect_right(keyframes, end + tolerance) - 1
+        last = keyframes[j] if j >= 0 else None
+        copy_end = last
+    if first is None or last is None or first >= last - tolerance:
+        return [("encode", start, end)]
+    pieces = []
+    if first - start > tolerance:
+        pieces.append(("encode", start, first))
+    pieces.append(("copy", first, copy_end))
+    if copy_end is not None and end - copy_end > tolerance:
+        pieces.append(("encode", copy_end, end))
+    return pieces
+
+
+def _smart_cut_encode_args(stream: dict, crf: int | None) -> list:
+    """边界 GOP 的编码参数: 编码器/像素格式/profile/色彩参数跟源视频流一致."""
+    encoder = _SMART_CUT_ENCODERS[stream.get("codec_name")]
+    args = ["-c:v", encoder, "-crf", str(18 if crf is None else int(crf)), "-fps_mode", "passthrough"]
+    if stream.get("pix_fmt"):
+        args += ["-pix_fmt", stream["pix_fmt"]]
+    profile = _SMART_CUT_PROFILES.get(str(stream.get("profile") or "").lower())
+    if profile:
+        args += ["-profile:v", profile]
+    for key, opt in _SMART_CUT_COLOR_OPTS:
+        if stream.get(key) and stream[key] != "unknown":
+            args += [opt, stream[key]]
+    if encoder == "libx265":
+        args += ["-x265-params", "log-level=error"]
+    return args
+
+
+def _smart_cut(input_path: str, output: str, ranges: list, crf: int | None, audio_args: list | None, work: str,
+               probe, run_batch, run_concat, cancel: CancelToken | None = None,
+               ffmpeg_tool: str = "the ffmpeg tool") -> dict:
+    """帧精确剪辑: 只重编码切点所在的不完整 GOP, 中间 stream copy, concat demuxer 拼回去.
+
+    多个区间按顺序拼成一个输出 (集锦). 视频片段和音频 (每个区间精确切, 整条编码一次) 用 run_batch 并行跑;
+    源视频需要是 h264 / hevc, 边界片段用同编码器、同像素格式和 profile 重编码.
+
+    路径怎么进容器由调用方决定: probe(path) -> 带 keyframes 的 probe 结果, run_batch(jobs) -> ffmpeg_batch 的结果,
+    run_concat(argv) -> 最后拼接那一步 run_ffmpeg 的结果. work 是放片段的临时目录 (容器里要能读写), 结束时删掉.
+    ffmpeg_tool 是报错里让用户改用的直接转码工具名.
+    """
+    started = time.monotonic()
+    info = probe(input_path)
+    if "error" in info:
+        return {"success": False, "error": f"probe failed: {info['error']}"}
+    video = next((st for st in info.get("streams", []) if st.get("codec_type") == "video"), None)
+    if video is None or not info.get("duration"):
+        return {"success": False, "error": "input has no video stream or no duration"}
+    if video.get("codec_name") not in _SMART_CUT_ENCODERS:
+        return {"success": False, "error": f"smart cut needs an h264 or hevc source, got {video.get('codec_name')!r}; "
+                                           f"re-encode with {ffmpeg_tool} instead"}
+    has_audio = any(st.get("codec_type") == "audio" for st in info.get("streams", []))
+    duration = info["duration"]
+    # ffprobe 给的是绝对 pts, -ss 相对文件起点
+    offset = float(info.get("format", {}).get("start_time") or 0)
+    keyframes = [k - offset for k in info.get("keyframes", [])]
+    try:
+        bounds = _parse_ranges(ranges, duration)
+    except (TypeError, ValueError) as e:
+        return {"success": False, "error": f"bad ranges: {e}"}
+    tolerance = _frame_duration(video) / 2
+    plans = [_smart_cut_plan(keyframes, start, end, duration, tolerance) for start, end in bounds]
+    encode_args = _smart_cut_encode_args(video, crf)
+
+    os.makedirs(work, exist_ok=True)
+    try:
+        jobs, pieces = [], []
+        for plan in plans:
+            for mode, start, end in plan:
+                piece = f"{work}/piece_{len(pieces):04d}.mkv"
+                pieces.append(piece)
+                if mode == "copy":
+                    # 稍微越过关键帧再 seek, 保证落在这个关键帧而不是前一个上
+                    argv = ["-y", "-ss", f"{start + 0.0005:.6f}", "-i", input_path]
+                    if end is not None:
+                        argv += ["-t", f"{end - start - 0.0005:.6f}"]
+                    argv += ["-map", "0:v:0", "-c:v", "copy", "-bsf:v", _SMART_CUT_ANNEXB[video["codec_name"]]]
+                else:
+                    argv = ["-y", "-ss", f"{start:.6f}", "-i", input_path, "-t", f"{end - start:.6f}",
+                            "-map", "0:v:0"] + encode_args + ["-bsf:v", "dump_extra"]
+                jobs.append({"name": f"{mode} {start:.3f}-{'end' if end is None else f'{end:.3f}'}",
+                             "args": argv + ["-an", "-sn", "-dn", piece]})
+        audio_path = f"{work}/audio.mka"
+        if has_audio:
+            argv = ["-y"]
+            for start, end in bounds:
+                argv += ["-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", input_path]
+            if len(bounds) > 1:
+                graph = "".join(f"[{i}:a:0]" for i in range(len(bounds))) + f"concat=n={len(bounds)}:v=0:a=1[a]"
+                argv += ["-filter_complex", graph, "-map", "[a]"]
+            else:
+                argv += ["-map", "0:a:0"]
+            audio = list(audio_args) if audio_args is not None else ["-c:a", "aac", "-b:a", "192k"]
+            jobs.append({"name": "audio", "args": argv + ["-vn"] + audio + [audio_path]})
+
+        batch = run_batch(jobs)
+        if cancel is not None and cancel.cancelled:
+            return {"success": False, "error": "Cancelled", "cancelled": True}
+        copied = sum((duration if e is None else e) - s for plan in plans for m, s, e in plan if m == "copy")
+        report = {
+            "ranges": [
+                {"start": round(start, 3), "end": round(end, 3),
+                 "pieces": [{"mode": m, "start": round(s, 3), "end": round(duration if e is None else e, 3)}
+                            for m, s, e in plan]}
+                for (start, end), plan in zip(bounds, plans)
+            ],
+            "copied_seconds": round(copied, 3),
+            "encoded_seconds": round(sum(e - s for s, e in bounds) - copied, 3),
+            "pieces_elapsed": batch["elapsed"],
+        }
+        failed = [r for r in batch["results"] if not r["success"]]
+        if failed:
+            return dict(report, success=False, error=f"{len(failed)} piece(s) failed", failed=failed)
+
+        list_path = f"{work}/pieces.txt"
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.writelines(f"file '{piece}'\n" for piece in pieces)
+        argv = ["-y", "-f", "concat", "-safe", "0", "-i", list_path]
+        if has_audio:
+            argv += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+        argv += ["-c", "copy"]
+        if output.lower().endswith((".mp4", ".mov", ".m4v")):
+            argv += ["-movflags", "+faststart"] + (["-tag:v", "hvc1"] if video["codec_name"] == "hevc" else [])
+        concat = run_concat(argv + [output])
+        report.update({
+            "success": concat.get("success", False),
+            "output": output,
+            "elapsed": round(time.monotonic() - started, 3),
+            "command": concat.get("command"),
+        })
+        if not report["success"]:
+            report["error"] = concat.get("error", "")
+        return report
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+_SHOWINFO_PTS_RE = re.compile(r"Parsed_showinfo.*?\bpts_time:\s*([\d.]+)")
+
+
+class ShowinfoTimes:
+    """逐块喂 ffmpeg 的 stderr (on_stderr 回调), 收集 showinfo 打出的 pts_time.
+
+    结果里的 stderr 只留首尾, 扫一条长视频时中间帧的 showinfo 行会被截掉, 所以要在截断之前逐行拿.
+    """
+
+    def __init__(self):
+        self._times: list = []
+        self._partial = b""
+
+    def feed(self, chunk: bytes) -> None:
+        lines = re.split(rb"[\r\n]", self._partial + chunk)
+        self._partial = lines.pop()
+        for line in lines:
+            self._scan(line)
+
+    def times(self) -> list:
+        if self._partial:
+            self._scan(self._partial)
+            self._partial = b""
+        return list(self._times)
+
+    def _scan(self, line: bytes) -> None:
+        if b"pts_time:" in line:
+            match = _SHOWINFO_PTS_RE.search(line.decode("utf-8", "replace"))
+            if match:
+                self._times.append(float(match.group(1)))
+
+
+def _stderr_sinks(*sinks):
+    """几个 on_stderr 回调合成一个, None 跳过; 一个都没有时返回 None."""
+    sinks = [sink for sink in sinks if sink is not None]
+    if len(sinks) <= 1:
+        return sinks[0] if sinks else None
+    return lambda chunk: [sink(chunk) for sink in sinks]
+
+
+# 一个进程里同时打开的 -ss 输入很多时, 每个解码器只给一个线程, 否则帧线程的缓冲按核数翻倍
+_FRAME_INPUT_THREADS_AFTER = 16
+
+
+def build_frame_grab(input_path: str, times: list, paths: list, width: int | None = None,
+                     sheet: dict | None = None) -> list:
+    """按时间点抽帧的 ffmpeg argv: 每个时间点一个 -ss 快速定位的输入, 一个进程输出全部帧 (可选顺带拼接触表).
+
+    每个输入只解码定位点附近的一个 GOP, 不用把整条视频解一遍; sheet = {"output", "columns", "rows", "width"}.
+    """
+    args = ["-y"]
+    threads = ["-threads", "1"] if len(times) > _FRAME_INPUT_THREADS_AFTER else []
+    for t in times:
+        args += threads + ["-ss", f"{t:.3f}", "-i", input_path]
+    chains, tiles = [], []
+    for i in range(len(times)):
+        chain = f"[{i}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS,setsar=1"
+        if width:
+            chain += f",scale={int(width)}:-2"
+        if sheet is None:
+            chains.append(f"{chain}[f{i}]")
+        else:
+            chains.append(f"{chain},split=2[f{i}][s{i}]")
+            chains.append(f"[s{i}]scale={int(sheet['width'])}:-2[t{i}]")
+            tiles.append(f"[t{i}]")
+    if sheet is not None:
+        chains.append(f"{''.join(tiles)}concat=n={len(times)}:v=1:a=0,"
+                      f"tile={sheet['columns']}x{sheet['rows']}:padding=4:margin=4[sheet]")
+    args += ["-filter_complex", ";".join(chains)]
+    for i, path in enumerate(paths):
+        args += ["-map", f"[f{i}]", "-frames:v", "1", "-update", "1", path]
+    if sheet is not None:
+        args += ["-map", "[sheet]", "-frames:v", "1", "-update", "1", sheet["output"]]
+    return args
+
+
+# pipeline 相邻两步之间每次转发的块大小: 转发线程手里最多一块, 下游写不动就不再读上游, 背压一路传回第一步
+_PIPE_CHUNK = 1024 * 1024
+
+
+# 每步 stderr 只留最后这么多字节
+_PIPE_STDERR_TAIL = 4096
+
+
+_PIPELINE_TOOLS = {"ffmpeg": (FFMPEG_IMAGE, "ffmpeg"), "imagemagick": (IMAGEMAGICK_IMAGE, "magick")}
+
+
+class _PipeStage:
+    """pipeline 的一步: Engine API 上 attach 了 stdin 的容器, 或者 API 用不了时一个 docker run -i 子进程.
+
+    read() 每次返回一块 stdout (b"" 为结束), write(data) 写 stdin 并返回写了多少, close_stdin() 送 EOF.
+    API 时 stdout / stderr 在同一条流里, stderr 帧由 read() 顺手交给 on_stderr; CLI 时另起 pumps 里的线程读.
+    启动失败抛 OSError.
+    """
+
+    def __init__(self, cmd: list, host: DockerHost, on_stderr):
+        self.attached = None
+        self.proc = None
+        self.pumps: list = []
+        self.killed = False
+        self._done = threading.Event()
+        spec = host.engine.spec(cmd) if host.engine.enabled else None
+        if spec is not None:
+            try:
+                self.attached = host.engine.attach(spec)
+            except DockerAPIUnavailable as e:
+                message = host.unreachable(e)
+                if message is not None:
+                    raise OSError(message.strip()) from e
+            except (DockerAPIError, http.client.HTTPException) as e:
+                raise OSError(f"Error response from daemon: {e}") from e
+        if self.attached is not None:
+            self.runner = "api"
+            self._read = self.attached.stdout_reader(on_stderr)
+            self.send = self.attached.send
+            return
+        self.runner = "cli"
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if "-i" in cmd[:3] else subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True,
+                                     env=host.env)
+        self.pumps.append(lambda: self._pump_stderr(on_stderr))
+
+    def _pump_stderr(self, on_stderr) -> None:
+        for chunk in iter(lambda: self.proc.stderr.read1(65536), b""):
+            on_stderr(chunk)
+
+    def read(self) -> bytes:
+        if self.proc is not None:
+            return os.read(self.proc.stdout.fileno(), _PIPE_CHUNK)
+        data = self._read()
+        if not data:
+            self._done.set()
+        return data
+
+    def write(self, data) -> int:
+        if self.proc is not None:
+            return os.write(self.proc.stdin.fileno(), data)
+        return self.send(data)
+
+    def close_stdin(self) -> None:
+        if self.proc is not None:
+            with contextlib.suppress(OSError):
+                self.proc.stdin.close()
+        else:
+            self.attached.close_stdin()
+
+    def close_stdout(self) -> None:
+        """没人再读它的输出了: CLI 关管道让它吃 SIGPIPE, API 断流 (容器由 _run_pipeline 收尾时删)."""
+        if self.proc is not None:
+            with contextlib.suppress(OSError):
+                self.proc.stdout.close()
+        elif not self._done.is_set():
+            self.kill()
+
+    def kill(self) -> None:
+        self.killed = True
+        if self.proc is not None:
+            _kill_group(self.proc)
+        else:
+            self.attached.abort()
+            self._done.set()
+
+    def wait(self) -> int:
+        if self.proc is not None:
+            return self.proc.wait()
+        # 流读完 (或者断了) 才去 daemon 那边等退出码, 免得长时间挂着一条控制请求
+        self._done.wait()
+        try:
+            return self.attached.wait()
+        except (OSError, DockerAPIError, http.client.HTTPException):
+            return -1
+
+    def close(self) -> None:
+        if self.attached is not None:
+            self.attached.close()
+
+
+class _PipeLink:
+    """相邻两步之间的转发: 读上游 stdout 写下游 stdin, 记字节数和两头各等了多久."""
+
+    def __init__(self, src: _PipeStage, dst: _PipeStage):
+        self.src = src
+        self.dst = dst
+        self.bytes = 0
+        self.producer_wait = 0.0  # 等上游吐数据
+        self.consumer_wait = 0.0  # 等下游收数据 (背压)
+        self.first: float | None = None
+        self.last: float | None = None
+        self.broken = False
+
+    def run(self) -> None:
+        try:
+            while True:
+                t0 = time.monotonic()
+                chunk = self.src.read()
+                t1 = time.monotonic()
+                self.producer_wait += t1 - t0
+                if not chunk:
+                    break
+                if self.first is None:
+                    self.first = t1
+                view = memoryview(chunk)
+                while view:
+                    view = view[self.dst.write(view):]
+                self.last = time.monotonic()
+                self.consumer_wait += self.last - t1
+                self.bytes += len(chunk)
+        except OSError:
+            # 下游先退出了 (EPIPE): 不再读, 关掉上游的输出让它也退出
+            self.broken = True
+        finally:
+            self.dst.close_stdin()
+            self.src.close_stdout()
+
+    def stats(self) -> dict:
+        span = self.last - self.first if self.first is not None and self.last is not None else 0.0
+        return {
+            "bytes": self.bytes,
+            "mb_per_s": round(self.bytes / span / 1e6, 2) if span > 0 else None,
+            "producer_wait_s": round(self.producer_wait, 3),
+            "consumer_wait_s": round(self.consumer_wait, 3),
+            "broken": self.broken,
+        }
+
+
+def _split_args(args) -> list:
+    """magick 之类的参数: 列表原样用, 字符串按 shell 的引号规则切 (带空格的路径用引号包起来).
+
+    反斜杠不当转义符, Windows 路径 (D:\\a\\b.png) 原样保留; 引号不配对或列表里有非字符串时抛 ValueError.
+    """
+    if isinstance(args, (list, tuple)):
+        if not all(isinstance(a, str) for a in args):
+            raise ValueError("args must be a list of strings or a single string")
+        return list(args)
+    if not isinstance(args, str):
+        raise ValueError("args must be a list of strings or a single string")
+    lexer = shlex.shlex(args, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ""
+    lexer.escape = ""
+    try:
+        return list(lexer)
+    except ValueError as e:
+        raise ValueError(f"cannot split args: {e}") from None
+
+
+def _pipeline_steps(steps: list, direct_tools: str = "ffmpeg / imagemagick") -> list:
+    """[{"tool", "args"}, ...] -> [(tool, image, binary, argv), ...]; 不合法抛 ValueError.
+
+    direct_tools 是只有一步时报错里让用户直接调用的工具名.
+    """
+    parsed = []
+    for i, step in enumerate(steps):
+        tool = step.get("tool") if isinstance(step, dict) else None
+        if tool not in _PIPELINE_TOOLS:
+            raise ValueError(f"step {i}: tool must be one of {sorted(_PIPELINE_TOOLS)}")
+        argv = step.get("args")
+        if tool == "imagemagick" and isinstance(argv, str):
+            try:
+                argv = _split_args(argv)
+            except ValueError as e:
+                raise ValueError(f"step {i}: {e}") from None
+        if not isinstance(argv, list) or not argv or not all(isinstance(a, str) for a in argv):
+            raise ValueError(f"step {i}: args must be a non-empty list of strings")
+        parsed.append((tool,) + _PIPELINE_TOOLS[tool] + (argv,))
+    if len(parsed) < 2:
+        raise ValueError(f"a pipeline needs at least two steps; call {direct_tools} directly for one")
+    return parsed
+
+
+def _run_pipeline(host: DockerHost, parsed: list, timeout: int, notify, cancel: CancelToken | None) -> dict:
+    """几步 ffmpeg / magick 用 OS 管道串起来跑, 中间的帧 (image2pipe / rawvideo) 不落到盘上.
+
+    parsed 是 [(tool, image, binary, 容器里的 argv, docker run 参数), ...]. 每步一个容器, 上一步的 stdout 经转发线程
+    写进下一步的 stdin: Engine API 可用时直接在 hijack 过的 attach 连接上收发 (不 fork CLI, stdin 靠半关连接送 EOF),
+    否则每步一个 docker run -i 子进程. 转发是阻塞的, 慢的一步会把背压一路传回第一步, 内存里每条管道最多一块
+    _PIPE_CHUNK; 任意一步超时或取消, 整条管道的容器一起删掉. 返回每步的退出码/耗时/stderr 尾部, 每条管道的字节数、
+    吞吐和两头的等待时间, 以及据此估计的瓶颈步 (它的输入管道等它收、输出管道等它吐的时间最长).
+    """
+    for image in {step[1] for step in parsed}:
+        host.preflight.wait(image)
+    names = [f"ffmpeg-mcp-pipe-{uuid.uuid4().hex[:12]}" for _ in parsed]
+    cmds = [["docker", "run"] + (["-i"] if i else []) + ["--rm", "--name", name] + list(run_opts)
+            + ["--entrypoint", binary, image] + argv
+            for i, (name, (_, image, binary, argv, run_opts)) in enumerate(zip(names, parsed))]
+    command = " | ".join(" ".join(cmd) for cmd in cmds)
+
+    stages: list = []
+    stderr_tails = [_TailBuffer(_PIPE_STDERR_TAIL) for _ in parsed]
+
+    def kill_all() -> None:
+        for stage in stages:
+            stage.kill()
+        _remove_containers(names, host)
+
+    started = time.monotonic()
+    try:
+        for cmd, tail in zip(cmds, stderr_tails):
+            stages.append(_PipeStage(cmd, host, tail.write))
+    except OSError as e:
+        kill_all()
+        return {"success": False, "error": f"failed to start step {len(stages)}: {e}", "command": command}
+    if cancel is not None:
+        cancel.register(kill_all)
+
+    links = [_PipeLink(stages[i], stages[i + 1]) for i in range(len(stages) - 1)]
+    output = _TailBuffer(STDOUT_TAIL_KB * 1024)
+    returncodes: list = [None] * len(stages)
+    ended: list = [None] * len(stages)
+    done = [0]
+    lock = threading.Lock()
+
+    def drain_last() -> None:
+        with contextlib.suppress(OSError):
+            for chunk in iter(stages[-1].read, b""):
+                output.write(chunk)
+
+    def reap(i: int) -> None:
+        returncodes[i] = stages[i].wait()
+        ended[i] = time.monotonic()
+        with lock:
+            done[0] += 1
+            finished = done[0]
+        if notify is not None:
+            notify(finished, len(stages), f"step {i} ({parsed[i][0]}) exited with {returncodes[i]}")
+
+    io_threads = [threading.Thread(target=link.run, daemon=True) for link in links]
+    io_threads += [threading.Thread(target=pump, daemon=True) for stage in stages for pump in stage.pumps]
+    io_threads.append(threading.Thread(target=drain_last, daemon=True))
+    reapers = [threading.Thread(target=reap, args=(i,), daemon=True) for i in range(len(stages))]
+    for t in io_threads + reapers:
+        t.start()
+    deadline = started + timeout
+    timed_out = False
+    try:
+        for t in reapers:
+            t.join(max(0.0, deadline - time.monotonic()))
+            if t.is_alive():
+                timed_out = True
+                kill_all()
+                break
+        for t in reapers + io_threads:
+            t.join(10)
+    finally:
+        if cancel is not None:
+            cancel.unregister(kill_all)
+        for stage in stages:
+            stage.close()
+    # API 时被断流的容器 (下游先退出 / 超时 / 取消) 不会自己删掉
+    _remove_containers([name for name, stage in zip(names, stages) if stage.killed and stage.runner == "api"], host)
+
+    report_stages = []
+    for i, (tool, *_) in enumerate(parsed):
+        report_stages.append({
+            "index": i,
+            "tool": tool,
+            "returncode": returncodes[i],
+            "elapsed": round((ended[i] or time.monotonic()) - started, 3),
+            "stderr": stderr_tails[i].getvalue().strip(),
+        })
+    link_stats = [dict(link.stats(), **{"from": i, "to": i + 1}) for i, link in enumerate(links)]
+    # 一步慢的时候: 它的输入管道一直在等它收, 输出管道一直在等它吐
+    busy = [(links[i - 1].consumer_wait if i else 0.0) + (links[i].producer_wait if i < len(links) else 0.0)
+            for i in range(len(stages))]
+    report = {
+        "success": not timed_out and all(code == 0 for code in returncodes),
+        "elapsed": round(time.monotonic() - started, 3),
+        "runner": stages[0].runner,
+        "stages": report_stages,
+        "links": link_stats,
+        "bottleneck": max(range(len(stages)), key=busy.__getitem__),
+        "output": output.getvalue(),
+        "command": command,
+    }
+    if timed_out:
+        report.update(error=f"Pipeline timed out after {timeout}s", timeout=True)
+    elif cancel is not None and cancel.cancelled:
+        report.update(error="Cancelled", cancelled=True)
+    elif not report["success"]:
+        # 最先退出的失败步是根因, 它上游的几步通常只是跟着收到了 EPIPE
+        failed = min((st for st in report_stages if st["returncode"] != 0), key=lambda st: st["elapsed"])
+        report["error"] = (f"step {failed['index']} ({failed['tool']}) exited with {failed['returncode']}: "
+                           f"{failed['stderr'][-500:]}")
+    return report
+
+
+def _local_stat(path: str) -> dict:
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return {"path": path, "exists": False}
+    if not stat.S_ISREG(st.st_mode):
+        return {"path": path, "exists": False}
+    return {"path": path, "exists": True, "size": st.st_size, "mtime": st.st_mtime}
+
+
+# 一个 busybox 容器里批量 stat, 每个路径输出一行 "size mtime" 或 "-"
+_STAT_SCRIPT = 'for p in "$@"; do if [ -f "$p" ]; then stat -c "%s %Y" "$p"; else echo -; fi; done'
+
+
+class ProbeCache:
+    """ffprobe 结果缓存: 内存一层 + 磁盘一层 (<dir>/<sha1>.json), key = path + size + mtime_ns."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._memory: dict = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path: str, st: os.stat_result) -> str:
+        return hashlib.sha1(f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()
+
+    def get(self, path: str, st: os.stat_result) -> dict | None:
+        key = self._key(path, st)
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(os.path.join(self.root, key + ".json")) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._memory[key] = entry
+        return entry
+
+    def put(self, path: str, st: os.stat_result, entry: dict) -> None:
+        key = self._key(path, st)
+        with self._lock:
+            self._memory[key] = entry
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = os.path.join(self.root, f".{key}.{uuid.uuid4().hex}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, os.path.join(self.root, key + ".json"))
+        except OSError as e:
+            _log(f"probe cache write failed: {e}")
+
+
+_PROBE_ARGS = ["-v", "error", "-print_format", "json", "-show_format", "-show_streams"]
+
+
+# 只解复用不解码: 读视频流每个包的 pts + flags, 带 K 的就是关键帧
+_KEYFRAME_ARGS = ["-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0"]
+
+
+def _parse_concurrency(spec: str, defaults: dict) -> dict:
+    """FFMPEG_MCP_CONCURRENCY="ffmpeg=2,imagemagick=8" 覆盖 defaults 里各工具的并发上限."""
+    limits = dict(defaults)
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip():
+            try:
+                limits[name.strip()] = int(value)
+            except ValueError:
+                _log(f"ignoring bad concurrency setting: {item!r}")
+    return limits
+
+
+class JobScheduler:
+    """按工具名限流: 每个有上限的工具一个信号量, 超出的请求在自己的线程里排队."""
+
+    def __init__(self, limits: dict):
+        self.limits = dict(limits)
+        self._slots = {name: threading.BoundedSemaphore(n) for name, n in limits.items() if n > 0}
+
+    @contextlib.contextmanager
+    def slot(self, tool_name: str):
+        sem = self._slots.get(tool_name)
+        if sem is None:
+            yield
+            return
+        sem.acquire()
+        try:
+            yield
+        finally:
+            sem.release()
+
+
+class CallGate:
+    """tools/call 的线程闸门: 每个请求一个线程, 但同时最多 limit 个; 满了回 -32000, 不起线程也不排队."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self._threads: list = []
+
+    def start(self, request: dict, handler) -> bool:
+        if self._sem is not None and not self._sem.acquire(blocking=False):
+            send_error(request.get("id"), -32000, f"Server busy: {self.limit} tool calls already in flight")
+            return False
+        worker = threading.Thread(target=self._run, args=(request, handler), daemon=True)
+        try:
+            worker.start()
+        except RuntimeError as e:
+            self._release()
+            send_error(request.get("id"), -32000, f"Server busy: {e}")
+            return False
+        self._threads = [t for t in self._threads if t.is_alive()] + [worker]
+        return True
+
+    def _run(self, request: dict, handler) -> None:
+        try:
+            handler(request)
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        if self._sem is not None:
+            self._sem.release()
+
+    def join(self) -> None:
+        for worker in self._threads:
+            worker.join()
+
+
+class Metrics:
+    """按工具聚合的调用计数、各阶段耗时直方图、CPU 时间和读写字节数, server_stats 和 Prometheus 共用."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+    PHASES = ("queue", "acquire", "stage_in", "start", "run", "teardown", "stage_out", "total")
+    SUMS = ("cpu_user_s", "cpu_sys_s", "input_bytes", "output_bytes", "stdout_bytes", "stderr_bytes")
+
+    def __init__(self):
+        self._tools: dict = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def _tool(self, name: str) -> dict:
+        entry = self._tools.get(name)
+        if entry is None:
+            entry = self._tools[name] = {
+                "calls": 0,
+                "errors": 0,
+                "runners": {},
+                "phases": {p: {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0} for p in self.PHASES},
+                "totals": dict.fromkeys(self.SUMS, 0),
+                "max_rss_kb": 0,
+            }
+        return entry
+
+    def observe(self, tool: str, result, total: float, queue: float) -> None:
+        result = result if isinstance(result, dict) else {}
+        metrics = result.get("metrics") or {}
+        phases = {"queue": queue, "total": total}
+        phases.update({p: metrics[f"{p}_s"] for p in self.PHASES[1:-1] if f"{p}_s" in metrics})
+        with self._lock:
+            entry = self._tool(tool)
+            entry["calls"] += 1
+            entry["errors"] += not result.get("success", False)
+            runner = result.get("runner") or ("cache" if result.get("cache", {}).get("hit") else None)
+            if runner:
+                entry["runners"][runner] = entry["runners"].get(runner, 0) + 1
+            for phase, value in phases.items():
+                hist = entry["phases"][phase]
+                if value <= self.BUCKETS[-1]:
+                    hist["buckets"][bisect.bisect_left(self.BUCKETS, value)] += 1
+                hist["sum"] += value
+                hist["count"] += 1
+            for key in self.SUMS:
+                entry["totals"][key] += metrics.get(key) or 0
+            entry["max_rss_kb"] = max(entry["max_rss_kb"], metrics.get("max_rss_kb") or 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            tools = {}
+            for name, entry in self._tools.items():
+                phases = {}
+                for phase, hist in entry["phases"].items():
+                    if hist["count"]:
+                        phases[phase] = {"count": hist["count"], "avg_s": round(hist["sum"] / hist["count"], 4),
+                                         "p50_s": self._quantile(hist, 0.5), "p95_s": self._quantile(hist, 0.95)}
+                tools[name] = {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "runners": dict(entry["runners"]),
+                    "phases": phases,
+                    "totals": {k: round(v, 3) for k, v in entry["totals"].items()},
+                    "max_rss_kb": entry["max_rss_kb"],
+                }
+        return {"uptime_s": round(time.time() - self.started, 1), "tools": tools}
+
+    def _quantile(self, hist: dict, q: float) -> float | None:
+        # 直方图只能给出桶的上界; 落在最大桶之外的返回 None
+        want = q * hist["count"]
+        seen = 0
+        for bound, n in zip(self.BUCKETS, hist["buckets"]):
+            seen += n
+            if seen >= want:
+                return bound
+        return None
+
+    def prometheus(self) -> str:
+        lines = [
+            "# TYPE ffmpeg_mcp_calls_total counter",
+            "# TYPE ffmpeg_mcp_errors_total counter",
+            "# TYPE ffmpeg_mcp_runs_total counter",
+            "# TYPE ffmpeg_mcp_phase_seconds histogram",
+            "# TYPE ffmpeg_mcp_cpu_seconds_total counter",
+            "# TYPE ffmpeg_mcp_bytes_total counter",
+            "# TYPE ffmpeg_mcp_max_rss_kb gauge",
+        ]
+        with self._lock:
+            for name, entry in sorted(self._tools.items()):
+                tool = f'tool="{name}"'
+                lines.append(f"ffmpeg_mcp_calls_total{{{tool}}} {entry['calls']}")
+                lines.append(f"ffmpeg_mcp_errors_total{{{tool}}} {entry['errors']}")
+                for runner, n in sorted(entry["runners"].items()):
+                    lines.append(f'ffmpeg_mcp_runs_total{{{tool},runner="{runner}"}} {n}')
+                for phase, hist in entry["phases"].items():
+                    if not hist["count"]:
+                        continue
+                    labels = f'{tool},phase="{phase}"'
+                    cumulative = 0
+                    for bound, n in zip(self.BUCKETS, hist["buckets"]):
+                        cumulative += n
+                        lines.append(f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="+Inf"}} {hist["count"]}')
+                    lines.append(f"ffmpeg_mcp_phase_seconds_sum{{{labels}}} {hist['sum']:.6f}")
+                    lines.append(f"ffmpeg_mcp_phase_seconds_count{{{labels}}} {hist['count']}")
+                totals = entry["totals"]
+                lines.append(f'ffmpeg_mcp_cpu_seconds_total{{{tool},mode="user"}} {totals["cpu_user_s"]:.3f}')
+                lines.append(f'ffmpeg_mcp_cpu_seconds_total{{{tool},mode="system"}} {totals["cpu_sys_s"]:.3f}')
+                for key in ("input", "output", "stdout", "stderr"):
+                    lines.append(f'ffmpeg_mcp_bytes_total{{{tool},direction="{key}"}} {totals[key + "_bytes"]}')
+                lines.append(f"ffmpeg_mcp_max_rss_kb{{{tool}}} {entry['max_rss_kb']}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)
+        except OSError as e:
+            _log(f"metrics file write failed: {e}")
+
+
+METRICS = Metrics()
+
+
+def _serve_metrics(port: int) -> None:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    except OSError as e:
+        _log(f"metrics port {port} unavailable: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def _progress_notifier(token):
+    if token is None:
+        return None
+
+    def notify(progress: float, total: float | None = None, message: str | None = None) -> None:
+        params = {"progressToken": token, "progress": progress}
+        if total is not None:
+            params["total"] = total
+        if message:
+            params["message"] = message
+        send({"jsonrpc": "2.0", "method": "notifications/progress", "params": params})
+
+    return notify
+
+
+class Job:
+    __slots__ = ("id", "tool", "arguments", "timeout", "status", "created", "started", "finished",
+                 "progress", "log", "result", "cancel")
+
+    def __init__(self, tool: str, arguments: dict, timeout: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.tool = tool
+        self.arguments = arguments
+        self.timeout = timeout
+        self.status = "queued"
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.progress: dict = {}
+        self.log: deque = deque(maxlen=200)
+        self.result: dict | None = None
+        self.cancel = CancelToken()
+
+    def summary(self) -> dict:
+        end = self.finished or time.time()
+        info = {
+            "job_id": self.id,
+            "tool": self.tool,
+            "status": self.status,
+            "created": self.created,
+            "elapsed": round(end - self.started, 3) if self.started else 0.0,
+            "timeout": self.timeout,
+        }
+        if self.progress:
+            info["progress"] = self.progress
+        return info
+
+
+class JobTable:
+    """进程内的后台任务表: 每个任务一个线程, 先排 scheduler 的队, 再带着 CancelToken 去跑.
+
+    tools 是可以放到后台跑的工具: 工具名 -> (arguments, notify, timeout, cancel) -> result.
+    任务结束后结果和日志保留 JOB_RETENTION 秒 (最多 JOB_MAX_FINISHED 个), 过期的在下次提交时清掉.
+    """
+
+    FINAL = ("succeeded", "failed", "cancelled", "timeout")
+
+    def __init__(self, tools: dict, scheduler: JobScheduler):
+        self.tools = tools
+        self.scheduler = scheduler
+        self._jobs: dict = {}
+        self._lock = threading.Lock()
+
+    def submit(self, tool: str, arguments: dict, timeout: int) -> Job:
+        job = Job(tool, arguments, timeout)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job: Job) -> None:
+        job.cancel.cancel()
+        with self._lock:
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished = time.time()
+
+    def shutdown(self) -> None:
+        for job in self.list():
+            if job.status not in self.FINAL:
+                self.cancel(job)
+
+    # 以下对应 job submit / status / cancel / result 四个工具, 返回工具结果
+
+    def tool_submit(self, tool: str, arguments: dict, timeout: int | None = None) -> dict:
+        """放到后台跑, 立即返回 job_id."""
+        if tool not in self.tools:
+            return {"success": False, "error": f"tool {tool!r} cannot run as a job; supported: {sorted(self.tools)}"}
+        job = self.submit(tool, dict(arguments or {}), int(timeout or JOB_TIMEOUT))
+        return dict(job.summary(), success=True)
+
+    def tool_status(self, job_id: str | None = None) -> dict:
+        """单个任务的状态、进度和最近日志; 不传 job_id 列出全部任务."""
+        if not job_id:
+            return {"success": True, "jobs": [job.summary() for job in self.list()]}
+        job = self.get(job_id)
+        if job is None:
+            return {"success": False, "error": f"Unknown job: {job_id}"}
+        return dict(job.summary(), log=list(job.log)[-20:])
+
+    def tool_cancel(self, job_id: str) -> dict:
+        """取消排队中或运行中的任务, 干活的容器会被删掉."""
+        job = self.get(job_id)
+        if job is None:
+            return {"success": False, "error": f"Unknown job: {job_id}"}
+        if job.status not in self.FINAL:
+            self.cancel(job)
+        return dict(job.summary(), success=True)
+
+    def tool_result(self, job_id: str) -> dict:
+        """已结束任务的完整结果和日志."""
+        job = self.get(job_id)
+        if job is None:
+            return {"success": False, "error": f"Unknown job: {job_id}"}
+        if job.status not in self.FINAL:
+            return dict(job.summary(), success=False, error=f"Job is still {job.status}")
+        report = dict(job.summary(), log=list(job.log))
+        report["result"] = job.result
+        return report
+
+    def _prune(self) -> None:
+        now = time.time()
+        done = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished)
+        for i, job in enumerate(done):
+            if now - job.finished > JOB_RETENTION or len(done) - i > JOB_MAX_FINISHED:
+                del self._jobs[job.id]
+
+    def _run(self, job: Job) -> None:
+        def notify(progress: float, total: float | None = None, message: str | None = None) -> None:
+            job.progress = {"progress": progress, "total": total}
+            if message:
+                job.log.append(message)
+
+        with self.scheduler.slot(job.tool):
+            with self._lock:
+                if job.status != "queued":
+                    return
+                job.status = "running"
+                job.started = time.time()
+            try:
+                result = self.tools[job.tool](job.arguments, notify, job.timeout, job.cancel)
+            except Exception as e:
+                result = {"success": False, "error": f"Internal error: {e}"}
+        if result.get("cancelled") or job.cancel.cancelled:
+            status = "cancelled"
+        elif result.get("timeout"):
+            status = "timeout"
+        else:
+            status = "succeeded" if result.get("success") else "failed"
+        with self._lock:
+            job.result = result
+            job.status = status
+            job.finished = time.time()
@@ -15,31 +15,318 @@ basedir 必须使用盘符根目录 (D:/, E:/, C:/)
 实战经验 sha256:b98d601b439325dd0216074d1d3c8b94e382889368a27eb70a1a2fdad15a5785
 """
 
-import subprocess
+import atexit
+import contextlib
+import functools
+import glob
+import os
+import stat
 import json
 import sys
 import re
+import threading
+import time
+import uuid
+from urllib.parse import quote
 
-def send_response(response):
-    """发送 MCP 响应"""
-    print(json.dumps(response), flush=True)
-
-def send_error(id, code, message):
-    """发送错误响应"""
-    send_response({
-        "jsonrpc": "2.0",
-        "id": id,
-        "error": {"code": code, "message": message}
-    })
-
-def send_result(id, result):
-    """发送成功响应"""
-    send_response({
-        "jsonrpc": "2.0",
-        "id": id,
-        "result": result
-    })
+from mcp_common import (
+    BUSYBOX_IMAGE, CallGate, DOCKER_SOCKET, DockerHost, FFMPEG_IMAGE, FFmpegProgress, IMAGEMAGICK_IMAGE, JOB_TIMEOUT,
+    JobScheduler, JobTable, MAX_INFLIGHT, METRICS, METRICS_FILE, METRICS_PORT, ProbeCache, ShowinfoTimes,
+    _DOCKER_HOST, _KEYFRAME_ARGS, _PROBE_ARGS, _STAT_SCRIPT, _bench_metrics, _docker_run_leased, _ffmpeg_io_indexes,
+    _local_stat, _parse_concurrency, _pipeline_steps, _pool_for, _preset_args, _progress_notifier,
+    _progress_supported, _run_batch, _run_pipeline, _serve_metrics, _smart_cut, _split_args, _stderr_sinks,
+    build_frame_grab, send_error, send_result, send_tool_result,
+)
 
+# 镜像、worker 池、Engine API、输出截断、预检、CPU、后台任务、指标这些与 Linux 版共用的配置见 mcp_common.py
+
+# 预检时按这些盘符预热 worker 池（worker 按卷映射分池，要知道常用盘符才能预热，如 "D,E"；不设只检查/拉镜像）
+WARM_DRIVES = [d.strip().rstrip(":/\\").upper() for d in os.environ.get("FFMPEG_MCP_WARM_DRIVES", "").split(",")
+               if d.strip()]
+
+# file-exists-win 走本进程 os.stat:
+# auto = 路径所在盘符在本机可见（直接在 Windows 上 python server.py）时走本地, 1 = 强制本地, 0 = 总是起 busybox 容器
+NATIVE_STAT = os.environ.get("FFMPEG_MCP_NATIVE_STAT", "auto").lower()
+
+# probe-win 结果按 path+size+mtime 落盘缓存（仅盘符在本机可见时生效，容器里拿不到 size/mtime）
+PROBE_CACHE_DIR = os.environ.get("FFMPEG_MCP_PROBE_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".cache", "ffmpeg-mcp", "probe"))
+
+# 每个工具同时最多跑几个任务，0 = 不限；可用 FFMPEG_MCP_CONCURRENCY="ffmpeg-win=2,imagemagick-win=8" 覆盖
+DEFAULT_CONCURRENCY = {"ffmpeg-win": 2, "imagemagick-win": 8, "file-exists-win": 0, "probe-win": 4, "ffmpeg-batch-win": 1,
+                       "extract-frames-win": 2, "trim-win": 1, "pipeline-win": 1}
+
+def _docker_run(image, cmd_args, volume_mount="", entrypoint=None, timeout=300,
+                on_stdout_line=None, on_stderr=None, worker=None, cancel=None):
+    """
+    在 DOCKER 上跑一次容器（见 mcp_common._docker_run_leased），卷映射由 volume_mount 给出
+
+    volume_mount 可以是一个卷映射字符串，也可以是多个（跨盘调用，见 plan_mounts）。
+
+    Returns:
+        dict: success / output (stdout) / error (stderr) / command / runner / metrics；
+              超时另带 timeout=True，取消另带 cancelled=True
+    """
+    return _docker_run_leased(DOCKER, image, cmd_args, _volume_opts(volume_mount), entrypoint, timeout,
+                              on_stdout_line, on_stderr, worker, cancel)
+
+def _file_bytes(paths):
+    """盘符在本机可见时统计文件总字节数，看不见返回 None"""
+    total = None
+    for path in paths:
+        if _native_stat_enabled(path):
+            try:
+                total = (total or 0) + os.path.getsize(path)
+            except OSError:
+                total = total or 0
+    return total
+
+# 路径翻译引擎：正则全部预编译，token 级结果记忆化（同一个滤镜图反复调用只算一次）
+_BASEDIR_RE = re.compile(r'^([A-Za-z]:)/?(.*)', re.S)
+# 整个参数就是一个 Windows 路径（-i 的值、输出文件），允许空格
+_WHOLE_PATH_RE = re.compile(r'^([A-Za-z]):[/\\](.*)$', re.S)
+# 路径里的盘符（取 basedir、判断本地可见）
+_DRIVE_RE = re.compile(r'(?<![A-Za-z0-9_/.])([A-Za-z]):[/\\]')
+# 嵌在滤镜/选项值里的路径：movie=D\:/a.png、subtitles='D\:/my subs/a.srt'、file:D:/x.mp4
+# 滤镜语法里冒号要转义成 \: （filter_complex 里可能是 \\:），容器路径不含冒号，转义一并去掉；
+# 引号包住的可以有空格，否则到滤镜分隔符（, ; [ ] | : 引号 空白）为止
+_EMBEDDED_PATH_RE = re.compile(
+    r"""(?P<quote>['"])(?P<qdrive>[A-Za-z])\\{0,2}:[/\\](?P<qpath>[^'"]*)(?P=quote)"""
+    r"""|(?<![A-Za-z0-9_/.])(?P<drive>[A-Za-z])\\{0,2}:[/\\](?P<path>[^\s'",;\[\]|:]*)"""
+)
+# 定位候选用的字面量模式：扫描长滤镜串时比带字符类开头的正则快一个数量级
+_COLON_SLASH_RE = re.compile(r':[/\\]')
+# concat demuxer 列表里的 file 行
+_CONCAT_LINE_RE = re.compile(r"""^(\s*file\s+)(['"]?)(.*?)\2\s*$""")
+
+def _container_path(drive, subpath, multi_drive=False):
+    """
+    盘符 + 盘内路径 -> 容器路径
+
+    单盘布局整个盘符挂在 /work；多盘布局每个盘符挂在 /work/<盘符小写>
+    """
+    subpath = subpath.replace("\\", "/")
+    root = f"/work/{drive.lower()}" if multi_drive else "/work"
+    return f"{root}/{subpath}" if subpath else root
+
+def _path_spans(arg):
+    """
+    找出一个参数里的所有 Windows 路径
+
+    先找 ":/" 再往回看盘符，只在候选位置上跑 _EMBEDDED_PATH_RE。
+
+    Returns:
+        tuple: ((start, end, quote, drive, subpath), ...)
+    """
+    # 绝大多数参数（-c:v、crf 数值……）没有盘符，先用 in 快速跳过
+    if ":/" not in arg and ":\\" not in arg:
+        return ()
+    match = _WHOLE_PATH_RE.match(arg)
+    if match:
+        return ((0, len(arg), "", match.group(1), match.group(2)),)
+    spans = []
+    last = 0
+    for colon in _COLON_SLASH_RE.finditer(arg):
+        drive = colon.start() - 1
+        while drive >= last and arg[drive] == "\\" and colon.start() - drive <= 2:
+            drive -= 1
+        if drive < last or not arg[drive].isalpha():
+            continue
+        match = None
+        if drive > last and arg[drive - 1] in "'\"":
+            match = _EMBEDDED_PATH_RE.match(arg, drive - 1)
+        if match is None:
+            match = _EMBEDDED_PATH_RE.match(arg, drive)
+        if match is None:
+            continue
+        if match.group("quote"):
+            spans.append((match.start(), match.end(), match.group("quote"), match.group("qdrive"), match.group("qpath")))
+        else:
+            spans.append((match.start(), match.end(), "", match.group("drive"), match.group("path")))
+        last = match.end()
+    return tuple(spans)
+
+@functools.lru_cache(maxsize=4096)
+def convert_any_windows_path(arg: str, multi_drive: bool = False) -> str:
+    """
+    把一个参数里的 Windows 路径全部转换为容器路径
+
+    转换规则:
+        D:/any/path/file.mp4 -> /work/any/path/file.mp4
+        C:\\Users\\test.jpg   -> /work/Users/test.jpg
+        movie=D\\:/logo.png   -> movie=/work/logo.png（滤镜/选项值里嵌入的路径同样转换）
+
+    multi_drive=True 时按多盘布局转换: E:/clips/a.mp4 -> /work/e/clips/a.mp4
+
+    这样用户可以直接使用 Windows 路径，无需手动转换！
+    """
+    spans = _path_spans(arg)
+    return _render_spans(arg, spans, multi_drive) if spans else arg
+
+def _render_spans(arg, spans, multi_drive=False):
+    """把 _path_spans 找到的路径替换成容器路径"""
+    parts = []
+    last = 0
+    for start, end, quote, drive, subpath in spans:
+        parts.append(arg[last:start])
+        parts.append(f"{quote}{_container_path(drive, subpath, multi_drive)}{quote}")
+        last = end
+    parts.append(arg[last:])
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=4096)
+def _translate_arg(arg):
+    """
+    单盘布局下的转换结果 + 参数里出现的盘符（大写字母拼成的串，如 "DE"）
+
+    translate_ffmpeg_args 每个参数只查一次缓存，转换和收集盘符在同一遍里完成。
+    """
+    if ":/" not in arg and ":\\" not in arg:
+        return arg, ""
+    # 整个参数是路径（-i 的值、输出文件）是最常见的情况，不拼 span
+    match = _WHOLE_PATH_RE.match(arg)
+    if match:
+        return _container_path(match.group(1), match.group(2)), match.group(1).upper()
+    spans = _path_spans(arg)
+    return _render_spans(arg, spans), "".join({span[3].upper() for span in spans})
+
+def referenced_drives(args):
+    """参数里出现过的盘符（大写）"""
+    drives = set()
+    for arg in args:
+        if ":/" in arg or ":\\" in arg:
+            drives.update(_translate_arg(arg)[1])
+    return drives
+
+def plan_mounts(basedir, drives=()):
+    """
+    决定这次调用的卷映射
+
+    参数里只出现 basedir 所在的盘符（或者根本没有盘符）时维持原来的单盘布局: D:/:/work；
+    跨盘时每个盘符各挂一个前缀: D:/:/work/d、E:/:/work/e，一个容器里直接读 E 写 D，不用先拷到同一个盘。
+
+    Returns:
+        tuple: (volume_mount, multi_drive) —— 单盘时 volume_mount 是字符串，多盘时是字符串元组
+    """
+    volume_mount, _ = convert_windows_path(basedir) if basedir else ("", "")
+    base = _BASEDIR_RE.match(basedir.replace("\\", "/")) if basedir else None
+    drives = set(drives)
+    if base:
+        drives.add(base.group(1)[0].upper())
+    if len(drives) <= 1:
+        return volume_mount, False
+    mounts = tuple(f"{d}:/:/work/{d.lower()}" for d in sorted(drives))
+    if volume_mount and not base:
+        # Linux/Mac 风格的 basedir 照旧按原路径挂载
+        mounts += (volume_mount,)
+    return mounts, True
+
+def _volume_opts(volume_mount):
+    """卷映射（字符串或元组） -> docker -v 参数"""
+    if not volume_mount:
+        return []
+    mounts = (volume_mount,) if isinstance(volume_mount, str) else volume_mount
+    return [opt for mount in mounts for opt in ("-v", mount)]
+
+def _container_arg(arg, basedir, multi_drive):
+    """
+    转换一个参数；多盘布局下用户按单盘习惯写的 /work/xxx 视为 basedir 盘符下的路径，
+    改写成 /work/<盘符>/xxx
+    """
+    if multi_drive and (arg == "/work" or arg.startswith("/work/")):
+        base = _BASEDIR_RE.match(basedir.replace("\\", "/")) if basedir else None
+        if base:
+            return f"/work/{base.group(1)[0].lower()}{arg[5:]}"
+    return convert_any_windows_path(arg, multi_drive)
+
+def _read_concat_list(path):
+    """concat 列表文件本地可见时返回所有行，否则 None"""
+    if not _native_stat_enabled(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().splitlines()
+    except OSError:
+        return None
+
+def _concat_targets(lines):
+    """列表里 file 行指向的路径"""
+    targets = []
+    for line in lines:
+        match = _CONCAT_LINE_RE.match(line)
+        if match:
+            targets.append(match.group(3).replace("'\\''", "'"))
+    return targets
+
+def _translate_concat_list(path, lines, multi_drive=False):
+    """
+    concat demuxer 的列表文件里也是 Windows 路径，容器里读不懂
+
+    在同目录写一份翻译后的副本（相对路径照样按这个目录解析），返回副本路径；写不了返回 None，保持原样。
+    """
+    out = []
+    for line in lines:
+        match = _CONCAT_LINE_RE.match(line)
+        if match:
+            target = convert_any_windows_path(match.group(3).replace("'\\''", "'"), multi_drive)
+            escaped = target.replace("'", "'\\''")
+            line = f"{match.group(1)}'{escaped}'"
+        out.append(line)
+    # 并发调用可能用同一个列表，副本名各不相同，互不删除对方的
+    directory, name = os.path.split(path.replace("\\", "/"))
+    copy = f"{directory}/.{name}.{uuid.uuid4().hex[:8]}.container.txt"
+    try:
+        with open(copy, "w", encoding="utf-8") as f:
+            f.write("\n".join(out) + "\n")
+    except OSError:
+        return None
+    return copy
+
+def translate_ffmpeg_args(args, basedir="", drives=()):
+    """
+    一次遍历 ffmpeg argv，转换其中所有 Windows 路径，并决定卷映射
+
+    - 整个参数是路径（-i 的值、输出文件）：整体转换，允许空格
+    - 滤镜/选项值里嵌入的路径（movie=、subtitles=、file:、amovie=……）：逐个替换
+    - -f concat 的输入列表：生成翻译后的副本再转换
+    - 参数（含 concat 列表）里出现多个盘符时切到多盘布局，见 plan_mounts；
+      drives 是额外要挂的盘符（ffmpeg-batch-win 共用一个容器时传全部任务的盘符）
+
+    Returns:
+        tuple: (container_args, temp_files, volume_mount) —— temp_files 是生成的 concat 副本，调用方用完删除
+    """
+    concat_lists = {}
+    concat_next = False
+    # 没有 -f 就不可能有 concat 列表，省掉逐参数的 Python 循环
+    for i, arg in enumerate(args if "-f" in args else ()):
+        if arg == "-f" and i + 1 < len(args):
+            concat_next = args[i + 1] == "concat"
+        elif concat_next and i > 0 and args[i - 1] == "-i":
+            concat_next = False
+            lines = _read_concat_list(arg)
+            if lines is not None:
+                concat_lists[i] = lines
+
+    # 按单盘布局转换和收集盘符共用一次缓存查询；真跨盘（少见）时再按多盘布局重转一次
+    translated = [_translate_arg(arg) for arg in args]
+    out = [container for container, _ in translated]
+    used = set("".join([arg_drives for _, arg_drives in translated]))
+    used.update(drives)
+    for lines in concat_lists.values():
+        used |= referenced_drives(_concat_targets(lines))
+    volume_mount, multi_drive = plan_mounts(basedir, used)
+
+    if multi_drive:
+        out = [_container_arg(arg, basedir, True) for arg in args]
+    temp_files = []
+    for i, lines in concat_lists.items():
+        copy = _translate_concat_list(args[i], lines, multi_drive)
+        if copy is not None:
+            temp_files.append(copy)
+            out[i] = _container_arg(copy, basedir, multi_drive)
+    return out, temp_files, volume_mount
+
+@functools.lru_cache(maxsize=64)
 def convert_windows_path(basedir: str) -> tuple:
     """
     将 Windows 路径转换为 Docker 兼容格式
@@ -59,13 +346,15 @@ def convert_windows_path(basedir: str) -> tuple:
     2. 子目录映射在 Linux 容器内无法正确识别 Windows 路径格式
     3. 实战测试：D:/subfolder 作为 basedir 会导致 "No such file or directory"
     
+    结果按 basedir 记忆化，同一个 basedir 的警告只打印一次。
+
     Returns:
         tuple: (docker_volume_mount, normalized_basedir)
     """
     basedir = basedir.replace("\\", "/").rstrip('/')
     
     # 检测 Windows 路径 (如 D:/tecx/text 或 C:/Users/...)
-    match = re.match(r'^([A-Za-z]:)/?(.*)', basedir)
+    match = _BASEDIR_RE.match(basedir)
     if match:
         drive = match.group(1)  # D:
         subpath = match.group(2)  # 可能的子路径，例如 "tecx/text"
@@ -86,29 +375,13 @@ def convert_windows_path(basedir: str) -> tuple:
         # Linux/Mac 路径 -> 官方模式 (basedir:basedir)
         return f"{basedir}:{basedir}", basedir
 
-def convert_any_windows_path(arg: str) -> str:
-    """
-    自动转换任意 Windows 路径为容器路径
-    
-    转换规则:
-        D:/any/path/file.mp4 -> /work/any/path/file.mp4
-        C:/Users/test.jpg -> /work/Users/test.jpg
-    
-    这样用户可以直接使用 Windows 路径，无需手动转换！
-    """
-    arg = arg.replace("\\", "/")
-    
-    # 检测 Windows 路径格式 (如 D:/xxx 或 C:/xxx)
-    match = re.match(r'^([A-Za-z]):/(.*)', arg)
-    if match:
-        # drive = match.group(1)  # D: (盘符信息保留用于 volume mount)
-        subpath = match.group(2)  # any/path/file.mp4
-        return f"/work/{subpath}" if subpath else "/work"
-    
-    return arg
-
+# 本机这一台 docker daemon；DOCKER_HOST 是 tcp:// / npipe:// 时 Engine API 不可用，全部走 CLI。
+# 预检按 WARM_DRIVES 每个盘符的卷映射预热 worker 池
+DOCKER = DockerHost(_DOCKER_HOST or "unix:///var/run/docker.sock", address=DOCKER_SOCKET,
+                    warm_opts=[_volume_opts(plan_mounts(f"{d}:/", (d,))[0]) for d in WARM_DRIVES])
 
-def run_ffmpeg(args: list, basedir: str) -> dict:
+def run_ffmpeg(args: list, basedir: str, notify=None, worker=None, timeout=300, cancel=None, drives=(), tier=None,
+               on_stderr=None) -> dict:
     """
     运行 FFmpeg 命令
     
@@ -123,101 +396,236 @@ def run_ffmpeg(args: list, basedir: str) -> dict:
            - D:/other/file.mp4 -> /work/other/file.mp4
         
     用户可以直接使用 Windows 路径，无需手动使用 /work/ 前缀！
+
+    跨盘:
+        参数里出现 basedir 以外的盘符时，每个盘符挂到 /work/<盘符小写>（D:/:/work/d、E:/:/work/e），
+        一个容器里完成读 E 写 D；手写的 /work/xxx 视为 basedir 盘下的路径。drives 是额外要挂的盘符。
+
+    进度:
+        自动注入 -progress pipe:1，每个进度块通过 notify(progress, total, message) 回调；
+        stderr 只保留最后 STDERR_TAIL_KB；要完整的 stderr 传 on_stderr，截断之前逐块收到（bytes）。
     """
-    volume_mount, _ = convert_windows_path(basedir)
-    
-    # 自动转换所有 Windows 路径为容器路径
-    processed_args = [convert_any_windows_path(arg) for arg in args]
-    
-    docker_cmd = [
-        "docker", "run", "--rm",
-        "-v", volume_mount,
-        "zuozuoliang999/ffmpeg:8.1-cli"
-    ] + processed_args
-    
     try:
-        result = subprocess.run(
-            docker_cmd,
-            capture_output=True,
-            text=True,
-            timeout=300
-        )
-        
-        return {
-            "success": result.returncode == 0,
-            "output": result.stdout,
-            "error": result.stderr,
-            "command": " ".join(docker_cmd)
-        }
-    except subprocess.TimeoutExpired:
-        return {
-            "success": False,
-            "output": "",
-            "error": "Command timeout (5 minutes)",
-            "command": " ".join(docker_cmd)
-        }
-    except Exception as e:
-        return {
-            "success": False,
-            "output": "",
-            "error": str(e),
-            "command": " ".join(docker_cmd)
-        }
+        args = _preset_args(list(args), tier)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    # 自动转换所有 Windows 路径为容器路径（含滤镜里嵌入的路径和 concat 列表），顺带决定卷映射
+    processed_args, temp_files, volume_mount = translate_ffmpeg_args(args, basedir, drives)
+    try:
+        return _run_ffmpeg(args, processed_args, volume_mount, notify, worker, timeout, cancel, on_stderr)
+    finally:
+        for path in temp_files:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+def _run_ffmpeg(args, processed_args, volume_mount, notify, worker, timeout, cancel, on_stderr=None):
+    """run_ffmpeg 的执行部分，args 是用户原始参数（统计文件字节数用）"""
+    progress = None
+    if _progress_supported(processed_args):
+        progress = FFmpegProgress(notify)
+        result = _docker_run(FFMPEG_IMAGE, ["-benchmark", "-progress", "pipe:1", "-nostats"] + processed_args,
+                             volume_mount, timeout=timeout, on_stdout_line=progress.feed_line,
+                             on_stderr=_stderr_sinks(progress.feed_stderr, on_stderr), worker=worker, cancel=cancel)
+    else:
+        result = _docker_run(FFMPEG_IMAGE, ["-benchmark"] + processed_args, volume_mount, timeout=timeout,
+                             on_stderr=on_stderr, worker=worker, cancel=cancel)
+    if result.get("timeout") or result.get("cancelled"):
+        # 超时/取消时 stdout 只有半截进度块，不返回
+        result["output"] = ""
+        if result.get("timeout") and timeout == 300:
+            result["error"] = result["error"].replace("(300s)", "(5 minutes)", 1)
+    if "metrics" in result:
+        # 字节数按用户传入的 Windows 路径统计（只有盘符在本机可见时才有）
+        result["metrics"].update(_bench_metrics(result.get("error") or ""))
+        in_idx, out_idx = _ffmpeg_io_indexes(args)
+        result["metrics"]["input_bytes"] = _file_bytes([args[i] for i in in_idx])
+        result["metrics"]["output_bytes"] = _file_bytes([args[i] for i in out_idx]) if result.get("success") else 0
+    if progress is not None and progress.stats():
+        result["stats"] = progress.stats()
+    return result
+
+def ffmpeg_batch(jobs, basedir, max_parallel=None, single_container=False, notify=None, tier=None, timeout=300,
+                 cancel=None):
+    """
+    并行运行一批 FFmpeg 命令
 
-def run_imagemagick(args: str, basedir: str) -> dict:
+    官方参数:
+        jobs: FFmpeg 参数列表的列表（或 {"name", "args"} 对象）
+        basedir: 盘符根目录，所有任务共用
+
+    规则:
+        - 默认并行度 = 核数一半（每个 ffmpeg 自己也会多线程）
+        - 单个任务失败不影响其它任务，按输入顺序返回每个任务的结果和耗时
+        - single_container=True 时所有任务 docker exec 进同一个常驻 worker
+        - timeout 是每个任务的超时；cancel 后还没开始的任务不再启动
+        - 每个任务占 ffmpeg-win 的一个并发槽，和直接调用的 ffmpeg-win 共用 FFMPEG_MCP_CONCURRENCY 的上限
+    """
+    pool = worker = None
+    drives = set()
+    if single_container:
+        # 共用的 worker 要挂上所有任务用到的盘符，每个任务按同一个布局转换路径
+        for job in jobs:
+            argv = job.get("args") if isinstance(job, dict) else job
+            if isinstance(argv, list) and all(isinstance(a, str) for a in argv):
+                drives |= referenced_drives(argv)
+        volume_mount, _ = plan_mounts(basedir, drives)
+        pool = _pool_for(FFMPEG_IMAGE, _volume_opts(volume_mount), DOCKER)
+        worker = pool.acquire(wait=60)
+    try:
+        return _run_batch(jobs, max_parallel,
+                          lambda argv: run_ffmpeg(argv, basedir, worker=worker, timeout=timeout, cancel=cancel,
+                                                  drives=drives, tier=tier),
+                          notify, cancel, worker, SCHEDULER, "ffmpeg-win")
+    finally:
+        if worker is not None:
+            pool.release(worker, healthy=not worker.broken)
+
+def run_imagemagick(args, basedir: str, timeout=300, cancel=None) -> dict:
     """
     运行 ImageMagick 命令
     
     官方参数:
-        args: ImageMagick 参数字符串
+        args: ImageMagick 参数列表，或按 shell 引号规则切分的字符串（带空格的路径用引号包起来，反斜杠原样保留）
     
     路径自动转换 (固化规则):
-        自动检测并转换所有 Windows 路径，用户无需手动使用 /work/ 前缀
+        自动检测并转换所有 Windows 路径，用户无需手动使用 /work/ 前缀；
+        跨盘时与 run_ffmpeg 一样每个盘符挂到 /work/<盘符小写>
     """
-    volume_mount, _ = convert_windows_path(basedir) if basedir else ("", "")
+    try:
+        tokens = _split_args(args)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    volume_mount, multi_drive = plan_mounts(basedir, referenced_drives(tokens))
     
     # 自动检测并转换所有 Windows 路径
-    def replace_windows_paths(text: str) -> str:
-        return re.sub(
-            r'([A-Za-z]):/([^\s"\']+)',
-            lambda m: f"/work/{m.group(2)}",
-            text
-        )
-    processed_args = replace_windows_paths(args)
-    
-    docker_cmd = [
-        "docker", "run", "--rm",
-        "--entrypoint", "magick",
-    ]
+    processed_args = [_container_arg(arg, basedir, multi_drive) for arg in tokens]
     
-    if volume_mount:
-        docker_cmd.extend(["-v", volume_mount])
-    
-    docker_cmd.append("zuozuoliang999/imagemagick:latest")
-    docker_cmd.extend(processed_args.split())
-    
-    try:
-        result = subprocess.run(
-            docker_cmd,
-            capture_output=True,
-            text=True,
-            timeout=300
-        )
-        
-        # 合并 stdout 和 stderr（ImageMagick 有时输出到 stderr）
-        combined_output = result.stdout + result.stderr
-        return {
-            "success": result.returncode == 0,
-            "output": combined_output.strip() if combined_output else "(no output)",
-            "command": " ".join(docker_cmd)
-        }
-    except Exception as e:
-        return {
+    result = _docker_run(IMAGEMAGICK_IMAGE, processed_args, volume_mount,
+                         entrypoint="magick", timeout=timeout, cancel=cancel)
+    if result.get("timeout") or result.get("cancelled") or "metrics" not in result:
+        failed = {
             "success": False,
             "output": "",
-            "error": str(e),
-            "command": " ".join(docker_cmd)
+            "error": _failure(result),
+            "command": result["command"],
+            "runner": result["runner"]
         }
+        for flag in ("timeout", "cancelled"):
+            if result.get(flag):
+                failed[flag] = True
+        return failed
+
+    # 合并 stdout 和 stderr（ImageMagick 有时输出到 stderr）
+    combined_output = result["output"] + result.pop("error")
+    result["output"] = combined_output.strip() if combined_output else "(no output)"
+    result["metrics"]["input_bytes"] = _file_bytes([t for t in tokens[:-1] if not t.startswith(("-", "+"))])
+    result["metrics"]["output_bytes"] = _file_bytes(tokens[-1:]) if result["success"] else 0
+    return result
+
+def pipeline(steps, basedir, timeout=3600, notify=None, cancel=None):
+    """
+    几步 ffmpeg / magick 用 OS 管道串起来跑，中间的帧（image2pipe / rawvideo）不落到盘上
+
+    每步的 Windows 路径和 ffmpeg-win / imagemagick-win 一样转换，各自决定卷映射；其余见 mcp_common._run_pipeline。
+
+    Returns:
+        dict: 每步的退出码/耗时/stderr 尾部，每条管道的字节数、吞吐和两头的等待时间，
+              以及估计的瓶颈步（它的输入管道等它收、输出管道等它吐的时间最长）
+    """
+    try:
+        steps = _pipeline_steps(steps, "ffmpeg-win / imagemagick-win")
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    parsed, temp_files = [], []
+    try:
+        for tool, image, binary, argv in steps:
+            if tool == "ffmpeg":
+                container_args, temps, volume_mount = translate_ffmpeg_args(argv, basedir)
+                temp_files += temps
+            else:
+                volume_mount, multi_drive = plan_mounts(basedir, referenced_drives(argv))
+                container_args = [_container_arg(a, basedir, multi_drive) for a in argv]
+            parsed.append((tool, image, binary, container_args, _volume_opts(volume_mount)))
+        return _run_pipeline(DOCKER, parsed, timeout, notify, cancel)
+    finally:
+        for path in temp_files:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+def _native_stat_enabled(path):
+    """
+    判断能否在本进程直接 os.stat 这个路径
+
+    MCP server 跑在 Docker 里时看不到 D:/ 之类的宿主盘符，只能起 busybox 容器检查；
+    直接在 Windows 上运行时盘符可见，os.stat 只要微秒级。
+    """
+    if NATIVE_STAT in ("0", "false", "no", "off"):
+        return False
+    match = _DRIVE_RE.match(path)
+    if not match:
+        return False
+    return NATIVE_STAT != "auto" or os.path.isdir(f"{match.group(1)}:/")
+
+def _failure(run):
+    """_docker_run 失败的原因：超时/取消只报原因，其余是 stderr"""
+    if run.get("timeout") or run.get("cancelled"):
+        return run["error"].split("\n", 1)[0]
+    return run["error"].strip()
+
+def _container_stat(paths, basedir):
+    """
+    在一个 busybox 容器里批量检查同一盘符下的多个路径
+
+    Returns:
+        tuple: (entries, command)
+    """
+    volume_mount, _ = convert_windows_path(basedir) if basedir else ("", "")
+    check_paths = [convert_any_windows_path(p) for p in paths]
+    run = _docker_run(BUSYBOX_IMAGE, ["sh", "-c", _STAT_SCRIPT, "sh"] + check_paths, volume_mount, timeout=30)
+    lines = run["output"].splitlines() if run["success"] else []
+    entries = []
+    for i, (path, check_path) in enumerate(zip(paths, check_paths)):
+        size, _, mtime = (lines[i] if i < len(lines) else "-").partition(" ")
+        entry = {"path": path, "exists": False, "container_path": check_path}
+        if size.isdigit() and mtime.isdigit():
+            entry.update({"exists": True, "size": int(size), "mtime": float(mtime)})
+        elif run.get("timeout") or "metrics" not in run:
+            entry["error"] = _failure(run)
+        entries.append(entry)
+    return entries, run["command"]
+
+def _drive_root(path):
+    """从路径中提取盘符根目录 (D:/)，没有盘符返回空串"""
+    match = _DRIVE_RE.search(path)
+    return f"{match.group(1)}:/" if match else ""
+
+def stat_paths(paths):
+    """
+    批量检查文件，返回每个路径的 exists/size/mtime
+
+    本地可见的盘符直接 os.stat；其余按盘符分组，每个盘符只起一个 busybox 容器。
+    """
+    entries = [None] * len(paths)
+    by_drive = {}
+    for i, path in enumerate(paths):
+        if _native_stat_enabled(path):
+            entries[i] = _local_stat(path)
+        else:
+            by_drive.setdefault(_drive_root(path), []).append(i)
+
+    commands = []
+    for basedir, indexes in by_drive.items():
+        drive_entries, command = _container_stat([paths[i] for i in indexes], basedir)
+        commands.append(command)
+        for i, entry in zip(indexes, drive_entries):
+            entries[i] = entry
+
+    remote = sum(len(indexes) for indexes in by_drive.values())
+    method = "stat" if not remote else ("container" if remote == len(paths) else "mixed")
+    result = {"method": method, "results": entries}
+    if commands:
+        result["commands"] = commands
+    return result
 
 def file_exists(path: str, basedir: str = "") -> dict:
     """
@@ -228,43 +636,222 @@ def file_exists(path: str, basedir: str = "") -> dict:
     
     路径自动转换 (固化规则):
         D:/any/path/file.mp4 -> /work/any/path/file.mp4
+
+    盘符在本机可见时直接 os.stat，不起容器。
+    """
+    if _native_stat_enabled(path):
+        entry = _local_stat(path)
+        entry["method"] = "stat"
+        return entry
+
+    entries, command = _container_stat([path], basedir)
+    entry = entries[0]
+    entry["method"] = "container"
+    entry["command"] = command
+    return entry
+
+PROBE_CACHE = ProbeCache(PROBE_CACHE_DIR)
+
+def _probe_one(path, keyframes):
     """
+    probe 单个文件
+
+    路径自动转换 (固化规则):
+        D:/any/path/file.mp4 -> 挂载 D:/:/work，容器内 /work/any/path/file.mp4
+    """
+    st = None
+    entry = None
+    if _native_stat_enabled(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {"path": path, "error": "No such file"}
+        entry = PROBE_CACHE.get(path, st)
+        if entry is not None and (not keyframes or "keyframes" in entry):
+            return dict(entry, path=path, cached=True)
+
+    basedir = _drive_root(path)
     volume_mount, _ = convert_windows_path(basedir) if basedir else ("", "")
-    
-    # 处理路径 - 自动转换 Windows 路径
-    check_path = convert_any_windows_path(path)
-    
-    docker_cmd = ["docker", "run", "--rm"]
-    
-    if volume_mount:
-        docker_cmd.extend(["-v", volume_mount])
-    
-    docker_cmd.extend([
-        "zuozuoliang999/busybox:latest",
-        "test", "-f", check_path
-    ])
-    
-    try:
-        result = subprocess.run(
-            docker_cmd,
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        return {
-            "exists": result.returncode == 0,
-            "path": path,
-            "container_path": check_path,
-            "command": " ".join(docker_cmd)
-        }
-    except Exception as e:
-        return {
-            "exists": False,
-            "path": path,
-            "error": str(e),
-            "command": " ".join(docker_cmd)
+    container_path = convert_any_windows_path(path)
+
+    if entry is None:
+        run = _docker_run(FFMPEG_IMAGE, _PROBE_ARGS + [container_path], volume_mount,
+                          entrypoint="ffprobe", timeout=120)
+        if not run["success"]:
+            return {"path": path, "error": _failure(run) or "ffprobe failed",
+                    "command": run["command"]}
+        try:
+            data = json.loads(run["output"] or "{}")
+        except ValueError:
+            return {"path": path, "error": "unparseable ffprobe output", "command": run["command"]}
+        fmt = data.get("format", {})
+        try:
+            duration = float(fmt.get("duration"))
+        except (TypeError, ValueError):
+            duration = None
+        entry = {"format": fmt, "streams": data.get("streams", []), "duration": duration}
+
+    if keyframes and "keyframes" not in entry:
+        run = _docker_run(FFMPEG_IMAGE, _KEYFRAME_ARGS + [container_path], volume_mount,
+                          entrypoint="ffprobe", timeout=300)
+        if not run["success"]:
+            return {"path": path, "error": _failure(run) or "keyframe scan failed",
+                    "command": run["command"]}
+        times = []
+        for line in run["output"].splitlines():
+            pts, _, flags = line.partition(",")
+            if "K" in flags:
+                with contextlib.suppress(ValueError):
+                    times.append(float(pts))
+        entry = dict(entry, keyframes=sorted(times))
+
+    if st is not None:
+        PROBE_CACHE.put(path, st, entry)
+    return dict(entry, path=path, cached=False)
+
+def probe(paths, keyframes=False):
+    """
+    批量 probe 媒体文件，返回 streams / format / duration（可选关键帧时间戳）
+
+    一次最多 4 个 ffprobe 并行，结果按输入顺序返回。
+    """
+    results = [None] * len(paths)
+
+    def work(i):
+        results[i] = _probe_one(paths[i], keyframes)
+
+    threads = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(len(paths))]
+    for batch in range(0, len(threads), 4):
+        for t in threads[batch:batch + 4]:
+            t.start()
+        for t in threads[batch:batch + 4]:
+            t.join()
+    return {"results": results}
+
+def extract_frames(input_path, output_dir, timestamps=None, count=None, scene=None, max_frames=100,
+                   width=None, fmt="jpg", contact_sheet=None, notify=None):
+    """
+    一次 ffmpeg 抽出多张预览帧，替代每个时间点各调一次 ffmpeg-win
+
+    三选一:
+        timestamps: 指定时间点（秒）
+        count: 均匀取 N 张（先 probe 时长）
+        scene: 场景切换阈值（0-1，select 滤镜整条扫描）
+    contact_sheet: true 或 {"output", "columns", "width"}，把抽出的帧拼成一张接触表
+    """
+    out_dir = output_dir.replace("\\", "/").rstrip("/")
+    basedir = _drive_root(input_path) or _drive_root(out_dir)
+    if not _drive_root(out_dir):
+        return {"success": False, "error": f"output_dir must be a Windows path such as D:/previews: {output_dir!r}"}
+    if sum(x is not None for x in (timestamps, count, scene)) != 1:
+        return {"success": False, "error": "pass exactly one of timestamps, count, scene"}
+    fmt = fmt.lstrip(".").lower() or "jpg"
+    max_frames = max(1, int(max_frames))
+
+    sheet = None
+    if contact_sheet:
+        spec = contact_sheet if isinstance(contact_sheet, dict) else {}
+        sheet = {
+            "output": spec.get("output") or f"{out_dir}/contact_sheet.{fmt}",
+            "columns": max(1, int(spec.get("columns", 5))),
+            "width": max(16, int(spec.get("width", 320)))
         }
+    if _native_stat_enabled(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    started = time.monotonic()
+    if scene is None:
+        if count is not None:
+            info = _probe_one(input_path, False)
+            if "error" in info:
+                return {"success": False, "error": f"probe failed: {info['error']}"}
+            duration = info.get("duration")
+            if not duration:
+                return {"success": False, "error": "input has no duration; pass timestamps instead"}
+            n = max(1, min(int(count), max_frames))
+            # 取每一份的中点，避开片头黑场和片尾
+            timestamps = [duration * (i + 0.5) / n for i in range(n)]
+        try:
+            times = [max(0.0, float(t)) for t in timestamps][:max_frames]
+        except (TypeError, ValueError):
+            return {"success": False, "error": "timestamps must be numbers (seconds)"}
+        if not times:
+            return {"success": False, "error": "timestamps must not be empty"}
+        paths = [f"{out_dir}/frame_{i + 1:03d}.{fmt}" for i in range(len(times))]
+        if sheet is not None:
+            sheet["rows"] = -(-len(times) // sheet["columns"])
+        result = run_ffmpeg(build_frame_grab(input_path, times, paths, width, sheet), basedir, notify)
+        frames = [{"path": p, "time": round(t, 3)} for p, t in zip(paths, times)]
+    else:
+        # 场景切换要看相邻帧差异，只能整条解码；showinfo 打出被选中帧的时间，从 stderr 流里逐行收
+        chain = f"select='gt(scene,{float(scene)})',showinfo"
+        if width:
+            chain += f",scale={int(width)}:-2"
+        # 每次调用一个新前缀：不碰目录里已有的文件，也不会把上一次的帧算进来
+        prefix = f"scene_{uuid.uuid4().hex[:8]}"
+        pattern = f"{out_dir}/{prefix}_%03d.{fmt}"
+        showinfo = ShowinfoTimes()
+        result = run_ffmpeg(["-y", "-i", input_path, "-vf", chain, "-fps_mode", "vfr",
+                             "-frames:v", str(max_frames), pattern], basedir, notify, on_stderr=showinfo.feed)
+        times = showinfo.times()
+        if _native_stat_enabled(out_dir):
+            files = sorted(f.replace("\\", "/") for f in glob.glob(f"{glob.escape(out_dir)}/{prefix}_*.{fmt}"))
+        else:
+            files = [pattern % (i + 1) for i in range(len(times))]
+        frames = [{"path": p, "time": round(t, 3) if t is not None else None}
+                  for p, t in zip(files, times + [None] * (len(files) - len(times)))]
+        if result.get("success") and sheet is not None and files:
+            sheet["rows"] = -(-len(files) // sheet["columns"])
+            tiled = run_ffmpeg(["-y", "-i", pattern, "-vf",
+                                f"scale={sheet['width']}:-2,tile={sheet['columns']}x{sheet['rows']}:padding=4:margin=4",
+                                "-frames:v", "1", "-update", "1", sheet["output"]], basedir)
+            if not tiled.get("success"):
+                result = tiled
+
+    report = {
+        "success": result.get("success", False),
+        "elapsed": round(time.monotonic() - started, 3),
+        "command": result.get("command"),
+        "runner": result.get("runner")
+    }
+    if not report["success"]:
+        report["error"] = result.get("error", "")
+        return report
+    report["frames"] = frames
+    if sheet is not None and frames:
+        report["contact_sheet"] = sheet["output"]
+    return report
+
+def smart_trim(input_path, output, ranges, crf=None, audio_args=None, max_parallel=None, timeout=3600, notify=None,
+               cancel=None):
+    """
+    帧精确剪辑：只重编码切点所在的不完整 GOP，中间 stream copy，concat demuxer 拼回去（见 mcp_common._smart_cut）
+
+    规则:
+        - 多个区间按顺序拼成一个输出（集锦）
+        - 视频片段和音频（每个区间精确切，整条编码一次）用 ffmpeg_batch 并行跑
+        - 源视频需要是 h264 / hevc，边界片段用同编码器、同像素格式和 profile 重编码
+        - 中间文件放在输出目录下的 .trim-xxxx 里，用完删除，所以输出盘符要对 server 可见
+        - timeout 是每个片段和最后拼接各自的超时
+    """
+    output = output.replace("\\", "/")
+    basedir = _drive_root(output)
+    if not _drive_root(input_path) or not basedir:
+        return {"success": False, "error": "input and output must be Windows paths such as D:/videos/clip.mp4"}
+    if not _native_stat_enabled(output):
+        return {"success": False, "error": f"{basedir} is not visible to the server; trim-win needs to write its pieces there"}
+    if os.path.normcase(os.path.abspath(input_path)) == os.path.normcase(os.path.abspath(output)):
+        return {"success": False, "error": "output must differ from input"}
+    # 拼接列表里写 Windows 路径，run_ffmpeg 会生成翻译成容器路径的副本
+    return _smart_cut(
+        input_path, output, ranges, crf, audio_args,
+        f"{os.path.dirname(output) or basedir.rstrip('/')}/.trim-{uuid.uuid4().hex[:12]}",
+        lambda path: _probe_one(path, True),
+        lambda jobs: ffmpeg_batch(jobs, basedir, max_parallel, notify=notify, timeout=timeout, cancel=cancel),
+        lambda argv: run_ffmpeg(argv, basedir, timeout=timeout, cancel=cancel),
+        cancel,
+        "ffmpeg-win"
+    )
 
 # 工具定义 - Windows 兼容版（重命名避免与 mcp-docker 冲突）
 # ⚠️ 强制规则（已固化到代码）: basedir 必须使用盘符根目录 (D:/, E:/)
@@ -272,7 +859,7 @@ def file_exists(path: str, basedir: str = "") -> dict:
 TOOLS = [
     {
         "name": "ffmpeg-win",
-        "description": "Run FFmpeg command with AUTO Windows path conversion. Paths like D:/path/file.mp4 are automatically converted to /work/path/file.mp4. ⚠️ IMPORTANT: basedir MUST be drive root (D:/, E:/), NOT subdirectory. Subdirectories are auto-corrected with warning.",
+        "description": "Run FFmpeg command with AUTO Windows path conversion. Paths like D:/path/file.mp4 are automatically converted to /work/path/file.mp4; when args reference several drives (e.g. read E:/ and write D:/), each drive is mounted at /work/<letter> in the same container. Progress is streamed as notifications/progress when the request carries a progressToken. ⚠️ IMPORTANT: basedir MUST be drive root (D:/, E:/), NOT subdirectory. Subdirectories are auto-corrected with warning.",
         "inputSchema": {
             "type": "object",
             "properties": {
@@ -284,11 +871,60 @@ TOOLS = [
                 "basedir": {
                     "type": "string",
                     "description": "⚠️ MUST BE DRIVE ROOT: D:/, E:/, C:/ etc. Do NOT use subdirectories! Example: Use 'D:/' not 'D:/videos'"
+                },
+                "tier": {
+                    "type": "string",
+                    "enum": ["latency", "balanced", "quality"],
+                    "description": "Speed/quality tier for CPU encoders (libx264, libx265, libsvtav1): picks -preset (veryfast / medium / slow) unless args already set one. Server default applies if omitted"
                 }
             },
             "required": ["basedir", "args"]
         }
     },
+    {
+        "name": "ffmpeg-batch-win",
+        "description": "Run many independent FFmpeg jobs in one call, in parallel up to a CPU-aware limit, with AUTO Windows path conversion. A failing job does not abort the others; per-job success, timing and errors are returned. Ideal for platform exports of one source. ⚠️ IMPORTANT: basedir MUST be drive root (D:/, E:/).",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "jobs": {
+                    "type": "array",
+                    "items": {
+                        "oneOf": [
+                            {"type": "array", "items": {"type": "string"}},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "args": {"type": "array", "items": {"type": "string"}}
+                                },
+                                "required": ["args"]
+                            }
+                        ]
+                    },
+                    "description": "FFmpeg argument lists (or {name, args} objects). Windows paths are auto-converted."
+                },
+                "basedir": {
+                    "type": "string",
+                    "description": "⚠️ MUST BE DRIVE ROOT: D:/, E:/, C:/ etc. Shared by all jobs."
+                },
+                "max_parallel": {
+                    "type": "integer",
+                    "description": "Upper bound on jobs running at once (default: half the CPU cores)"
+                },
+                "single_container": {
+                    "type": "boolean",
+                    "description": "Run every job inside one warm worker container instead of one container per job"
+                },
+                "tier": {
+                    "type": "string",
+                    "enum": ["latency", "balanced", "quality"],
+                    "description": "Speed/quality tier applied to every job (see ffmpeg-win)"
+                }
+            },
+            "required": ["basedir", "jobs"]
+        }
+    },
     {
         "name": "imagemagick-win",
         "description": "Run ImageMagick command with AUTO Windows path conversion. Paths like D:/path/file.jpg are automatically converted. ⚠️ IMPORTANT: basedir MUST be drive root (D:/, E:/), NOT subdirectory.",
@@ -296,8 +932,8 @@ TOOLS = [
             "type": "object",
             "properties": {
                 "args": {
-                    "type": "string",
-                    "description": "The arguments to pass to imagemagick. Windows paths are auto-converted"
+                    "oneOf": [{"type": "array", "items": {"type": "string"}}, {"type": "string"}],
+                    "description": "The arguments to pass to imagemagick: an argv list (preferred), or one string split with shell quoting rules (quote paths that contain spaces; backslashes are kept). Windows paths are auto-converted"
                 },
                 "basedir": {
                     "type": "string",
@@ -307,22 +943,314 @@ TOOLS = [
             "required": ["args"]
         }
     },
+    {
+        "name": "probe-win",
+        "description": "Probe media files with ffprobe and return structured JSON (streams, format, duration, optional keyframe timestamps) with AUTO Windows path conversion. Accepts many files per call, possibly across drives; results are cached by path+size+mtime. Use this instead of `ffmpeg -i` to inspect media.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "path": {
+                    "type": "string",
+                    "description": "Full file path (e.g. D:/videos/input.mp4)"
+                },
+                "paths": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Batch mode: full file paths. Results come back in the same order."
+                },
+                "keyframes": {
+                    "type": "boolean",
+                    "description": "Also return the keyframe timestamps (seconds) of the first video stream"
+                }
+            }
+        }
+    },
+    {
+        "name": "trim-win",
+        "description": "Frame-accurate cut at near stream-copy speed (smart cut). Probes keyframes, re-encodes only the partial GOPs at each cut point, stream-copies everything in between and joins the pieces with the concat demuxer. Pass several `ranges` to build a highlight reel: they are joined in order into one output. Audio is cut exactly per range and encoded once (AAC 192k unless `audio_args`). Source video must be h264 or hevc. Use instead of `-ss/-to -c copy` (drops frames at non-keyframe cuts) or a full re-encode. Windows paths are auto-converted; the output drive must be visible to the server.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {
+                    "type": "string",
+                    "description": "Source video, e.g. D:/videos/match.mp4"
+                },
+                "output": {
+                    "type": "string",
+                    "description": "Output file, e.g. D:/videos/highlights.mp4"
+                },
+                "ranges": {
+                    "type": "array",
+                    "items": {
+                        "oneOf": [
+                            {"type": "array", "items": {"type": "number"}, "minItems": 1, "maxItems": 2},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "start": {"type": "number", "description": "Seconds"},
+                                    "end": {"type": "number", "description": "Seconds; omit for end of file"}
+                                }
+                            }
+                        ]
+                    },
+                    "description": "Cut ranges in seconds, e.g. [[12.5, 30], {\"start\": 95, \"end\": 110.04}]"
+                },
+                "crf": {
+                    "type": "integer",
+                    "description": "CRF for the re-encoded boundary pieces (default 18)"
+                },
+                "audio_args": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Audio codec options (default ['-c:a', 'aac', '-b:a', '192k'])"
+                },
+                "max_parallel": {
+                    "type": "integer",
+                    "description": "Pieces encoded at once"
+                },
+                "timeout": {
+                    "type": "integer",
+                    "description": "Seconds each piece and the final join may take (default 3600)"
+                }
+            },
+            "required": ["input", "output", "ranges"]
+        }
+    },
+    {
+        "name": "pipeline-win",
+        "description": "Chain ffmpeg and ImageMagick steps with OS pipes so intermediate frames never touch the disk (e.g. ffmpeg frame dump -> magick edit -> ffmpeg encode). Each step runs in its own container; step N's stdout feeds step N+1's stdin with backpressure. Producers write to stdout (ffmpeg: `-f image2pipe -c:v ppm pipe:1` or `-f rawvideo -pix_fmt rgb24 pipe:1`; magick: `ppm:-`), consumers read stdin (ffmpeg: `-f image2pipe -framerate 30 -i pipe:0`; magick: `ppm:-`). ImageMagick reads its whole input before writing, so keep magick steps to short sequences. Windows paths in every step are auto-converted. Reports per-step exit code and stderr tail, per-link bytes, MB/s and wait times, and the bottleneck step.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "basedir": {
+                    "type": "string",
+                    "description": "⚠️ MUST BE DRIVE ROOT: D:/, E:/, C:/ etc. Shared by all steps"
+                },
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "tool": {"type": "string", "enum": ["ffmpeg", "imagemagick"]},
+                            "args": {
+                                "oneOf": [{"type": "array", "items": {"type": "string"}}, {"type": "string"}],
+                                "description": "ffmpeg / magick argv (a string is split with shell quoting rules for imagemagick)"
+                            }
+                        },
+                        "required": ["tool", "args"]
+                    },
+                    "description": "Two or more steps, in pipe order"
+                },
+                "timeout": {
+                    "type": "integer",
+                    "description": "Seconds before every step is killed (default 3600)"
+                }
+            },
+            "required": ["basedir", "steps"]
+        }
+    },
+    {
+        "name": "extract-frames-win",
+        "description": "Extract many preview frames from a video in ONE ffmpeg process (instead of one ffmpeg-win call per timestamp), optionally tiled into a contact sheet. Choose exactly one of `timestamps` (seconds), `count` (N evenly spaced frames) or `scene` (scene-change threshold 0-1, scans the whole video). Frames are written as frame_001.jpg ... (scene_<random>_001.jpg ... in scene mode, a fresh prefix per call) into output_dir; the response lists each frame path with its timestamp. Windows paths are auto-converted.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {
+                    "type": "string",
+                    "description": "Source video (e.g. D:/videos/input.mp4)"
+                },
+                "output_dir": {
+                    "type": "string",
+                    "description": "Directory for the frames (e.g. D:/videos/previews)"
+                },
+                "timestamps": {
+                    "type": "array",
+                    "items": {"type": "number"},
+                    "description": "Frame times in seconds"
+                },
+                "count": {
+                    "type": "integer",
+                    "description": "Number of evenly spaced frames"
+                },
+                "scene": {
+                    "type": "number",
+                    "description": "Scene-change threshold, e.g. 0.3"
+                },
+                "max_frames": {
+                    "type": "integer",
+                    "description": "Upper bound on frames written (default 100)"
+                },
+                "width": {
+                    "type": "integer",
+                    "description": "Scale frames to this width (keeps aspect)"
+                },
+                "format": {
+                    "type": "string",
+                    "description": "Image format/extension: jpg (default), png, webp"
+                },
+                "contact_sheet": {
+                    "description": "true, or {output, columns (default 5), width (default 320)}: also tile the frames into one image"
+                }
+            },
+            "required": ["input", "output_dir"]
+        }
+    },
+    {
+        "name": "job-submit-win",
+        "description": f"Start a long ffmpeg-win/imagemagick-win/ffmpeg-batch-win/trim-win/pipeline-win run in the background and return a job_id immediately. Poll with job-status-win, stop with job-cancel-win (kills the container), fetch output with job-result-win. Jobs get their own timeout (default {JOB_TIMEOUT}s) instead of the 5-minute limit of the direct tools.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "tool": {
+                    "type": "string",
+                    "enum": ["ffmpeg-win", "imagemagick-win", "ffmpeg-batch-win", "trim-win", "pipeline-win"]
+                },
+                "arguments": {
+                    "type": "object",
+                    "description": "Same arguments the tool takes when called directly (args, basedir)"
+                },
+                "timeout": {
+                    "type": "integer",
+                    "description": "Seconds before the job is killed"
+                }
+            },
+            "required": ["tool", "arguments"]
+        }
+    },
+    {
+        "name": "job-status-win",
+        "description": "Status, elapsed time, progress and recent log lines of a background job; all jobs when job_id is omitted.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "job_id": {"type": "string"}
+            }
+        }
+    },
+    {
+        "name": "job-cancel-win",
+        "description": "Cancel a queued or running background job; the container doing the work is removed.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "job_id": {"type": "string"}
+            },
+            "required": ["job_id"]
+        }
+    },
+    {
+        "name": "job-result-win",
+        "description": "Full result (output, stderr tail, stats) and log of a finished background job.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "job_id": {"type": "string"}
+            },
+            "required": ["job_id"]
+        }
+    },
+    {
+        "name": "server-stats-win",
+        "description": "Per-tool call counts, errors, warm/cold runner split, phase timings (queue, acquire, start, run, teardown, total), CPU seconds, peak RSS and bytes read/written since the server started.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "format": {
+                    "type": "string",
+                    "enum": ["json", "prometheus"],
+                    "description": "prometheus also returns the text exposition format"
+                }
+            }
+        }
+    },
+    {
+        "name": "server-status-win",
+        "description": "Readiness of the docker images checked at startup (present / pulling / missing, pull and check time) and the warm worker pools (idle, busy, starting). Call it after deploying to see whether the first real job will hit a cold image.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {}
+        }
+    },
     {
         "name": "file-exists-win",
-        "description": "Check if a file exists with AUTO Windows path conversion. ⚠️ IMPORTANT: Drive letter is auto-extracted and forced to root (D:/, E:/).",
+        "description": "Check if files exist with AUTO Windows path conversion, returning size/mtime for each. Pass `path` for one file or `paths` to check many in one call. ⚠️ IMPORTANT: Drive letter is auto-extracted and forced to root (D:/, E:/).",
         "inputSchema": {
             "type": "object",
             "properties": {
                 "path": {
                     "type": "string",
                     "description": "Full file path (e.g. D:/jianji_FFMPEG/video.mp4). Drive root (D:/) is auto-extracted and normalized."
+                },
+                "paths": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Batch mode: full file paths (may span drives). Results come back in the same order."
                 }
-            },
-            "required": ["path"]
+            }
         }
     }
 ]
 
+SCHEDULER = JobScheduler(_parse_concurrency(os.environ.get("FFMPEG_MCP_CONCURRENCY", ""), DEFAULT_CONCURRENCY))
+
+def _imagemagick_basedir(arguments):
+    """优先使用显式传入的 basedir，否则从 args 中提取 Windows 路径并强制使用盘符根目录"""
+    args = arguments.get("args", "")
+    return arguments.get("basedir", "") or _drive_root(args if isinstance(args, str) else " ".join(map(str, args)))
+
+def _ffmpeg_batch_call(a, notify=None, timeout=300, cancel=None):
+    return ffmpeg_batch(
+        list(a.get("jobs") or []),
+        a.get("basedir", ""),
+        a.get("max_parallel"),
+        bool(a.get("single_container")),
+        notify,
+        a.get("tier"),
+        timeout,
+        cancel
+    )
+
+def _trim_call(a, notify=None, timeout=3600, cancel=None):
+    return smart_trim(
+        a.get("input", ""),
+        a.get("output", ""),
+        list(a.get("ranges") or []),
+        a.get("crf"),
+        a.get("audio_args"),
+        a.get("max_parallel"),
+        int(a.get("timeout") or timeout),
+        notify,
+        cancel
+    )
+
+# 可以放到后台跑的工具：(arguments, notify, timeout, cancel) -> result
+_JOB_TOOLS = {
+    "ffmpeg-win": lambda a, notify, timeout, cancel: run_ffmpeg(
+        a.get("args", []), a.get("basedir", ""), notify, timeout=timeout, cancel=cancel, tier=a.get("tier")),
+    "imagemagick-win": lambda a, notify, timeout, cancel: run_imagemagick(
+        a.get("args", ""), _imagemagick_basedir(a), timeout=timeout, cancel=cancel),
+    "ffmpeg-batch-win": _ffmpeg_batch_call,
+    "trim-win": _trim_call,
+    "pipeline-win": lambda a, notify, timeout, cancel: pipeline(
+        list(a.get("steps") or []), a.get("basedir", ""), int(a.get("timeout") or timeout), notify, cancel)
+}
+
+JOBS = JobTable(_JOB_TOOLS, SCHEDULER)
+atexit.register(JOBS.shutdown)
+
+def _run_tool(tool_name, call):
+    """在工具的并发槽里执行 call()，记录排队时间并汇总到 METRICS"""
+    queued = time.monotonic()
+    with SCHEDULER.slot(tool_name):
+        queue = time.monotonic() - queued
+        result = call()
+    if isinstance(result, dict) and "metrics" in result:
+        result["metrics"] = dict(queue_s=round(queue, 4), **result["metrics"])
+    METRICS.observe(tool_name, result, time.monotonic() - queued, queue)
+    if METRICS_FILE:
+        METRICS.write_file(METRICS_FILE)
+    return result
+
 def handle_request(request: dict):
     """处理 MCP 请求"""
     method = request.get("method")
@@ -330,6 +1258,7 @@ def handle_request(request: dict):
     params = request.get("params", {})
     
     if method == "initialize":
+        DOCKER.preflight.start()
         send_result(id, {
             "protocolVersion": "2024-11-05",
             "capabilities": {
@@ -351,30 +1280,87 @@ def handle_request(request: dict):
         if tool_name == "ffmpeg-win":
             basedir = arguments.get("basedir", "")
             args = arguments.get("args", [])
-            result = run_ffmpeg(args, basedir)
-            send_result(id, {"content": [{"type": "text", "text": json.dumps(result, indent=2, ensure_ascii=False)}]})
+            notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+            result = _run_tool(tool_name, lambda: run_ffmpeg(args, basedir, notify, tier=arguments.get("tier")))
+            send_tool_result(id, result)
+        
+        elif tool_name == "ffmpeg-batch-win":
+            notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+            result = _run_tool(tool_name, lambda: _ffmpeg_batch_call(arguments, notify))
+            send_tool_result(id, result)
         
         elif tool_name == "imagemagick-win":
             args = arguments.get("args", "")
-            # 优先使用显式传入的 basedir，否则从 args 中提取盘符根目录
-            basedir = arguments.get("basedir", "")
-            if not basedir:
-                # 从 args 中提取 Windows 路径并强制使用盘符根目录
-                match = re.search(r'([A-Za-z]):[/\\]', args)
-                if match:
-                    basedir = f"{match.group(1)}:/"
-            result = run_imagemagick(args, basedir)
-            send_result(id, {"content": [{"type": "text", "text": json.dumps(result, indent=2, ensure_ascii=False)}]})
+            result = _run_tool(tool_name, lambda: run_imagemagick(args, _imagemagick_basedir(arguments)))
+            send_tool_result(id, result)
+        
+        elif tool_name == "extract-frames-win":
+            notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+            result = _run_tool(tool_name, lambda: extract_frames(
+                arguments.get("input", ""),
+                arguments.get("output_dir", ""),
+                arguments.get("timestamps"),
+                arguments.get("count"),
+                arguments.get("scene"),
+                int(arguments.get("max_frames") or 100),
+                arguments.get("width"),
+                arguments.get("format") or "jpg",
+                arguments.get("contact_sheet"),
+                notify
+            ))
+            send_tool_result(id, result)
+        
+        elif tool_name == "trim-win":
+            notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+            result = _run_tool(tool_name, lambda: _trim_call(arguments, notify))
+            send_tool_result(id, result)
+        
+        elif tool_name == "pipeline-win":
+            notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+            result = _run_tool(tool_name, lambda: pipeline(
+                list(arguments.get("steps") or []),
+                arguments.get("basedir", ""),
+                int(arguments.get("timeout") or 3600),
+                notify
+            ))
+            send_tool_result(id, result)
+        
+        elif tool_name == "probe-win":
+            paths = list(arguments.get("paths") or []) if "paths" in arguments else [arguments.get("path", "")]
+            result = _run_tool(tool_name, lambda: probe(paths, bool(arguments.get("keyframes"))))
+            send_tool_result(id, result)
+        
+        elif tool_name in ("job-submit-win", "job-status-win", "job-cancel-win", "job-result-win"):
+            if tool_name == "job-submit-win":
+                result = JOBS.tool_submit(arguments.get("tool", ""), arguments.get("arguments") or {}, arguments.get("timeout"))
+            elif tool_name == "job-status-win":
+                result = JOBS.tool_status(arguments.get("job_id"))
+            elif tool_name == "job-cancel-win":
+                result = JOBS.tool_cancel(arguments.get("job_id", ""))
+            else:
+                result = JOBS.tool_result(arguments.get("job_id", ""))
+            send_tool_result(id, result)
+        
+        elif tool_name == "server-stats-win":
+            result = dict(METRICS.snapshot(), success=True)
+            if arguments.get("format") == "prometheus":
+                result["prometheus"] = METRICS.prometheus()
+            send_tool_result(id, result)
+        
+        elif tool_name == "server-status-win":
+            result = dict(DOCKER.preflight.status(), success=True)
+            send_tool_result(id, result)
+        
+        elif tool_name == "file-exists-win" and "paths" in arguments:
+            result = _run_tool(tool_name, lambda: stat_paths(list(arguments.get("paths") or [])))
+            send_tool_result(id, result)
         
         elif tool_name == "file-exists-win":
             path = arguments.get("path", "")
             # 从 path 中提取盘符并强制使用根目录
-            basedir = ""
-            match = re.search(r'([A-Za-z]):[/\\]', path)
-            if match:
-                basedir = f"{match.group(1)}:/"
-            result = file_exists(path, basedir)
-            send_result(id, {"content": [{"type": "text", "text": json.dumps(result, indent=2, ensure_ascii=False)}]})
+            basedir = _drive_root(path)
+            result = _run_tool(tool_name, lambda: file_exists(path, basedir))
+            send_tool_result(id, result)
         
         else:
             send_error(id, -32601, f"Unknown tool: {tool_name}")
@@ -385,17 +1371,37 @@ def handle_request(request: dict):
     else:
         send_error(id, -32601, f"Method not found: {method}")
 
+def _handle_safely(request):
+    """执行单个请求，异常记日志并回 -32603，避免客户端一直等"""
+    try:
+        handle_request(request)
+    except Exception as e:
+        sys.stderr.write(f"Error: {e}\n")
+        sys.stderr.flush()
+        if request.get("id") is not None:
+            send_error(request.get("id"), -32603, f"Internal error: {e}")
+
 def main():
-    """主循环"""
+    """
+    主循环
+
+    tools/call 每个请求一个线程并发执行（最多 MAX_INFLIGHT 个，满了直接回 busy），响应按 id 乱序返回；
+    其余方法都很轻，直接在读循环里处理。
+    """
+    if METRICS_PORT:
+        _serve_metrics(METRICS_PORT)
+    gate = CallGate(MAX_INFLIGHT)
     for line in sys.stdin:
         try:
             request = json.loads(line.strip())
-            handle_request(request)
         except json.JSONDecodeError:
             continue
-        except Exception as e:
-            sys.stderr.write(f"Error: {e}\n")
-            sys.stderr.flush()
+        if request.get("method") == "tools/call":
+            gate.start(request, _handle_safely)
+        else:
+            _handle_safely(request)
+    # stdin 关闭后等在跑的任务把响应写完再退出
+    gate.join()
 
 if __name__ == "__main__":
     main()
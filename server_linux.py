@@ -13,64 +13,1678 @@ FFmpeg MCP Server - Linux 云端版 v2.0.0
 - 工具名为 ffmpeg / imagemagick / file_exists (不含 -win 后缀)
 """
 
-import subprocess
+import atexit
+import bisect
+import contextlib
+import errno
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import shlex
+import shutil
+import stat
 import json
 import sys
+import threading
+import time
+import uuid
+
+from mcp_common import (
+    BUSYBOX_IMAGE, CallGate, CancelToken, DOCKER_SOCKET, DockerHost, FFMPEG_IMAGE, FFmpegProgress, IMAGEMAGICK_IMAGE,
+    JOB_TIMEOUT, JobScheduler, JobTable, MAX_INFLIGHT, METRICS, METRICS_FILE, METRICS_PORT, ProbeCache, ShowinfoTimes,
+    _DOCKER_HOST, _KEYFRAME_ARGS, _POOLS, _POOLS_LOCK, _PROBE_ARGS, _STAT_SCRIPT, _VIDEO_CODEC_OPTS, _Worker,
+    _bench_metrics, _cpu_count, _daemon_unreachable, _docker_run_leased, _ffmpeg_io_indexes, _local_stat, _log,
+    _parse_concurrency, _pipeline_steps, _pool_for, _preset_args, _progress_notifier, _progress_supported, _run_batch,
+    _run_pipeline, _serve_metrics, _smart_cut, _split_args, _stderr_sinks, build_frame_grab, send_error, send_result,
+    send_tool_result,
+)
 
 MEDIA_ROOT = "/home/media"
 
 
-def send(payload: dict) -> None:
-    print(json.dumps(payload), flush=True)
+# 多台 docker daemon 分摊任务, 逗号分隔, = 后面是容量权重 (默认 1), 例如
+# "unix:///var/run/docker.sock=4,tcp://10.0.0.12:2375=8". 各台都挂着同一个 /home/media (COSFS), 路径不用改.
+# 不设就只用上面那一个 (DOCKER_HOST / 本机 docker.sock)
+DOCKER_HOSTS = os.environ.get("FFMPEG_MCP_DOCKER_HOSTS", "")
+
+
+# 结果缓存 (默认关闭, 工具参数 cache=true 可单次开启): 相同 argv + 镜像 + 输入指纹直接复用上次的输出
+RESULT_CACHE = os.environ.get("FFMPEG_MCP_RESULT_CACHE", "0").lower() in ("1", "true", "yes", "on")
+CACHE_DIR = os.environ.get("FFMPEG_MCP_CACHE_DIR", f"{MEDIA_ROOT}/.cache/results")
+CACHE_MAX_BYTES = int(float(os.environ.get("FFMPEG_MCP_CACHE_MAX_MB", "10240")) * 1024 * 1024)
+# 输入指纹: 0 = size+mtime, 1 = 内容 sha256 (慢但不怕 touch)
+CACHE_CONTENT_HASH = os.environ.get("FFMPEG_MCP_CACHE_HASH", "0").lower() in ("1", "true", "yes", "on")
+
+# 本地 scratch 中转 (COSFS 上 moov 回跳 / faststart / 两遍编码这类随机读写极慢): 输入先大块顺序读到本地盘
+# (按 path+size+mtime 做 LRU 复用), ffmpeg 读写本地文件, 输出成功后一次顺序写回卷里.
+# SCRATCH_DIR 不设就不可用 (目录会同路径挂进工作容器, server 跑在容器里时宿主和容器内路径要一致);
+# FFMPEG_MCP_STAGE=1 默认开启, 工具参数 stage=true/false 可单次覆盖
+SCRATCH_DIR = os.environ.get("FFMPEG_MCP_SCRATCH_DIR", "").rstrip("/")
+STAGE_DEFAULT = os.environ.get("FFMPEG_MCP_STAGE", "0").lower() in ("1", "true", "yes", "on")
+SCRATCH_MAX_BYTES = int(float(os.environ.get("FFMPEG_MCP_SCRATCH_MAX_MB", "20480")) * 1024 * 1024)
+# 比这小的输入直接读卷, 拷一遍不划算
+STAGE_MIN_BYTES = int(float(os.environ.get("FFMPEG_MCP_STAGE_MIN_MB", "8")) * 1024 * 1024)
+
+# probe 结果按 path+size+mtime 落盘缓存, 规划阶段反复 probe 同一批素材时不用再起 ffprobe
+PROBE_CACHE_DIR = os.environ.get("FFMPEG_MCP_PROBE_CACHE_DIR", f"{MEDIA_ROOT}/.cache/probe")
+
+
+# file_exists 走本进程 os.stat: auto = 能看到 MEDIA_ROOT 就走本地, 1 = 强制本地, 0 = 总是起 busybox 容器
+NATIVE_STAT = os.environ.get("FFMPEG_MCP_NATIVE_STAT", "auto").lower()
+
+
+# 同一时刻完全相同的 docker 调用 (镜像 + 规范化 argv) 只跑一次, 后到的共用结果; 0 关闭
+COALESCE = os.environ.get("FFMPEG_MCP_COALESCE", "1").lower() in ("1", "true", "yes", "on")
+# 输出先写同目录的 .xxx.partial 临时文件, 成功后 rename 到位, 并发/中断时不会留下写了一半的文件; 0 关闭
+ATOMIC_OUTPUTS = os.environ.get("FFMPEG_MCP_ATOMIC_OUTPUTS", "1").lower() in ("1", "true", "yes", "on")
+
+# 每个工具同时最多跑几个任务, 0 = 不限; 可用 FFMPEG_MCP_CONCURRENCY="ffmpeg=2,imagemagick=8" 覆盖
+DEFAULT_CONCURRENCY = {"ffmpeg": 2, "imagemagick": 8, "file_exists": 0, "probe": 4, "ffmpeg_batch": 1,
+                       "ffmpeg_renditions": 1, "ffmpeg_parallel_transcode": 1, "imagemagick_batch": 1,
+                       "extract_frames": 2, "trim": 1, "pipeline": 1}
+
+
+# 工作容器统一的 docker run 参数: 卷同路径挂进去
+RUN_OPTS = (["-v", f"{MEDIA_ROOT}:{MEDIA_ROOT}"] + (["-v", f"{SCRATCH_DIR}:{SCRATCH_DIR}"] if SCRATCH_DIR else [])
+            + ["-w", MEDIA_ROOT])
+
+
+def _has_idle_worker(host: "DockerHost", image: str) -> bool:
+    with _POOLS_LOCK:
+        pool = _POOLS.get((host.name, image, tuple(RUN_OPTS)))
+    return pool is not None and pool.stats()["idle"] > 0
+
+
+def _parse_docker_hosts(spec: str) -> list:
+    """FFMPEG_MCP_DOCKER_HOSTS -> [DockerHost]; 空串 = 只用 DOCKER_HOST / 本机 docker.sock."""
+    hosts = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, sep, weight = entry.rpartition("=")
+        if not sep:
+            url, weight = entry, "1"
+        try:
+            weight = float(weight)
+        except ValueError:
+            url, weight = entry, 1.0
+        if "://" not in url:
+            url = ("unix://" if url.startswith("/") else "tcp://") + url
+        hosts.append(DockerHost(url, max(weight, 0.01), env=dict(os.environ, DOCKER_HOST=url), warm_opts=[RUN_OPTS]))
+    if not hosts:
+        hosts.append(DockerHost(_DOCKER_HOST or "unix:///var/run/docker.sock", 1.0, DOCKER_SOCKET, warm_opts=[RUN_OPTS]))
+    return hosts
+
+
+class HostDispatcher:
+    """把每个 docker 调用派到一台 daemon 上.
+
+    挑法: 预检确认镜像在的优先 (没有的要先拉, 一拉就是几分钟); 其次按 (在跑的任务数 + 1) / 权重 取最小,
+    有空闲常驻 worker 的那台不加这个 1 (省掉冷启动); 并列时按配置顺序. 连不上的 daemon 冷却 HOST_RETRY 秒后
+    再参与, 全都在冷却就还是挑一台试. run() 遇到连不上 (任务根本没开始) 换一台重跑, 每台最多一次.
+    """
+
+    def __init__(self, hosts: list):
+        self.hosts = hosts
+        self.primary = hosts[0]
+        for host in hosts:
+            host.failover = len(hosts) > 1
+        self._lock = threading.Lock()
+
+    def acquire(self, image: str, exclude: list = ()) -> DockerHost | None:
+        candidates = [h for h in self.hosts if h not in exclude]
+        if not candidates:
+            return None
+        warm = missing = set()
+        if len(candidates) > 1:
+            warm = {h.name for h in candidates if _has_idle_worker(h, image)}
+            missing = {h.name for h in candidates if h.preflight.image_missing(image)}
+        now = time.monotonic()
+        with self._lock:
+            up = [h for h in candidates if h.down_until <= now] or candidates
+            host = min(up, key=lambda h: (h.name in missing, (h.active + (h.name not in warm)) / h.weight))
+            host.active += 1
+            host.dispatched += 1
+        return host
+
+    def release(self, host: DockerHost) -> None:
+        with self._lock:
+            host.active -= 1
+
+    def run(self, image: str, fn, cancel: "CancelToken | None" = None) -> dict:
+        """fn(host) -> result, 在挑出来的 daemon 上跑; 多台时结果里带 host."""
+        tried: list = []
+        result: dict = {}
+        host = self.acquire(image)
+        while host is not None:
+            failures = host.failures
+            try:
+                result = fn(host)
+            finally:
+                self.release(host)
+            if len(self.hosts) > 1:
+                result["host"] = host.name
+            if not _daemon_unreachable(result.get("error") or ""):
+                host.mark_up()
+                break
+            # Engine API 连不上时 DockerHost.unreachable 已经记过这次故障
+            if host.failures == failures:
+                host.mark_down(result["error"])
+            tried.append(host)
+            if cancel is not None and cancel.cancelled:
+                break
+            host = self.acquire(image, tried)
+        if tried and len(self.hosts) > 1:
+            result["failed_over"] = [h.name for h in tried]
+        return result
+
+    def start_preflight(self) -> None:
+        for host in self.hosts:
+            host.preflight.start()
+
+    def status(self) -> dict:
+        """server_status 用: 单台时和以前一样是它的预检报告, 多台时每台一份."""
+        if len(self.hosts) == 1:
+            return dict(self.primary.preflight.status(), hosts=[self.primary.stats()])
+        hosts = [dict(h.stats(), **h.preflight.status()) for h in self.hosts]
+        return {"preflight": hosts[0]["preflight"], "ready": any(h["ready"] for h in hosts), "hosts": hosts}
+
+
+DISPATCH = HostDispatcher(_parse_docker_hosts(DOCKER_HOSTS))
+
+
+class _Flight:
+    """一次正在跑的 docker 调用和挂在它上面的调用方."""
+
+    def __init__(self):
+        self.token = CancelToken()
+        self.waiters: list = []
+        self.result: dict | None = None
+
+    def fan_out(self, slot: int):
+        """把某个回调 (0 = stdout 行, 1 = stderr) 转给所有还在等的调用方."""
+        def emit(data) -> None:
+            for waiter in list(self.waiters):
+                callback = waiter["callbacks"][slot]
+                if waiter["active"] and callback is not None:
+                    try:
+                        callback(data)
+                    except Exception as e:
+                        _log(f"coalesced callback failed: {e}")
+        return emit
+
+
+class SingleFlight:
+    """同一时刻完全相同的 docker 调用只跑一次, 后到的挂到正在跑的那次上, 共用它的结果.
+
+    进程在单独的线程里跑, 每个调用方各自等: 调用方取消或超时只是自己不等了, 所有调用方都走了才真的杀进程.
+    stdout 行 / stderr 回调扇出给所有调用方 (中途加入的从加入时起收到). 跑完就从表里摘掉,
+    之后再来的相同调用重新跑 (输入可能已经变了).
+    """
+
+    def __init__(self):
+        self._flights: dict = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    @staticmethod
+    def key(image: str, entrypoint: str | None, argv: list, on_stdout_line, on_stderr) -> str:
+        # 跟随者拿到的是领头那次的 stderr 和进度, 所以 -loglevel / -progress 这类也要一致, 只有 -y / -hide_banner
+        # 的位置无所谓 (-y / -n 决定输出已存在时是覆盖还是失败, 单独算). 有没有 stdout 行回调决定 stdout 进不进结果.
+        shape = [image, entrypoint, [a for a in argv if a not in ("-y", "-hide_banner")], "-y" in argv, "-n" in argv,
+                 on_stdout_line is not None, on_stderr is not None]
+        return hashlib.sha256(json.dumps(shape).encode()).hexdigest()
+
+    def run(self, key: str, fn, on_stdout_line, on_stderr, timeout: int, cancel: CancelToken | None) -> dict:
+        """fn(cancel, on_stdout_line, on_stderr) -> result, 只有第一个调用方会真的调用."""
+        waiter = {"event": threading.Event(), "callbacks": (on_stdout_line, on_stderr), "active": True}
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+            flight.waiters.append(waiter)
+        if leader:
+            threading.Thread(target=self._lead, args=(key, flight, fn), daemon=True).start()
+
+        leave = lambda: self._leave(flight, waiter)  # noqa: E731
+        if cancel is not None:
+            cancel.register(leave)
+        try:
+            # 真正的超时由跑进程的那个调用方的 timeout 控制, 这里只防止永远等下去
+            finished = waiter["event"].wait(timeout + 60) and flight.result is not None
+        finally:
+            if cancel is not None:
+                cancel.unregister(leave)
+        if not finished:
+            self._leave(flight, waiter)
+            if cancel is not None and cancel.cancelled:
+                return {"success": False, "output": "", "error": "Cancelled", "cancelled": True, "runner": "coalesced"}
+            return {"success": False, "output": "", "error": f"Timed out after {timeout}s waiting for an identical run",
+                    "timeout": True, "runner": "coalesced"}
+        # 每个调用方拿一份自己的副本, 后面各自往 metrics 里加东西互不影响
+        result = {k: dict(v) if isinstance(v, dict) else v for k, v in flight.result.items()}
+        if not leader:
+            result["coalesced"] = True
+        return result
+
+    def _lead(self, key: str, flight: _Flight, fn) -> None:
+        try:
+            result = fn(flight.token, flight.fan_out(0), flight.fan_out(1))
+        except Exception as e:
+            result = {"success": False, "output": "", "error": str(e)}
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.result = result
+            waiters = list(flight.waiters)
+        for waiter in waiters:
+            waiter["event"].set()
+
+    def _leave(self, flight: _Flight, waiter: dict) -> None:
+        with self._lock:
+            if not waiter["active"]:
+                return
+            waiter["active"] = False
+            abandoned = flight.result is None and not any(w["active"] for w in flight.waiters)
+        waiter["event"].set()
+        if abandoned:
+            flight.token.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "waiting": sum(len(f.waiters) for f in self._flights.values()),
+                "coalesced_total": self.coalesced,
+            }
+
+
+FLIGHTS = SingleFlight()
+
+# 写多个文件的 muxer (播放列表 + 分片, 分片名从输出名推出来), 输出不改名
+_MULTI_FILE_FORMATS = {"hls", "dash", "segment", "stream_segment", "ssegment", "image2", "tee"}
+_MULTI_FILE_EXTS = (".m3u8", ".mpd")
+
+
+def _atomic_outputs(image: str, entrypoint: str | None, argv: list) -> tuple:
+    """把 argv 里卷内的输出文件换成同目录的临时文件, 返回 (新 argv, [(临时文件, 目标), ...]).
 
+    ffmpeg: 每个输出; magick: _magick_output 认出来的那个输出. 序列帧 (%d)、stdout、多文件 muxer、
+    同时也是输入的 (原地改写)、没带 -y 又已经存在的输出 (ffmpeg 本来会拒绝覆盖) 保持原样.
+    临时文件保留扩展名, ffmpeg / magick 照样按扩展名选格式.
+    """
+    if not ATOMIC_OUTPUTS or not _native_stat_enabled():
+        return argv, []
+    if image == FFMPEG_IMAGE and entrypoint is None:
+        formats = {argv[i + 1] for i, a in enumerate(argv[:-1]) if a == "-f"}
+        if formats & _MULTI_FILE_FORMATS:
+            return argv, []
+        indexes = _ffmpeg_io_indexes(argv)[1]
+    elif image == IMAGEMAGICK_IMAGE and entrypoint == "magick":
+        out = _magick_output(argv)
+        # +adjoin 按输出名拆成 out-0.png / out-1.png ... 多个文件
+        if out is None or "+adjoin" in argv:
+            return argv, []
+        indexes = [out]
+    else:
+        return argv, []
+    # 其它参数里读到的卷内文件 (-i 的值、movie= / subtitles= 里嵌的): 原地改写的输出换成临时文件, 读的就是空文件了
+    reads = set()
+    for j, arg in enumerate(argv):
+        if j not in indexes:
+            reads.update(os.path.normpath(m.rstrip(".:")) for m in _MEDIA_PATH_RE.findall(arg))
+            if not arg.startswith(("-", "+")):
+                reads.add(_media_path(arg))
+    out = list(argv)
+    moves = []
+    for i in indexes:
+        dest = argv[i]
+        if "%" in dest or dest in ("-", "pipe:", "pipe:1") or dest.lower().endswith(_MULTI_FILE_EXTS):
+            continue
+        if not _under_media_root(dest) or os.path.isdir(dest) or os.path.normpath(dest) in reads:
+            continue
+        if os.path.exists(dest) and "-y" not in argv and image == FFMPEG_IMAGE:
+            continue
+        directory, name = os.path.split(dest)
+        stem, ext = os.path.splitext(name)
+        out[i] = os.path.join(directory, f".{stem}.{uuid.uuid4().hex[:8]}.partial{ext}")
+        moves.append((out[i], dest))
+    return out, moves
 
-def send_error(rid, code: int, message: str) -> None:
-    send({"jsonrpc": "2.0", "id": rid, "error": {"code": code, "message": message}})
 
+def _docker_run(image: str, cmd_args: list, entrypoint: str | None = None, timeout: int = 600,
+                on_stdout_line=None, on_stderr=None, worker: _Worker | None = None,
+                cancel: CancelToken | None = None) -> dict:
+    """worker 不为空时在这个 (调用方 pin 住的) worker 里 exec, 用完不归还.
 
-def send_result(rid, result: dict) -> None:
-    send({"jsonrpc": "2.0", "id": rid, "result": result})
+    超时或 cancel 时只杀 docker CLI 是不够的, 容器里的进程会继续跑: warm 路径把整个 worker 删掉,
+    冷启动路径给容器起名, 按名字 docker rm -f.
 
+    前面有一层 singleflight (FLIGHTS): 正在跑一个完全相同的调用时不再起进程, 挂上去等它的结果;
+    pin 了 worker 的调用 (ffmpeg_batch single_container) 不合并. 卷内输出先写临时文件, 成功后 rename 到位.
+    """
+    if worker is not None or not COALESCE:
+        return _docker_run_atomic(image, cmd_args, entrypoint, timeout, on_stdout_line, on_stderr, worker, cancel)
+    key = SingleFlight.key(image, entrypoint, cmd_args, on_stdout_line, on_stderr)
+    return FLIGHTS.run(
+        key,
+        lambda token, out, err: _docker_run_atomic(image, cmd_args, entrypoint, timeout,
+                                                   out if on_stdout_line else None, err if on_stderr else None,
+                                                   None, token),
+        on_stdout_line, on_stderr, timeout, cancel,
+    )
 
-def _docker_run(image: str, cmd_args: list, entrypoint: str | None = None, timeout: int = 600) -> dict:
-    base = ["docker", "run", "--rm", "-v", f"{MEDIA_ROOT}:{MEDIA_ROOT}", "-w", MEDIA_ROOT]
-    if entrypoint is not None:
-        base.extend(["--entrypoint", entrypoint])
-    docker_cmd = base + [image] + cmd_args
 
+def _docker_run_atomic(image: str, cmd_args: list, entrypoint: str | None, timeout: int, on_stdout_line,
+                       on_stderr, worker: _Worker | None, cancel: CancelToken | None) -> dict:
+    cmd_args, moves = _atomic_outputs(image, entrypoint, cmd_args)
     try:
-        proc = subprocess.run(docker_cmd, capture_output=True, text=True, timeout=timeout)
-        return {
-            "success": proc.returncode == 0,
-            "output": proc.stdout,
-            "error": proc.stderr,
-            "command": " ".join(docker_cmd),
+        result = _docker_run_dispatched(image, cmd_args, entrypoint, timeout, on_stdout_line, on_stderr, worker, cancel)
+        if result.get("success"):
+            for tmp, dest in moves:
+                if os.path.exists(tmp):
+                    os.replace(tmp, dest)
+        return result
+    finally:
+        for tmp, _ in moves:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+
+
+def _docker_run_dispatched(image: str, cmd_args: list, entrypoint: str | None, timeout: int, on_stdout_line,
+                           on_stderr, worker: _Worker | None, cancel: CancelToken | None) -> dict:
+    """pin 住的 worker 就在它那台 daemon 上跑, 否则由 DISPATCH 挑一台 (连不上换一台)."""
+    if worker is not None:
+        result = _docker_run_leased(worker.host, image, cmd_args, RUN_OPTS, entrypoint, timeout, on_stdout_line,
+                                    on_stderr, worker, cancel)
+        if len(DISPATCH.hosts) > 1:
+            result["host"] = worker.host.name
+        return result
+    return DISPATCH.run(image, lambda host: _docker_run_leased(host, image, cmd_args, RUN_OPTS, entrypoint, timeout,
+                                                               on_stdout_line, on_stderr, None, cancel), cancel)
+
+
+def _file_bytes(paths: list) -> int | None:
+    if not _native_stat_enabled():
+        return None
+    total = 0
+    for path in paths:
+        full = _media_path(path)
+        with contextlib.suppress(OSError, TypeError):
+            total += os.path.getsize(full)
+    return total
+
+
+def _ffmpeg_files(args: list) -> tuple:
+    """统计读写字节数用的输入 / 输出文件: 每个输出都算, 选项的值和 - / pipe: 不算."""
+    in_idx, out_idx = _ffmpeg_io_indexes(args)
+    files = [[args[i] for i in idx if args[i] != "-" and not args[i].startswith("pipe:")] for idx in (in_idx, out_idx)]
+    return files[0], files[1]
+
+
+# 不影响输出内容的参数, 算缓存 key 时去掉
+_FFMPEG_NOISE_FLAGS = {"-y", "-hide_banner", "-nostdin", "-nostats", "-stats"}
+_FFMPEG_NOISE_OPTS = {"-loglevel", "-v", "-progress", "-stats_period"}
+
+_MEDIA_PATH_RE = re.compile(re.escape(MEDIA_ROOT) + r"/[^\s'\",;\[\]|]+")
+
+
+def _normalized_argv(argv: list, slots: dict | None = None) -> list:
+    """去掉不影响输出内容的参数 (-y / -loglevel / -progress ...); slots 把输出路径换成占位符."""
+    normalized, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in _FFMPEG_NOISE_OPTS:
+            skip = True
+        elif arg not in _FFMPEG_NOISE_FLAGS:
+            normalized.append(slots.get(arg, arg) if slots else arg)
+    return normalized
+
+
+def _media_path(path: str) -> str | None:
+    full = os.path.normpath(path if os.path.isabs(path) else os.path.join(MEDIA_ROOT, path))
+    return full if _under_media_root(full) else None
+
+
+def _ffmpeg_io(args: list) -> tuple | None:
+    """拆出 ffmpeg argv 里的输入/输出文件, 不可缓存 (网络输入/stdout/序列帧/-n) 时返回 None."""
+    if "-n" in args:
+        return None
+    in_idx, out_idx = _ffmpeg_io_indexes(args)
+    inputs = [args[i] for i in in_idx]
+    if any("://" in a for a in inputs):
+        return None
+    return _split_io(args, inputs, [args[i] for i in out_idx])
+
+
+# 没有输出文件 (identify / stream 只打印, mogrify 原地改写, compare 主要结果是打印的差异值) 或者会起窗口的子命令
+_MAGICK_NO_OUTPUT = {"identify", "mogrify", "compare", "stream", "display", "animate", "import", "conjure"}
+
+
+def _magick_output(argv: list) -> int | None:
+    """magick argv 里输出文件的下标, 找不到确定的单个输出时返回 None.
+
+    约定最后一个参数是输出, 但 identify / mogrify 这类子命令的最后一个参数是它读 (或原地改写) 的文件,
+    带 -write 的有多个输出, -list / -version 只打印, 最后一个参数在前面也出现过的是原地改写: 这些都不算.
+    """
+    if len(argv) < 2 or argv[0].lower() in _MAGICK_NO_OUTPUT:
+        return None
+    if any(a in ("-write", "+write", "-list", "-version", "-help") for a in argv):
+        return None
+    out = argv[-1]
+    # png:- / info: / PNG8:out.png 这类带格式前缀的输出 (stdout、伪格式) 不当文件处理
+    if out.startswith(("-", "+")) or re.match(r"[A-Za-z0-9]+:", out):
+        return None
+    target = _media_path(out) or os.path.normpath(out)
+    if any((_media_path(a) or os.path.normpath(a)) == target for a in argv[:-1]):
+        return None
+    return len(argv) - 1
+
+
+def _magick_io(argv: list) -> tuple | None:
+    """magick 的输入/输出文件, 没有确定的输出 (见 _magick_output) 时不缓存."""
+    out = _magick_output(argv)
+    if out is None:
+        return None
+    # 操作数 (50%, 800x600 ...) 和文件混在一起, 只有真实存在的卷内文件才算输入
+    inputs = [a for a in argv[:out] if not a.startswith(("-", "+")) and os.path.isfile(_media_path(a) or "")]
+    return _split_io(argv, inputs, [argv[out]])
+
+
+def _split_io(argv: list, inputs: list, outputs: list) -> tuple | None:
+    """返回 (输入, 输出, 输出的绝对路径); 输出同时也被读 (原地改写) 时返回 None: 命中缓存会把旧内容盖回用户的文件."""
+    if not outputs or any("%" in o or o in ("-", "pipe:", "pipe:1") for o in outputs):
+        return None
+    out_paths = [_media_path(o) for o in outputs]
+    if None in out_paths:
+        return None
+    # 显式输入之外, 滤镜字符串里嵌的卷内文件 (movie=/subtitles=/overlay 图片) 也算输入
+    referenced = set()
+    for arg in argv:
+        if arg not in outputs:
+            referenced.update(m.rstrip(".:") for m in _MEDIA_PATH_RE.findall(arg))
+    for arg in inputs:
+        full = _media_path(arg)
+        if full is None or not os.path.isfile(full):
+            return None
+        referenced.add(full)
+    if referenced.intersection(out_paths):
+        return None
+    in_paths = sorted(p for p in referenced if os.path.isfile(p))
+    return in_paths, outputs, out_paths
+
+
+def _clone_file(src: str, dst: str) -> str:
+    """hardlink -> reflink -> copy, 返回实际用的方式."""
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())  # FICLONE
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class ResultCache:
+    """按 (镜像, 规范化 argv, 输入指纹) 做内容寻址的输出缓存.
+
+    目录结构: <root>/<key>/out0.mp4 ... + meta.json; meta.json 的 mtime 就是 LRU 时间戳.
+    同一条命令 (recipe) 的输入一变, key 跟着变, 旧条目在写入新条目时一并删除.
+    """
+
+    def __init__(self, root: str, max_bytes: int, content_hash: bool = False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self._hashes: dict = {}
+        self._lock = threading.Lock()
+
+    def fingerprint(self, path: str) -> list:
+        st = os.stat(path)
+        if not self.content_hash:
+            return [path, st.st_size, st.st_mtime_ns]
+        memo = (path, st.st_size, st.st_mtime_ns)
+        digest = self._hashes.get(memo)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            digest = self._hashes[memo] = h.hexdigest()
+        return [path, digest]
+
+    def key(self, image: str, argv: list, outputs: list, inputs: list) -> tuple:
+        """返回 (key, recipe): recipe 只看命令本身, key 再加上输入指纹."""
+        slots = {o: f"<out{i}{os.path.splitext(o)[1]}>" for i, o in enumerate(outputs)}
+        recipe = hashlib.sha256(json.dumps([image, _normalized_argv(argv, slots)]).encode()).hexdigest()
+        prints = [self.fingerprint(p) for p in inputs]
+        key = hashlib.sha256(json.dumps([recipe, prints]).encode()).hexdigest()
+        return key, recipe
+
+    def lookup(self, key: str, out_paths: list) -> dict | None:
+        entry = os.path.join(self.root, key)
+        meta_path = os.path.join(entry, "meta.json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            files = meta["files"]
+            # 输出以 hardlink 存进来时, 之后有人原地覆盖了输出文件, 缓存副本也会被改, 这里校验掉
+            for name, size, mtime_ns in files:
+                st = os.stat(os.path.join(entry, name))
+                if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                    raise ValueError(f"cache entry {key[:12]} modified")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            _log(f"dropping cache entry: {e}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        methods = []
+        for (name, _, _), dst in zip(files, out_paths):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(dst)
+            methods.append(_clone_file(os.path.join(entry, name), dst))
+        os.utime(meta_path)
+        result = dict(meta["result"])
+        result.update({"runner": "cache", "cache": {"hit": True, "key": key, "materialized": methods}})
+        return result
+
+    def store(self, key: str, recipe: str, out_paths: list, result: dict) -> bool:
+        total = sum(os.path.getsize(p) for p in out_paths)
+        if total > self.max_bytes:
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        try:
+            files = []
+            for i, src in enumerate(out_paths):
+                name = f"out{i}{os.path.splitext(src)[1]}"
+                _clone_file(src, os.path.join(tmp, name))
+                st = os.stat(os.path.join(tmp, name))
+                files.append([name, st.st_size, st.st_mtime_ns])
+            stored = {k: v for k, v in result.items() if k not in ("runner", "cache")}
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"key": key, "recipe": recipe, "bytes": total, "files": files, "result": stored}, f)
+            with self._lock:
+                try:
+                    os.rename(tmp, os.path.join(self.root, key))
+                except OSError as e:
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                self._evict(keep=key, recipe=recipe)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return True
+
+    def _evict(self, keep: str, recipe: str) -> None:
+        entries = []
+        for name in os.listdir(self.root):
+            meta_path = os.path.join(self.root, name, "meta.json")
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                entries.append((os.stat(meta_path).st_mtime, name, meta.get("bytes", 0), meta.get("recipe")))
+            except (OSError, ValueError):
+                continue
+        used = 0
+        for mtime, name, size, entry_recipe in sorted(entries, reverse=True):
+            # 同一条命令的旧条目: 输入已经变了, 直接作废
+            stale = entry_recipe == recipe and name != keep
+            if stale or (used + size > self.max_bytes and name != keep):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            else:
+                used += size
+
+
+RESULT_CACHE_STORE = ResultCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_CONTENT_HASH)
+
+
+def _cached(image: str, argv: list, io: tuple | None, use_cache: bool | None, run) -> dict:
+    """有缓存就直接物化输出, 没有就 run() 跑一遍并在成功后写入缓存."""
+    if not (RESULT_CACHE if use_cache is None else use_cache) or io is None or not _native_stat_enabled():
+        return run()
+    inputs, outputs, out_paths = io
+    try:
+        key, recipe = RESULT_CACHE_STORE.key(image, argv, outputs, inputs)
+        hit = RESULT_CACHE_STORE.lookup(key, out_paths)
+    except OSError as e:
+        _log(f"result cache unavailable: {e}")
+        return run()
+    if hit is not None:
+        return hit
+
+    result = run()
+    if result.get("success") and all(os.path.isfile(p) for p in out_paths):
+        try:
+            if RESULT_CACHE_STORE.store(key, recipe, out_paths, result):
+                result["cache"] = {"hit": False, "key": key}
+        except OSError as e:
+            _log(f"result cache store failed: {e}")
+    return result
+
+
+class ScratchStage:
+    """本地盘上的中转区.
+
+    <root>/inputs/<key><ext>: 输入副本, key = sha256(path, size, mtime_ns), 文件 mtime 当 LRU 时间戳,
+    总量不超过 max_bytes; 正在被调用使用 (pin 住) 的副本不淘汰. 源文件一改 key 就变, 旧副本按 LRU 淘汰.
+    <root>/jobs/<id>/: 单次调用的输出, 写回卷里之后整个删掉; 进程崩溃留下的目录下次启动时按年龄清理.
+    """
+
+    CHUNK = 16 << 20
+
+    def __init__(self, root: str, max_bytes: int, min_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.inputs_dir = os.path.join(root, "inputs")
+        self.jobs_dir = os.path.join(root, "jobs")
+        self._pins: dict = {}
+        self._copying: dict = {}
+        self._prepared = False
+        self._lock = threading.Lock()
+
+    def _prepare(self) -> None:
+        with self._lock:
+            if self._prepared:
+                return
+            os.makedirs(self.inputs_dir, exist_ok=True)
+            os.makedirs(self.jobs_dir, exist_ok=True)
+            cutoff = time.time() - JOB_TIMEOUT
+            for name in os.listdir(self.inputs_dir):
+                if name.startswith(".tmp-"):
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(self.inputs_dir, name))
+            for name in os.listdir(self.jobs_dir):
+                path = os.path.join(self.jobs_dir, name)
+                with contextlib.suppress(OSError):
+                    if os.stat(path).st_mtime < cutoff:
+                        shutil.rmtree(path, ignore_errors=True)
+            self._prepared = True
+
+    @classmethod
+    def copy(cls, src: str, dst: str, cancel: CancelToken | None = None) -> int:
+        """大块顺序拷贝: COSFS 上一次读 16MB 比 ffmpeg 的零碎 seek 快得多."""
+        copied = 0
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            with contextlib.suppress(AttributeError, OSError):
+                os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                if cancel is not None and cancel.cancelled:
+                    raise InterruptedError("Cancelled")
+                block = fsrc.read(cls.CHUNK)
+                if not block:
+                    return copied
+                fdst.write(block)
+                copied += len(block)
+
+    def stage_input(self, path: str, cancel: CancelToken | None = None) -> tuple | None:
+        """返回 (本地副本, key, 是否命中), 副本已 pin 住, 用完 release; 太小/太大不值得中转时返回 None."""
+        self._prepare()
+        st = os.stat(path)
+        if st.st_size < self.min_bytes or st.st_size > self.max_bytes:
+            return None
+        key = hashlib.sha256(f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()[:32]
+        local = os.path.join(self.inputs_dir, key + os.path.splitext(path)[1])
+        while True:
+            with self._lock:
+                copying = self._copying.get(key)
+                if copying is None:
+                    if os.path.isfile(local):
+                        self._pins[key] = self._pins.get(key, 0) + 1
+                        os.utime(local)
+                        return local, key, True
+                    copying = self._copying[key] = threading.Event()
+                    break
+            # 另一个调用正在拷同一个文件, 等它拷完直接用
+            copying.wait()
+
+        tmp = os.path.join(self.inputs_dir, f".tmp-{uuid.uuid4().hex}")
+        try:
+            self._make_room(st.st_size)
+            self.copy(path, tmp, cancel)
+            os.rename(tmp, local)
+            with self._lock:
+                self._pins[key] = self._pins.get(key, 0) + 1
+        finally:
+            with self._lock:
+                self._copying.pop(key).set()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+        return local, key, False
+
+    def release(self, keys: list) -> None:
+        with self._lock:
+            for key in keys:
+                left = self._pins.get(key, 0) - 1
+                if left > 0:
+                    self._pins[key] = left
+                else:
+                    self._pins.pop(key, None)
+
+    def _make_room(self, size: int) -> None:
+        """按 LRU 淘汰没人在用的副本, 直到放得下 size."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.inputs_dir):
+                if name.startswith(".tmp-"):
+                    continue
+                with contextlib.suppress(OSError):
+                    st = os.stat(os.path.join(self.inputs_dir, name))
+                    entries.append((st.st_mtime, name, st.st_size))
+            used = sum(e[2] for e in entries)
+            for _, name, entry_size in sorted(entries):
+                if used + size <= self.max_bytes:
+                    return
+                key = name.partition(".")[0]
+                if key in self._pins or key in self._copying:
+                    continue
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.inputs_dir, name))
+                    used -= entry_size
+
+    def job_dir(self) -> str:
+        self._prepare()
+        path = os.path.join(self.jobs_dir, uuid.uuid4().hex[:12])
+        os.makedirs(path)
+        return path
+
+    def free_bytes(self) -> int:
+        # 没有输入要中转时 (网络输入 / 卷外路径) 这里是第一次碰 scratch, 目录可能还没建
+        self._prepare()
+        return shutil.disk_usage(self.root).free
+
+    def publish(self, local: str, dest: str, cancel: CancelToken | None = None) -> int:
+        """本地输出顺序写回卷里: 先写同目录临时文件再 rename, 中途失败不会留下半个输出."""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{uuid.uuid4().hex[:8]}.partial")
+        try:
+            copied = self.copy(local, tmp, cancel)
+            os.replace(tmp, dest)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+        return copied
+
+
+SCRATCH = ScratchStage(SCRATCH_DIR, SCRATCH_MAX_BYTES, STAGE_MIN_BYTES) if SCRATCH_DIR else None
+
+
+def _run_staged(args: list, run, cancel: CancelToken | None = None) -> dict:
+    """把 argv 里卷内的输入/输出换成 scratch 上的路径跑 run(argv), 成功后把输出写回卷里.
+
+    网络输入、序列帧 (%d)、stdout 输出、已存在且没有 -y 的输出保持原样 (ffmpeg 原来怎么处理还怎么处理).
+    本地盘剩余空间不够放下和输入一样大的输出时, 输出不走中转.
+    """
+    in_idx, out_idx = _ffmpeg_io_indexes(args)
+    staged = list(args)
+    pins: list = []
+    outputs: list = []
+    job_dir = None
+    info = {"inputs": 0, "input_hits": 0, "input_bytes": 0, "outputs": 0, "output_bytes": 0}
+    started = time.monotonic()
+    try:
+        in_bytes = 0
+        for i in in_idx:
+            full = _media_path(args[i]) if "://" not in args[i] else None
+            if full is None or not os.path.isfile(full):
+                continue
+            got = SCRATCH.stage_input(full, cancel)
+            in_bytes += os.path.getsize(full)
+            if got is None:
+                continue
+            staged[i], key, hit = got
+            pins.append(key)
+            info["inputs"] += 1
+            info["input_hits"] += hit
+            info["input_bytes"] += 0 if hit else os.path.getsize(full)
+
+        if SCRATCH.free_bytes() > in_bytes:
+            for i in out_idx:
+                dest = _media_path(args[i])
+                if dest is None or "%" in args[i] or args[i] in ("-", "pipe:", "pipe:1"):
+                    continue
+                if os.path.exists(dest) and "-y" not in args:
+                    continue
+                if job_dir is None:
+                    job_dir = SCRATCH.job_dir()
+                staged[i] = os.path.join(job_dir, f"{len(outputs)}-{os.path.basename(dest)}")
+                outputs.append((staged[i], dest))
+        stage_in = time.monotonic() - started
+
+        result = run(staged)
+        published = time.monotonic()
+        if result.get("success"):
+            for local, dest in outputs:
+                if os.path.isfile(local):
+                    info["output_bytes"] += SCRATCH.publish(local, dest, cancel)
+                    info["outputs"] += 1
+        stage_out = time.monotonic() - published
+    except InterruptedError:
+        return {"success": False, "output": "", "error": "Cancelled", "cancelled": True, "staging": info}
+    except OSError as e:
+        return {"success": False, "output": "", "error": f"scratch staging failed: {e}", "staging": info}
+    finally:
+        SCRATCH.release(pins)
+        if job_dir is not None:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    result["staging"] = info
+    if "metrics" in result:
+        inputs, outs = _ffmpeg_files(args)
+        result["metrics"].update({
+            "stage_in_s": round(stage_in, 4),
+            "stage_out_s": round(stage_out, 4),
+            "input_bytes": _file_bytes(inputs),
+            "output_bytes": _file_bytes(outs) if result.get("success") else 0,
+        })
+    return result
+
+
+def run_ffmpeg(args: list, notify=None, cache: bool | None = None, worker: _Worker | None = None,
+               timeout: int = 600, cancel: CancelToken | None = None, stage: bool | None = None,
+               tier: str | None = None, on_stderr=None) -> dict:
+    """on_stderr 在输出截断之前逐块收到 ffmpeg 的 stderr (bytes)."""
+    try:
+        args = _preset_args(list(args), tier)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    if SCRATCH is not None and (STAGE_DEFAULT if stage is None else stage) and _native_stat_enabled():
+        run = lambda: _run_staged(  # noqa: E731
+            args, lambda staged: _run_ffmpeg(staged, notify, worker, timeout, cancel, on_stderr), cancel)
+    else:
+        run = lambda: _run_ffmpeg(args, notify, worker, timeout, cancel, on_stderr)  # noqa: E731
+    return _cached(FFMPEG_IMAGE, args, _ffmpeg_io(args), cache, run)
+
+
+def _run_ffmpeg(args: list, notify=None, worker: _Worker | None = None, timeout: int = 600,
+                cancel: CancelToken | None = None, on_stderr=None) -> dict:
+    progress = None
+    if _progress_supported(args):
+        progress = FFmpegProgress(notify)
+        result = _docker_run(
+            FFMPEG_IMAGE,
+            ["-benchmark", "-progress", "pipe:1", "-nostats"] + args,
+            timeout=timeout,
+            on_stdout_line=progress.feed_line,
+            on_stderr=_stderr_sinks(progress.feed_stderr, on_stderr),
+            worker=worker,
+            cancel=cancel,
+        )
+    else:
+        result = _docker_run(FFMPEG_IMAGE, ["-benchmark"] + args, timeout=timeout, on_stderr=on_stderr, worker=worker,
+                             cancel=cancel)
+
+    if "metrics" in result:
+        inputs, outputs = _ffmpeg_files(args)
+        result["metrics"].update(_bench_metrics(result.get("error") or ""))
+        result["metrics"]["input_bytes"] = _file_bytes(inputs)
+        result["metrics"]["output_bytes"] = _file_bytes(outputs) if result.get("success") else 0
+    stats = progress.stats() if progress is not None else None
+    if stats:
+        result["stats"] = stats
+    return result
+
+
+def ffmpeg_batch(jobs: list, max_parallel: int | None = None, single_container: bool = False,
+                 cache: bool | None = None, notify=None, timeout: int = 600,
+                 cancel: CancelToken | None = None, stage: bool | None = None, tier: str | None = None) -> dict:
+    """并行跑一批 ffmpeg argv, 单个失败不影响其它任务, 按输入顺序返回每个任务的结果和耗时.
+
+    每个任务占 ffmpeg 工具的一个并发槽 (FFMPEG_MCP_CONCURRENCY 里的 ffmpeg=N), 批量、并行转码和 trim 的
+    子进程和直接调用的 ffmpeg 加起来不超过这个数.
+    """
+    pool = worker = host = None
+    if single_container:
+        host = DISPATCH.acquire(FFMPEG_IMAGE)
+        try:
+            pool = _pool_for(FFMPEG_IMAGE, RUN_OPTS, host)
+            worker = pool.acquire(wait=60)
+        finally:
+            # 没拿到常驻容器就退回逐个任务各自调度, 不能一直占着这台主机的名额
+            if worker is None:
+                DISPATCH.release(host)
+                host = None
+    try:
+        return _run_batch(jobs, max_parallel,
+                          lambda argv: run_ffmpeg(argv, cache=cache, worker=worker, timeout=timeout, cancel=cancel,
+                                                  stage=stage, tier=tier),
+                          notify, cancel, worker, SCHEDULER, "ffmpeg")
+    finally:
+        if worker is not None:
+            pool.release(worker, healthy=not worker.broken)
+        if host is not None:
+            DISPATCH.release(host)
+
+
+def _segment_bounds(keyframes: list, duration: float, count: int) -> list:
+    """把 [0, duration) 切成约 count 段, 切点吸附到最近的关键帧; 返回 [(start, end|None), ...]."""
+    cuts = [0.0]
+    for i in range(1, count):
+        target = duration * i / count
+        j = bisect.bisect_left(keyframes, target)
+        near = [keyframes[k] for k in (j - 1, j) if 0 <= k < len(keyframes)]
+        if not near:
+            continue
+        cut = min(near, key=lambda t: abs(t - target))
+        # 关键帧太稀时几个目标会吸到同一帧上, 去掉重复/过短的段
+        if cut - cuts[-1] >= 1.0 and duration - cut >= 1.0:
+            cuts.append(cut)
+    return [(start, end) for start, end in zip(cuts, cuts[1:] + [None])]
+
+
+# 各段是独立的编码会话, 参数集 (SPS/PPS/VPS) 不一定相同, 而 concat 之后只剩第一段的 extradata: H.264 / HEVC 段
+# 和 smart cut 的编码片段一样用 dump_extra 把本段的参数集写进每个关键帧, 解码器到段首自己换参数集
+_INBAND_HEADER_ENCODERS = ("libx264", "libx265", "h264_", "hevc_")
+
+
+def _segment_jobs(input_path: str, bounds: list, seg_paths: list, video_args: list) -> list:
+    """每段一个只编视频的 ffmpeg 任务, 切点上输入 seek."""
+    encoder = None
+    for opt, value in zip(video_args, video_args[1:]):
+        if opt in _VIDEO_CODEC_OPTS or opt in ("-c", "-codec") or opt.startswith("-c:v:"):
+            encoder = value
+    # 不指定编码器时 mkv 默认 libx264; 用户自己给了 bitstream filter 就不加
+    inband = ((encoder is None or encoder.startswith(_INBAND_HEADER_ENCODERS))
+              and not any(a == "-bsf" or a.startswith("-bsf:v") for a in video_args))
+    jobs = []
+    for (start, end), seg in zip(bounds, seg_paths):
+        argv = ["-y", "-ss", f"{start:.6f}", "-i", input_path]
+        if end is not None:
+            argv += ["-t", f"{end - start:.6f}"]
+        argv += ["-map", "0:v:0"] + list(video_args) + (["-bsf:v", "dump_extra"] if inband else [])
+        jobs.append({"name": os.path.basename(seg), "args": argv + ["-an", "-sn", seg]})
+    return jobs
+
+
+def ffmpeg_parallel_transcode(input_path: str, output: str, video_args: list, audio_args: list | None = None,
+                              segments: int | None = None, max_parallel: int | None = None, retries: int = 2,
+                              timeout: int = 3600, notify=None, cancel: CancelToken | None = None) -> dict:
+    """按关键帧把长视频切成 GOP 对齐的段并行编码, 再 concat demuxer 无损拼回去.
+
+    视频段各自 -ss/-t 输入 seek (切点在关键帧上, 不丢不重帧), 音频整条单独编一次 (避免每段开头的编码器
+    priming 造成断音), 和视频段一起并行跑; 失败的段只重跑那一段, 最多 retries 次.
+    """
+    for path in (input_path, output):
+        if not _under_media_root(_media_path(path) or ""):
+            return {"success": False, "error": f"input and output must be under {MEDIA_ROOT}/: {path!r}"}
+    started = time.monotonic()
+    info = _probe_one(input_path, keyframes=True)
+    if "error" in info:
+        return {"success": False, "error": f"probe failed: {info['error']}"}
+    if not info.get("duration") or not info.get("keyframes"):
+        return {"success": False, "error": "input has no duration or no video keyframes"}
+    has_audio = any(st.get("codec_type") == "audio" for st in info.get("streams", []))
+
+    count = int(segments or max(2, _cpu_count() // 2))
+    # ffprobe 给的是绝对 pts (MPEG-TS / 剪过的 MP4 不从 0 开始), -ss 相对文件起点
+    offset = float(info.get("format", {}).get("start_time") or 0)
+    keyframes = [k - offset for k in info["keyframes"]]
+    bounds = _segment_bounds(keyframes, info["duration"], max(1, count))
+    work = os.path.join(MEDIA_ROOT, ".cache", f"parallel-{uuid.uuid4().hex[:12]}")
+    os.makedirs(work, exist_ok=True)
+    try:
+        seg_paths = [os.path.join(work, f"seg_{i:04d}.mkv") for i in range(len(bounds))]
+        jobs = _segment_jobs(input_path, bounds, seg_paths, list(video_args))
+        audio_path = os.path.join(work, "audio.mka")
+        if has_audio:
+            audio = list(audio_args) if audio_args is not None else ["-c:a", "aac", "-b:a", "160k"]
+            jobs.append({"name": "audio", "args": ["-y", "-i", input_path, "-map", "0:a:0", "-vn"] + audio + [audio_path]})
+
+        attempts = [0] * len(jobs)
+        results: list = [None] * len(jobs)
+        todo = list(range(len(jobs)))
+        encode_started = time.monotonic()
+        while todo:
+            batch = ffmpeg_batch([jobs[i] for i in todo], max_parallel, notify=notify, timeout=timeout, cancel=cancel)
+            for i, entry in zip(todo, batch["results"]):
+                attempts[i] += 1
+                results[i] = dict(entry, index=i, attempts=attempts[i])
+            if cancel is not None and cancel.cancelled:
+                return {"success": False, "error": "Cancelled", "cancelled": True, "segments": results}
+            todo = [i for i in todo if not results[i]["success"] and attempts[i] <= retries]
+        encode_elapsed = time.monotonic() - encode_started
+
+        failed = [r for r in results if not r["success"]]
+        report = {
+            "segments": len(bounds),
+            "cuts": [round(start, 3) for start, _ in bounds],
+            "retried": sum(1 for a in attempts if a > 1),
+            "encode_elapsed": round(encode_elapsed, 3),
+            "segment_time_total": round(sum(r.get("elapsed", 0) for r in results), 3),
         }
-    except subprocess.TimeoutExpired:
-        return {"success": False, "output": "", "error": f"Command timeout ({timeout}s)", "command": " ".join(docker_cmd)}
-    except Exception as e:
-        return {"success": False, "output": "", "error": str(e), "command": " ".join(docker_cmd)}
+        if failed:
+            return dict(report, success=False, error=f"{len(failed)} segment(s) failed after retries", failed=failed)
+
+        list_path = os.path.join(work, "segments.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.writelines(f"file '{seg}'\n" for seg in seg_paths)
+        argv = ["-y", "-f", "concat", "-safe", "0", "-i", list_path]
+        if has_audio:
+            argv += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+        argv += ["-c", "copy"]
+        if output.lower().endswith((".mp4", ".mov", ".m4v")):
+            argv += ["-movflags", "+faststart"]
+        concat = run_ffmpeg(argv + [output], timeout=timeout, cancel=cancel)
+        report.update({
+            "success": concat.get("success", False),
+            "output": output,
+            "elapsed": round(time.monotonic() - started, 3),
+            "command": concat.get("command"),
+        })
+        if not report["success"]:
+            report["error"] = concat.get("error", "")
+        return report
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def smart_trim(input_path: str, output: str, ranges: list, crf: int | None = None, audio_args: list | None = None,
+               max_parallel: int | None = None, timeout: int = 3600, notify=None,
+               cancel: CancelToken | None = None) -> dict:
+    """帧精确剪辑, 见 _smart_cut; 片段放在卷里的 .cache 下."""
+    for path in (input_path, output):
+        if not _under_media_root(_media_path(path) or ""):
+            return {"success": False, "error": f"input and output must be under {MEDIA_ROOT}/: {path!r}"}
+    if os.path.abspath(input_path) == os.path.abspath(output):
+        return {"success": False, "error": "output must differ from input"}
+    return _smart_cut(
+        input_path, output, ranges, crf, audio_args,
+        os.path.join(MEDIA_ROOT, ".cache", f"trim-{uuid.uuid4().hex[:12]}"),
+        lambda path: _probe_one(path, keyframes=True),
+        lambda jobs: ffmpeg_batch(jobs, max_parallel, notify=notify, timeout=timeout, cancel=cancel),
+        lambda argv: run_ffmpeg(argv, timeout=timeout, cancel=cancel),
+        cancel,
+    )
+
+
+def _pattern_files(pattern: str) -> list:
+    # 序列帧输出 (thumb_%03d.jpg) 对应的实际文件
+    return sorted(glob.glob(re.sub(r"%0?\d*d", "*", glob.escape(pattern).replace("%%", "%"))))
+
+
+def _rendition_args(spec: dict, label: str, audio_label: str | None) -> list:
+    out = spec["output"]
+    if spec.get("type") == "frames":
+        args = ["-map", f"[{label}]"]
+        if spec.get("count"):
+            args += ["-frames:v", str(int(spec["count"]))]
+        return args + list(spec.get("extra_args") or []) + [out]
+
+    args = ["-map", f"[{label}]", "-c:v", spec.get("vcodec", "libx264")]
+    if spec.get("video_bitrate"):
+        args += ["-b:v", str(spec["video_bitrate"])]
+    if spec.get("crf") is not None:
+        args += ["-crf", str(spec["crf"])]
+    if spec.get("preset"):
+        args += ["-preset", str(spec["preset"])]
+    if audio_label is not None:
+        args += ["-map", f"[{audio_label}]", "-c:a", spec.get("acodec", "aac")]
+        if spec.get("audio_bitrate"):
+            args += ["-b:a", str(spec["audio_bitrate"])]
+    if spec.get("format"):
+        args += ["-f", spec["format"]]
+    if out.lower().endswith((".mp4", ".mov", ".m4v")):
+        args += ["-movflags", "+faststart"]
+    return args + list(spec.get("extra_args") or []) + [out]
+
+
+def _video_filter(spec: dict, duration: float | None) -> str:
+    steps = []
+    if spec.get("type") == "frames":
+        if spec.get("interval"):
+            steps.append(f"fps=1/{float(spec['interval'])}")
+        elif spec.get("count") and duration:
+            steps.append(f"fps={int(spec['count'])}/{duration}")
+    if spec.get("scale"):
+        steps.append(f"scale={spec['scale']}")
+    elif spec.get("height"):
+        steps.append(f"scale=-2:{int(spec['height'])}")
+    elif spec.get("width"):
+        steps.append(f"scale={int(spec['width'])}:-2")
+    return ",".join(steps) or "null"
+
+
+def build_renditions(input_path: str, specs: list, has_audio: bool, duration: float | None) -> list:
+    """把多个输出规格编译成一条 ffmpeg 命令: 源只解码一次, split/asplit 分给各路输出."""
+    video_n = len(specs)
+    audio_specs = [i for i, spec in enumerate(specs)
+                   if has_audio and spec.get("type") != "frames" and spec.get("audio", True)]
+    graph = [f"[0:v]split={video_n}" + "".join(f"[s{i}]" for i in range(video_n))]
+    for i, spec in enumerate(specs):
+        graph.append(f"[s{i}]{_video_filter(spec, duration)}[v{i}]")
+    audio_labels: dict = {}
+    if audio_specs:
+        graph.append(f"[0:a]asplit={len(audio_specs)}" + "".join(f"[a{i}]" for i in audio_specs))
+        audio_labels = {i: f"a{i}" for i in audio_specs}
+
+    args = ["-y", "-i", input_path, "-filter_complex", ";".join(graph)]
+    for i, spec in enumerate(specs):
+        args += _rendition_args(spec, f"v{i}", audio_labels.get(i))
+    return args
+
+
+def _output_sizes(specs: list) -> list:
+    sizes = []
+    for spec in specs:
+        out = spec["output"]
+        if "%" in out:
+            files = _pattern_files(out)
+            sizes.append({"output": out, "files": len(files), "bytes": sum(os.path.getsize(f) for f in files)})
+        else:
+            entry = _local_stat(out) if _native_stat_enabled() else stat_paths([out])["results"][0]
+            sizes.append({"output": out, "bytes": entry.get("size")})
+    return sizes
+
+
+def ffmpeg_renditions(input_path: str, outputs: list, compare: bool = False, notify=None) -> dict:
+    """一个输入 + 多个输出规格 (码率阶梯 + 抽帧), 编译成单次解码的 ffmpeg 图."""
+    if not outputs:
+        return {"success": False, "error": "outputs must not be empty"}
+    for spec in outputs:
+        if not isinstance(spec, dict) or not spec.get("output") or not _under_media_root(_media_path(spec["output"]) or ""):
+            return {"success": False, "error": f"every output needs an `output` path under {MEDIA_ROOT}/: {spec!r}"}
+
+    info = _probe_one(input_path, keyframes=False)
+    if "error" in info:
+        return {"success": False, "error": f"probe failed: {info['error']}"}
+    streams = info.get("streams", [])
+    if not any(st.get("codec_type") == "video" for st in streams):
+        return {"success": False, "error": "input has no video stream"}
+    has_audio = any(st.get("codec_type") == "audio" for st in streams)
 
+    args = build_renditions(input_path, outputs, has_audio, info.get("duration"))
+    started = time.monotonic()
+    result = run_ffmpeg(args, notify)
+    elapsed = time.monotonic() - started
+    report = {
+        "success": result.get("success", False),
+        "elapsed": round(elapsed, 3),
+        "decodes_saved": len(outputs) - 1,
+        "command": result.get("command"),
+        "runner": result.get("runner"),
+    }
+    if not report["success"]:
+        report["error"] = result.get("error", "")
+        return report
+    report["outputs"] = _output_sizes(outputs)
 
-def run_ffmpeg(args: list) -> dict:
-    return _docker_run("zuozuoliang999/ffmpeg:8.1-cli", list(args), timeout=600)
+    if compare:
+        # 实测: 每路输出单独跑一遍 (写到临时目录), 和单次解码的耗时对比
+        scratch = os.path.join(MEDIA_ROOT, ".cache", f"renditions-compare-{uuid.uuid4().hex[:8]}")
+        os.makedirs(scratch, exist_ok=True)
+        try:
+            separate = 0.0
+            for i, spec in enumerate(outputs):
+                tmp_spec = dict(spec, output=os.path.join(scratch, f"{i}-{os.path.basename(spec['output'])}"))
+                t0 = time.monotonic()
+                run_ffmpeg(build_renditions(input_path, [tmp_spec], has_audio, info.get("duration")))
+                separate += time.monotonic() - t0
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        report["separate_elapsed"] = round(separate, 3)
+        report["saved"] = round(separate - elapsed, 3)
+    return report
+
+
+def extract_frames(input_path: str, output_dir: str, timestamps: list | None = None, count: int | None = None,
+                   scene: float | None = None, max_frames: int = 100, width: int | None = None,
+                   fmt: str = "jpg", contact_sheet=None, notify=None) -> dict:
+    """一次 ffmpeg 抽出多张预览帧, 替代每个时间点各起一个容器.
+
+    timestamps: 指定时间点 (秒); count: 均匀取 N 张 (需要 probe 时长); scene: 场景切换阈值 (0-1, select 滤镜整条扫描).
+    contact_sheet: true 或 {"output", "columns", "width"}, 把抽出的帧拼成一张接触表.
+    """
+    out_dir = _media_path(output_dir)
+    if out_dir is None:
+        return {"success": False, "error": f"output_dir must be under {MEDIA_ROOT}/: {output_dir!r}"}
+    if sum(x is not None for x in (timestamps, count, scene)) != 1:
+        return {"success": False, "error": "pass exactly one of timestamps, count, scene"}
+    fmt = fmt.lstrip(".").lower() or "jpg"
+    max_frames = max(1, int(max_frames))
 
+    sheet = None
+    if contact_sheet:
+        spec = contact_sheet if isinstance(contact_sheet, dict) else {}
+        sheet = {
+            "output": spec.get("output") or os.path.join(out_dir, f"contact_sheet.{fmt}"),
+            "columns": max(1, int(spec.get("columns", 5))),
+            "width": max(16, int(spec.get("width", 320))),
+        }
+        if _media_path(sheet["output"]) is None:
+            return {"success": False, "error": f"contact_sheet.output must be under {MEDIA_ROOT}/"}
+    if _native_stat_enabled():
+        os.makedirs(out_dir, exist_ok=True)
+
+    started = time.monotonic()
+    if scene is None:
+        duration = None
+        if count is not None:
+            info = _probe_one(input_path, keyframes=False)
+            if "error" in info:
+                return {"success": False, "error": f"probe failed: {info['error']}"}
+            duration = info.get("duration")
+            if not duration:
+                return {"success": False, "error": "input has no duration; pass timestamps instead"}
+            n = max(1, min(int(count), max_frames))
+            # 取每一份的中点, 避开片头黑场和片尾
+            timestamps = [duration * (i + 0.5) / n for i in range(n)]
+        try:
+            times = [max(0.0, float(t)) for t in timestamps][:max_frames]
+        except (TypeError, ValueError):
+            return {"success": False, "error": "timestamps must be numbers (seconds)"}
+        if not times:
+            return {"success": False, "error": "timestamps must not be empty"}
+        paths = [os.path.join(out_dir, f"frame_{i + 1:03d}.{fmt}") for i in range(len(times))]
+        if sheet is not None:
+            sheet["rows"] = -(-len(times) // sheet["columns"])
+        result = run_ffmpeg(build_frame_grab(input_path, times, paths, width, sheet), notify)
+        frames = [{"path": p, "time": round(t, 3)} for p, t in zip(paths, times)]
+    else:
+        # 场景切换要看相邻帧差异, 只能整条解码; showinfo 打出被选中帧的时间, 从 stderr 流里逐行收
+        chain = f"select='gt(scene,{float(scene)})',showinfo"
+        if width:
+            chain += f",scale={int(width)}:-2"
+        # 每次调用一个新前缀: 不碰目录里已有的文件, 也不会把上一次的帧算进来
+        pattern = os.path.join(out_dir, f"scene_{uuid.uuid4().hex[:8]}_%03d.{fmt}")
+        showinfo = ShowinfoTimes()
+        result = run_ffmpeg(["-y", "-i", input_path, "-vf", chain, "-fps_mode", "vfr",
+                             "-frames:v", str(max_frames), pattern], notify, on_stderr=showinfo.feed)
+        times = showinfo.times()
+        # server 看不到卷时按序号推出文件名
+        files = _pattern_files(pattern) or [pattern % (i + 1) for i in range(len(times))]
+        frames = [{"path": p, "time": round(t, 3) if t is not None else None}
+                  for p, t in zip(files, times + [None] * (len(files) - len(times)))]
+        if result.get("success") and sheet is not None and files:
+            sheet["rows"] = -(-len(files) // sheet["columns"])
+            tiled = run_ffmpeg(["-y", "-i", pattern, "-vf",
+                                f"scale={sheet['width']}:-2,tile={sheet['columns']}x{sheet['rows']}:padding=4:margin=4",
+                                "-frames:v", "1", "-update", "1", sheet["output"]])
+            if not tiled.get("success"):
+                result = tiled
 
-def run_imagemagick(args: str) -> dict:
+    report = {
+        "success": result.get("success", False),
+        "elapsed": round(time.monotonic() - started, 3),
+        "command": result.get("command"),
+        "runner": result.get("runner"),
+    }
+    if not report["success"]:
+        report["error"] = result.get("error", "")
+        return report
+    report["frames"] = frames
+    if sheet is not None and frames:
+        report["contact_sheet"] = sheet["output"]
+    return report
+
+
+def run_imagemagick(args: list | str, cache: bool | None = None, timeout: int = 300,
+                    cancel: CancelToken | None = None) -> dict:
+    """args 是 argv 列表, 或者按 shell 引号规则切分的字符串 (见 _split_args)."""
+    try:
+        argv = _split_args(args)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    return _cached(IMAGEMAGICK_IMAGE, argv, _magick_io(argv), cache,
+                   lambda: _run_imagemagick(argv, timeout, cancel))
+
+
+def _run_imagemagick(argv: list, timeout: int = 300, cancel: CancelToken | None = None) -> dict:
     result = _docker_run(
-        "zuozuoliang999/imagemagick:latest",
-        args.split(),
+        IMAGEMAGICK_IMAGE,
+        argv,
         entrypoint="magick",
-        timeout=300,
+        timeout=timeout,
+        cancel=cancel,
     )
+    if "metrics" in result and argv:
+        # 操作数 (50%, 800x600) 不是文件, _file_bytes 会跳过
+        out = _magick_output(argv)
+        inputs = argv if out is None else argv[:out]
+        result["metrics"]["input_bytes"] = _file_bytes([a for a in inputs if not a.startswith(("-", "+"))])
+        if out is not None:
+            result["metrics"]["output_bytes"] = _file_bytes([argv[out]]) if result.get("success") else 0
     merged = (result.get("output") or "") + (result.get("error") or "")
     result["output"] = merged.strip() if merged.strip() else "(no output)"
     return result
 
 
+# 单个 sh -c 脚本的上限: Linux 单个 argv 元素最多 128KB (MAX_ARG_STRLEN), 超过就拆成几次调用
+_MAGICK_SCRIPT_MAX = 96 * 1024
+# 每个文件回传的 magick 输出只留最后这么多字节
+_MAGICK_OUTPUT_TAIL = 2048
+
+
+def _magick_script(ops: list, parallel: int) -> str:
+    """一批 magick argv -> POSIX sh 脚本: parallel 条 lane 后台并行, 每条 lane 顺序跑分到的操作.
+
+    每个操作结束输出一行 "R <序号> <退出码> <lane>", 它的 stdout+stderr 逐行以 "O <序号> " 前缀输出;
+    一行远小于 PIPE_BUF, 多条 lane 并发写也不会交错.
+    """
+    lines = ["export MAGICK_THREAD_LIMIT=1"] if parallel > 1 else []
+    lanes: list = [[] for _ in range(parallel)]
+    for n, (index, argv) in enumerate(ops):
+        lanes[n % parallel].append((index, argv))
+    for lane, items in enumerate(lanes):
+        if not items:
+            continue
+        body = []
+        for index, argv in items:
+            body.append(f"out=$(magick {' '.join(shlex.quote(a) for a in argv)} 2>&1); rc=$?")
+            body.append(f'[ -n "$out" ] && printf \'%s\\n\' "$out" | while IFS= read -r l; do printf \'O {index} %s\\n\' "$l"; done')
+            body.append(f'echo "R {index} $rc {lane}"')
+        lines.append("(\n" + "\n".join(body) + "\n) &")
+    lines.append("wait")
+    return "\n".join(lines) + "\n"
+
+
+def _magick_chunks(ops: list, parallel: int) -> list:
+    """按脚本长度把操作切成几批, 每批一个 sh -c."""
+    chunks, current, size = [], [], 0
+    for index, argv in ops:
+        cost = sum(len(shlex.quote(a)) + 1 for a in argv) + 120
+        if current and size + cost > _MAGICK_SCRIPT_MAX:
+            chunks.append(current)
+            current, size = [], 0
+        current.append((index, argv))
+        size += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _expand_magick_glob(pattern: str, args: list, output: str) -> list | str:
+    """glob + 一组操作 + 输出模板 -> 每个文件一条 argv; 出错时返回错误信息.
+
+    模板占位符: {dir} 源文件目录, {name} 文件名, {stem} 去扩展名的文件名, {ext} 扩展名 (含点).
+    """
+    full = _media_path(pattern)
+    if full is None:
+        return f"glob must be under {MEDIA_ROOT}/: {pattern!r}"
+    if not output or "{" not in output:
+        return "output must be a template such as /home/media/outputs/{stem}.webp"
+    files = sorted(f for f in glob.glob(full) if os.path.isfile(f))
+    if not files:
+        return f"no files match {pattern!r}"
+    ops = []
+    for f in files:
+        stem, ext = os.path.splitext(os.path.basename(f))
+        try:
+            dest = output.format(dir=os.path.dirname(f), name=os.path.basename(f), stem=stem, ext=ext)
+        except (KeyError, IndexError, ValueError) as e:
+            return f"bad output template {output!r}: {e}"
+        ops.append({"name": os.path.basename(f), "args": [f] + list(args) + [dest]})
+    return ops
+
+
+def imagemagick_batch(operations: list | None = None, pattern: str | None = None, args: list | None = None,
+                      output: str | None = None, max_parallel: int | None = None, notify=None,
+                      timeout: int = 1800, cancel: CancelToken | None = None) -> dict:
+    """一批 magick 操作放进一个容器里跑, 容器内多条 lane 并行, 按文件返回结果.
+
+    operations: magick argv 列表 (或 {"name", "args"} 对象), 参数按列表原样传, 路径里有空格也没问题;
+    或者 pattern (glob) + args (一组操作) + output (输出模板), 对每个匹配的文件跑一遍.
+    """
+    if pattern:
+        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+            return {"success": False, "error": "args must be a list of strings"}
+        operations = _expand_magick_glob(pattern, args, output or "")
+        if isinstance(operations, str):
+            return {"success": False, "error": operations}
+    if not operations:
+        return {"success": False, "error": "pass operations, or glob + args + output"}
+
+    ops, results = [], [None] * len(operations)
+    for i, op in enumerate(operations):
+        argv = op.get("args") if isinstance(op, dict) else op
+        if not isinstance(argv, list) or len(argv) < 2 or not all(isinstance(a, str) for a in argv):
+            results[i] = {"index": i, "success": False, "error": "operation must be a magick argv list (inputs ... output)"}
+            continue
+        results[i] = {"index": i, "output": argv[-1]}
+        if isinstance(op, dict) and "name" in op:
+            results[i]["name"] = op["name"]
+        if _native_stat_enabled() and _media_path(argv[-1]):
+            with contextlib.suppress(OSError):
+                os.makedirs(os.path.dirname(_media_path(argv[-1])), exist_ok=True)
+        ops.append((i, argv))
+
+    parallel = _cpu_count()
+    if max_parallel:
+        parallel = min(parallel, max(1, int(max_parallel)))
+    parallel = max(1, min(parallel, len(ops) or 1))
+
+    texts: dict = {}
+    lane_clock: dict = {}
+    done = 0
+    lock = threading.Lock()
+
+    def on_line(line: str) -> None:
+        nonlocal done
+        kind, _, rest = line.rstrip("\n").partition(" ")
+        index, _, payload = rest.partition(" ")
+        if not index.isdigit() or int(index) >= len(results):
+            return
+        i = int(index)
+        if kind == "O":
+            texts[i] = (texts.get(i, "") + payload + "\n")[-_MAGICK_OUTPUT_TAIL:]
+            return
+        if kind != "R":
+            return
+        rc, _, lane = payload.partition(" ")
+        now = time.monotonic()
+        with lock:
+            done += 1
+            finished = done
+            results[i]["elapsed"] = round(now - lane_clock.get(lane, chunk_started), 3)
+            lane_clock[lane] = now
+        results[i]["success"] = rc == "0"
+        if notify is not None:
+            notify(finished, len(ops), f"{finished}/{len(ops)} images finished")
+
+    started = time.monotonic()
+    commands, runners = [], []
+    error = None
+    for chunk in _magick_chunks(ops, parallel):
+        if cancel is not None and cancel.cancelled:
+            error = "Cancelled"
+            break
+        chunk_started = time.monotonic()
+        lane_clock.clear()
+        run = _docker_run(IMAGEMAGICK_IMAGE, ["-c", _magick_script(chunk, min(parallel, len(chunk)))],
+                          entrypoint="sh", timeout=timeout, on_stdout_line=on_line, cancel=cancel)
+        commands.append(f"sh -c <script: {len(chunk)} magick commands>")
+        runners.append(run.get("runner"))
+        # 脚本最后是 wait, 退出码只反映容器/sh 本身; 单个 magick 的成败看 R 行
+        if not run.get("success"):
+            lines = (run.get("error") or "").strip().splitlines()
+            error = lines[0] if lines else "container failed"
+            break
+
+    for i, _ in ops:
+        entry = results[i]
+        if "success" not in entry:
+            entry.update({"success": False, "error": error or "not run"})
+        elif not entry["success"]:
+            entry["error"] = texts.get(i, "").strip() or "magick failed"
+        if entry["success"] and texts.get(i):
+            entry["text"] = texts[i].strip()
+        if entry["success"] and _native_stat_enabled():
+            with contextlib.suppress(OSError, TypeError):
+                entry["size"] = os.path.getsize(_media_path(entry["output"]))
+
+    succeeded = sum(1 for r in results if r.get("success"))
+    report = {
+        "success": succeeded == len(results),
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "parallel": parallel,
+        "containers": len(runners),
+        "runner": runners[0] if len(set(runners)) == 1 else runners,
+        "elapsed": round(time.monotonic() - started, 3),
+        "commands": commands,
+        "results": results,
+    }
+    if error:
+        report["error"] = error
+        if error.startswith("Cancelled"):
+            report["cancelled"] = True
+    return report
+
+
+def pipeline(steps: list, timeout: int = 3600, notify=None, cancel: CancelToken | None = None) -> dict:
+    """几步 ffmpeg / magick 用 OS 管道串起来跑, 中间的帧 (image2pipe / rawvideo) 不落到共享卷上, 见 _run_pipeline."""
+    try:
+        parsed = [step + (RUN_OPTS,) for step in _pipeline_steps(steps)]
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    # 中间的数据都经过本进程转发, 整条管道放在同一台 daemon 上就够了; 已经开始流数据的管道不换台重跑
+    host = DISPATCH.acquire(parsed[0][1])
+    try:
+        report = _run_pipeline(host, parsed, timeout, notify, cancel)
+    finally:
+        DISPATCH.release(host)
+    if len(DISPATCH.hosts) > 1:
+        report["host"] = host.name
+    return report
+
+
+def _native_stat_enabled() -> bool:
+    if NATIVE_STAT == "auto":
+        return os.path.isdir(MEDIA_ROOT)
+    return NATIVE_STAT not in ("0", "false", "no", "off")
+
+
+def _under_media_root(path: str) -> bool:
+    # 本地 stat 只放行卷内路径, 其它路径交给容器 (容器里也只看得到卷和镜像自身)
+    norm = os.path.normpath(path)
+    return norm == MEDIA_ROOT or norm.startswith(MEDIA_ROOT + "/")
+
+
+def _container_stat(paths: list) -> tuple:
+    result = _docker_run(BUSYBOX_IMAGE, ["sh", "-c", _STAT_SCRIPT, "sh"] + paths, timeout=30)
+    lines = result["output"].splitlines() if result["success"] else []
+    entries = []
+    for i, path in enumerate(paths):
+        size, _, mtime = (lines[i] if i < len(lines) else "-").partition(" ")
+        if size.isdigit() and mtime.isdigit():
+            entries.append({"path": path, "exists": True, "size": int(size), "mtime": float(mtime)})
+        else:
+            entries.append({"path": path, "exists": False})
+    return entries, result["command"]
+
+
+def stat_paths(paths: list) -> dict:
+    native = _native_stat_enabled()
+    entries: list = [None] * len(paths)
+    remote = []
+    for i, path in enumerate(paths):
+        if native and _under_media_root(path):
+            entries[i] = _local_stat(path)
+        else:
+            remote.append(i)
+
+    result: dict = {"method": "stat"}
+    if remote:
+        remote_entries, command = _container_stat([paths[i] for i in remote])
+        for i, entry in zip(remote, remote_entries):
+            entries[i] = entry
+        result = {"method": "container" if len(remote) == len(paths) else "mixed", "command": command}
+    result["results"] = entries
+    return result
+
+
 def file_exists(path: str) -> dict:
-    result = _docker_run("zuozuoliang999/busybox:latest", ["test", "-f", path], timeout=30)
-    return {"exists": result["success"], "path": path, "command": result["command"]}
+    result = stat_paths([path])
+    entry = result["results"][0]
+    entry["method"] = result["method"]
+    if "command" in result:
+        entry["command"] = result["command"]
+    return entry
+
+
+PROBE_CACHE = ProbeCache(PROBE_CACHE_DIR)
+
+
+def _ffprobe(args: list, timeout: int = 120) -> dict:
+    return _docker_run(FFMPEG_IMAGE, args, entrypoint="ffprobe", timeout=timeout)
+
+
+def _probe_one(path: str, keyframes: bool) -> dict:
+    st = None
+    if _native_stat_enabled() and _under_media_root(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {"path": path, "error": "No such file"}
+        entry = PROBE_CACHE.get(path, st)
+        if entry is not None and (not keyframes or "keyframes" in entry):
+            return dict(entry, path=path, cached=True)
+    else:
+        entry = None
+
+    if entry is None:
+        result = _ffprobe(_PROBE_ARGS + [path])
+        if not result["success"]:
+            return {"path": path, "error": result["error"].strip() or "ffprobe failed", "command": result["command"]}
+        try:
+            data = json.loads(result["output"] or "{}")
+        except ValueError:
+            return {"path": path, "error": "unparseable ffprobe output", "command": result["command"]}
+        fmt = data.get("format", {})
+        try:
+            duration = float(fmt.get("duration"))
+        except (TypeError, ValueError):
+            duration = None
+        entry = {"format": fmt, "streams": data.get("streams", []), "duration": duration}
+
+    if keyframes and "keyframes" not in entry:
+        result = _ffprobe(_KEYFRAME_ARGS + [path], timeout=600)
+        if not result["success"]:
+            return {"path": path, "error": result["error"].strip() or "keyframe scan failed", "command": result["command"]}
+        times = []
+        for line in result["output"].splitlines():
+            pts, _, flags = line.partition(",")
+            if "K" in flags:
+                with contextlib.suppress(ValueError):
+                    times.append(float(pts))
+        entry = dict(entry, keyframes=sorted(times))
+
+    if st is not None:
+        PROBE_CACHE.put(path, st, entry)
+    return dict(entry, path=path, cached=False)
+
+
+def probe(paths: list, keyframes: bool = False) -> dict:
+    results: list = [None] * len(paths)
+
+    def work(i: int) -> None:
+        results[i] = _probe_one(paths[i], keyframes)
+
+    threads = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(len(paths))]
+    # 一次最多 4 个 ffprobe 并行, 大批量时分批
+    for batch in range(0, len(threads), 4):
+        for t in threads[batch:batch + 4]:
+            t.start()
+        for t in threads[batch:batch + 4]:
+            t.join()
+    return {"results": results}
 
 
 TOOLS = [
@@ -83,7 +1697,8 @@ TOOLS = [
             f"Typical input is `{MEDIA_ROOT}/inputs/<file>`, write outputs to `{MEDIA_ROOT}/outputs/<file>` "
             f"so they auto-sync back to the bucket. "
             f"Example args: ['-i', '{MEDIA_ROOT}/inputs/in.mp4', '-c:v', 'libx264', '-crf', '23', "
-            f"'{MEDIA_ROOT}/outputs/out.mp4']"
+            f"'{MEDIA_ROOT}/outputs/out.mp4']. "
+            f"Progress is streamed as notifications/progress when the request carries a progressToken."
         ),
         "inputSchema": {
             "type": "object",
@@ -92,49 +1707,586 @@ TOOLS = [
                     "type": "array",
                     "items": {"type": "string"},
                     "description": f"ffmpeg argv. Use absolute paths under {MEDIA_ROOT}/ for all I/O files.",
-                }
+                },
+                "cache": {
+                    "type": "boolean",
+                    "description": "Reuse the output of an identical earlier run on unchanged inputs (server default applies if omitted)",
+                },
+                "stage": {
+                    "type": "boolean",
+                    "description": (
+                        "Copy inputs to local scratch disk and write outputs there, uploading them back afterwards. "
+                        "Much faster for seek-heavy work (faststart, two-pass, moov at end) on the network mount. "
+                        "Only available when the server has a scratch dir configured (server default applies if omitted)"
+                    ),
+                },
+                "tier": {
+                    "type": "string",
+                    "enum": ["latency", "balanced", "quality"],
+                    "description": (
+                        "Speed/quality tier for CPU encoders (libx264, libx265, libsvtav1): picks -preset "
+                        "(veryfast / medium / slow) unless args already set one. Server default applies if omitted"
+                    ),
+                },
             },
             "required": ["args"],
         },
     },
+    {
+        "name": "ffmpeg_batch",
+        "description": (
+            f"Run many independent ffmpeg jobs in one call, in parallel up to a CPU-aware limit. "
+            f"Each job is an ffmpeg argv (same rules as the `ffmpeg` tool, paths absolute under `{MEDIA_ROOT}/`). "
+            f"A failing job does not abort the others; per-job success, timing and errors are returned. "
+            f"Ideal for platform exports / renditions of one source."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "jobs": {
+                    "type": "array",
+                    "items": {
+                        "oneOf": [
+                            {"type": "array", "items": {"type": "string"}},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "args": {"type": "array", "items": {"type": "string"}},
+                                },
+                                "required": ["args"],
+                            },
+                        ]
+                    },
+                    "description": "ffmpeg argv lists, or {name, args} objects",
+                },
+                "max_parallel": {"type": "integer", "description": "Upper bound on jobs running at once (default: half the CPU cores)"},
+                "single_container": {
+                    "type": "boolean",
+                    "description": "Run every job inside one warm worker container instead of one container per job",
+                },
+                "cache": {"type": "boolean", "description": "Use the result cache for each job"},
+                "stage": {"type": "boolean", "description": "Stage each job's inputs/outputs through local scratch disk"},
+                "tier": {"type": "string", "enum": ["latency", "balanced", "quality"],
+                         "description": "Speed/quality tier applied to every job (see the ffmpeg tool)"},
+            },
+            "required": ["jobs"],
+        },
+    },
+    {
+        "name": "ffmpeg_renditions",
+        "description": (
+            f"Produce a renditions ladder (e.g. 1080p/720p/480p) plus frame extractions from ONE input in a single "
+            f"ffmpeg run: the source is decoded (and read from the volume) once and fanned out with split/asplit. "
+            f"Each output spec sets scale/height/width, vcodec, video_bitrate/crf/preset, acodec/audio_bitrate, format; "
+            f"frame specs use type='frames' with interval (seconds) or count. Returns per-output sizes. "
+            f"Paths absolute under `{MEDIA_ROOT}/`."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {"type": "string", "description": f"Source video, absolute under {MEDIA_ROOT}/"},
+                "outputs": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "output": {"type": "string", "description": "Output path (use %03d for frame sequences)"},
+                            "type": {"type": "string", "enum": ["video", "frames"]},
+                            "scale": {"type": "string", "description": "ffmpeg scale expression, e.g. 1280:-2"},
+                            "height": {"type": "integer"},
+                            "width": {"type": "integer"},
+                            "vcodec": {"type": "string"},
+                            "video_bitrate": {"type": "string"},
+                            "crf": {"type": "integer"},
+                            "preset": {"type": "string"},
+                            "acodec": {"type": "string"},
+                            "audio_bitrate": {"type": "string"},
+                            "audio": {"type": "boolean", "description": "Set false to drop audio from this output"},
+                            "format": {"type": "string", "description": "Container format (-f)"},
+                            "interval": {"type": "number", "description": "frames: one frame every N seconds"},
+                            "count": {"type": "integer", "description": "frames: number of frames, evenly spaced"},
+                            "extra_args": {"type": "array", "items": {"type": "string"}},
+                        },
+                        "required": ["output"],
+                    },
+                },
+                "compare": {
+                    "type": "boolean",
+                    "description": "Also run every output separately to measure the wall-clock saved (slow)",
+                },
+            },
+            "required": ["input", "outputs"],
+        },
+    },
+    {
+        "name": "ffmpeg_parallel_transcode",
+        "description": (
+            f"Transcode a long video using all cores: split at keyframes into GOP-aligned segments, encode them "
+            f"concurrently, and losslessly concat them into the output. Audio is encoded once, in parallel with the "
+            f"video segments. Failed segments are retried on their own. Use for hour-long inputs (e.g. under "
+            f"{MEDIA_ROOT}/inputs) with slow codecs/presets; submit through job_submit for long runs."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {"type": "string", "description": f"Source video, absolute under {MEDIA_ROOT}/"},
+                "output": {"type": "string", "description": f"Final output, absolute under {MEDIA_ROOT}/"},
+                "video_args": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Video encode options, e.g. [\"-c:v\", \"libx265\", \"-crf\", \"24\", \"-preset\", \"slow\"]",
+                },
+                "audio_args": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Audio encode options (default -c:a aac -b:a 160k)",
+                },
+                "segments": {"type": "integer", "description": "Number of segments (default: half the cores, at least 2)"},
+                "max_parallel": {"type": "integer", "description": "Segments encoded at once (default: half the cores)"},
+                "retries": {"type": "integer", "description": "Extra attempts per failed segment (default 2)"},
+                "timeout": {"type": "integer", "description": "Per-segment timeout in seconds (default 3600)"},
+            },
+            "required": ["input", "output", "video_args"],
+        },
+    },
     {
         "name": "imagemagick",
         "description": (
             f"Run ImageMagick `magick` CLI in a sandbox container against the team-shared media volume. "
             f"All paths MUST be absolute under `{MEDIA_ROOT}/`. "
-            f"Example args: '{MEDIA_ROOT}/inputs/a.png -resize 50% {MEDIA_ROOT}/outputs/a-small.png'"
+            f"Example args: ['{MEDIA_ROOT}/inputs/a.png', '-resize', '50%', '{MEDIA_ROOT}/outputs/a-small.png']"
         ),
         "inputSchema": {
             "type": "object",
             "properties": {
                 "args": {
-                    "type": "string",
-                    "description": f"Whitespace-separated magick arguments. Paths absolute under {MEDIA_ROOT}/.",
-                }
+                    "oneOf": [{"type": "array", "items": {"type": "string"}}, {"type": "string"}],
+                    "description": (f"magick argv (preferred), or one string split with shell quoting rules "
+                                    f"(quote paths that contain spaces). Paths absolute under {MEDIA_ROOT}/."),
+                },
+                "cache": {
+                    "type": "boolean",
+                    "description": "Reuse the output of an identical earlier run on unchanged inputs (server default applies if omitted)",
+                },
             },
             "required": ["args"],
         },
     },
+    {
+        "name": "extract_frames",
+        "description": (
+            "Extract many preview frames from a video in ONE ffmpeg process (instead of one ffmpeg call per "
+            "timestamp), optionally tiled into a contact sheet. Choose exactly one of `timestamps` (seconds), "
+            "`count` (N evenly spaced frames) or `scene` (scene-change threshold 0-1, scans the whole video). "
+            f"Frames are written as frame_001.jpg ... (scene_<random>_001.jpg ... for scene mode, a fresh prefix per call) into `output_dir` under `{MEDIA_ROOT}/`; "
+            "the response lists each frame path with its timestamp."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {"type": "string", "description": f"Source video, absolute under {MEDIA_ROOT}/"},
+                "output_dir": {"type": "string", "description": f"Directory for the frames, absolute under {MEDIA_ROOT}/"},
+                "timestamps": {"type": "array", "items": {"type": "number"}, "description": "Frame times in seconds"},
+                "count": {"type": "integer", "description": "Number of evenly spaced frames"},
+                "scene": {"type": "number", "description": "Scene-change threshold, e.g. 0.3"},
+                "max_frames": {"type": "integer", "description": "Upper bound on frames written (default 100)"},
+                "width": {"type": "integer", "description": "Scale frames to this width (keeps aspect)"},
+                "format": {"type": "string", "description": "Image format/extension: jpg (default), png, webp"},
+                "contact_sheet": {
+                    "oneOf": [
+                        {"type": "boolean"},
+                        {
+                            "type": "object",
+                            "properties": {
+                                "output": {"type": "string", "description": "Sheet path (default <output_dir>/contact_sheet.<format>)"},
+                                "columns": {"type": "integer", "description": "Tiles per row (default 5)"},
+                                "width": {"type": "integer", "description": "Tile width in px (default 320)"},
+                            },
+                        },
+                    ],
+                    "description": "Also tile the frames into one contact-sheet image",
+                },
+            },
+            "required": ["input", "output_dir"],
+        },
+    },
+    {
+        "name": "trim",
+        "description": (
+            "Frame-accurate cut at near stream-copy speed (smart cut). Probes keyframes, re-encodes only the partial "
+            "GOPs at each cut point, stream-copies everything in between and joins the pieces with the concat demuxer. "
+            "Pass several `ranges` to build a highlight reel: they are joined in order into one output. Audio is cut "
+            "exactly per range and encoded once (AAC 192k unless `audio_args`). Source video must be h264 or hevc; "
+            f"paths absolute under `{MEDIA_ROOT}/`. Use instead of `-ss/-to -c copy` (drops frames at non-keyframe cuts) "
+            "or a full re-encode."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "input": {"type": "string", "description": f"Source video, absolute under {MEDIA_ROOT}/"},
+                "output": {"type": "string", "description": f"Output file, absolute under {MEDIA_ROOT}/"},
+                "ranges": {
+                    "type": "array",
+                    "items": {
+                        "oneOf": [
+                            {"type": "array", "items": {"type": "number"}, "minItems": 1, "maxItems": 2},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "start": {"type": "number", "description": "Seconds"},
+                                    "end": {"type": "number", "description": "Seconds; omit for end of file"},
+                                },
+                            },
+                        ]
+                    },
+                    "description": "Cut ranges in seconds, e.g. [[12.5, 30], {\"start\": 95, \"end\": 110.04}]",
+                },
+                "crf": {"type": "integer", "description": "CRF for the re-encoded boundary pieces (default 18)"},
+                "audio_args": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Audio codec options (default ['-c:a', 'aac', '-b:a', '192k'])",
+                },
+                "max_parallel": {"type": "integer", "description": "Pieces encoded at once"},
+                "timeout": {"type": "integer", "description": "Seconds each piece and the final join may take (default 3600)"},
+            },
+            "required": ["input", "output", "ranges"],
+        },
+    },
+    {
+        "name": "pipeline",
+        "description": (
+            "Chain ffmpeg and ImageMagick steps with OS pipes so intermediate frames never touch the shared volume "
+            "(e.g. ffmpeg frame dump -> magick edit -> ffmpeg encode). Each step runs in its own container; step N's "
+            "stdout feeds step N+1's stdin with backpressure. Producers write to stdout (ffmpeg: `-f image2pipe "
+            "-c:v ppm pipe:1` or `-f rawvideo -pix_fmt rgb24 pipe:1`; magick: `ppm:-`), consumers read stdin "
+            "(ffmpeg: `-f image2pipe -framerate 30 -i pipe:0`; magick: `ppm:-`). ImageMagick reads its whole input "
+            "before writing, so keep magick steps to short sequences. Reports per-step exit code and stderr tail, "
+            "per-link bytes, MB/s and wait times, and the bottleneck step."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "tool": {"type": "string", "enum": ["ffmpeg", "imagemagick"]},
+                            "args": {
+                                "oneOf": [{"type": "array", "items": {"type": "string"}}, {"type": "string"}],
+                                "description": "ffmpeg / magick argv (a string is split with shell quoting rules "
+                                               "for imagemagick)",
+                            },
+                        },
+                        "required": ["tool", "args"],
+                    },
+                    "description": "Two or more steps, in pipe order",
+                },
+                "timeout": {"type": "integer", "description": "Seconds before every step is killed (default 3600)"},
+            },
+            "required": ["steps"],
+        },
+    },
+    {
+        "name": "imagemagick_batch",
+        "description": (
+            "Run many ImageMagick operations inside ONE container (parallel lanes inside it) instead of one "
+            "container per image, with per-file results. Either pass `operations` (each a magick argv list: "
+            "inputs, options, output last) or `glob` + `args` + `output` template to apply one operation to every "
+            "matching file. Arguments are passed as lists, so paths with spaces are fine. "
+            f"Paths absolute under `{MEDIA_ROOT}/`. Example: glob '{MEDIA_ROOT}/inputs/photos/*.jpg', "
+            f"args ['-resize', '50%'], output '{MEDIA_ROOT}/outputs/photos/{{stem}}.webp'."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "operations": {
+                    "type": "array",
+                    "items": {
+                        "oneOf": [
+                            {"type": "array", "items": {"type": "string"}},
+                            {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "args": {"type": "array", "items": {"type": "string"}},
+                                },
+                                "required": ["args"],
+                            },
+                        ]
+                    },
+                    "description": "magick argv lists (without the leading `magick`), output path last",
+                },
+                "glob": {"type": "string", "description": f"Input file pattern under {MEDIA_ROOT}/, e.g. .../*.png"},
+                "args": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "glob mode: options applied to each file, e.g. ['-resize', '800x800>', '-quality', '85']",
+                },
+                "output": {
+                    "type": "string",
+                    "description": "glob mode: output path template with {dir} {name} {stem} {ext}",
+                },
+                "max_parallel": {"type": "integer", "description": "Parallel lanes inside the container (default: CPU count)"},
+            },
+        },
+    },
+    {
+        "name": "probe",
+        "description": (
+            f"Probe media files with ffprobe and return structured JSON: streams, format and duration "
+            f"(optionally the video keyframe timestamps). Accepts many files per call; results are cached "
+            f"by path+size+mtime. Use this instead of `ffmpeg -i` to inspect media. Paths absolute under `{MEDIA_ROOT}/`."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": f"Absolute path under {MEDIA_ROOT}/"},
+                "paths": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": f"Batch mode: absolute paths under {MEDIA_ROOT}/, results come back in the same order",
+                },
+                "keyframes": {
+                    "type": "boolean",
+                    "description": "Also return the keyframe timestamps (seconds) of the first video stream",
+                },
+            },
+        },
+    },
+    {
+        "name": "job_submit",
+        "description": (
+            "Start a long ffmpeg/imagemagick/ffmpeg_batch/ffmpeg_parallel_transcode/trim/pipeline run in the background and return a job_id immediately. "
+            "Poll with job_status, stop with job_cancel (kills the container), fetch output with job_result. "
+            f"Jobs get their own timeout (default {JOB_TIMEOUT}s) instead of the 600s limit of the direct tools."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "tool": {"type": "string", "enum": ["ffmpeg", "imagemagick", "ffmpeg_batch", "ffmpeg_parallel_transcode",
+                                                   "imagemagick_batch", "trim", "pipeline"]},
+                "arguments": {"type": "object", "description": "Same arguments the tool takes when called directly"},
+                "timeout": {"type": "integer", "description": "Seconds before the job is killed"},
+            },
+            "required": ["tool", "arguments"],
+        },
+    },
+    {
+        "name": "job_status",
+        "description": "Status, elapsed time, progress and recent log lines of a background job; all jobs when job_id is omitted.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"job_id": {"type": "string"}},
+        },
+    },
+    {
+        "name": "job_cancel",
+        "description": "Cancel a queued or running background job; the container doing the work is removed.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"job_id": {"type": "string"}},
+            "required": ["job_id"],
+        },
+    },
+    {
+        "name": "job_result",
+        "description": "Full result (output, stderr tail, stats) and log of a finished background job.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"job_id": {"type": "string"}},
+            "required": ["job_id"],
+        },
+    },
+    {
+        "name": "server_stats",
+        "description": (
+            "Per-tool call counts, errors, warm/cold runner split, phase timings (queue, acquire, start, run, "
+            "teardown, total), CPU seconds, peak RSS and bytes read/written since the server started."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "format": {"type": "string", "enum": ["json", "prometheus"],
+                           "description": "prometheus also returns the text exposition format"},
+            },
+        },
+    },
+    {
+        "name": "server_status",
+        "description": (
+            "Readiness of the docker images checked at startup (present / pulling / missing, pull and check time) "
+            "and the warm worker pools (idle, busy, starting). Call it after deploying to see whether the first "
+            "real job will hit a cold image."
+        ),
+        "inputSchema": {"type": "object", "properties": {}},
+    },
     {
         "name": "file_exists",
-        "description": f"Check whether a file exists in the team-shared media volume. Path must be absolute under `{MEDIA_ROOT}/`.",
+        "description": (
+            f"Check whether files exist in the team-shared media volume and return size/mtime for each. "
+            f"Paths must be absolute under `{MEDIA_ROOT}/`. Pass `path` for one file or `paths` to check many in one call."
+        ),
         "inputSchema": {
             "type": "object",
             "properties": {
-                "path": {"type": "string", "description": f"Absolute path under {MEDIA_ROOT}/"}
+                "path": {"type": "string", "description": f"Absolute path under {MEDIA_ROOT}/"},
+                "paths": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": f"Batch mode: absolute paths under {MEDIA_ROOT}/, results come back in the same order",
+                },
             },
-            "required": ["path"],
         },
     },
 ]
 
 
+SCHEDULER = JobScheduler(_parse_concurrency(os.environ.get("FFMPEG_MCP_CONCURRENCY", ""), DEFAULT_CONCURRENCY))
+
+
+def _parallel_transcode_call(a: dict, notify=None, timeout: int = 3600, cancel: CancelToken | None = None) -> dict:
+    return ffmpeg_parallel_transcode(
+        a.get("input", ""),
+        a.get("output", ""),
+        list(a.get("video_args") or []),
+        a.get("audio_args"),
+        a.get("segments"),
+        a.get("max_parallel"),
+        int(a.get("retries", 2)),
+        int(a.get("timeout") or timeout),
+        notify,
+        cancel,
+    )
+
+
+def _trim_call(a: dict, notify=None, timeout: int = 3600, cancel: CancelToken | None = None) -> dict:
+    return smart_trim(
+        a.get("input", ""),
+        a.get("output", ""),
+        list(a.get("ranges") or []),
+        a.get("crf"),
+        a.get("audio_args"),
+        a.get("max_parallel"),
+        int(a.get("timeout") or timeout),
+        notify,
+        cancel,
+    )
+
+
+def _imagemagick_batch_call(a: dict, notify=None, timeout: int = 1800, cancel: CancelToken | None = None) -> dict:
+    return imagemagick_batch(
+        a.get("operations"),
+        a.get("glob"),
+        a.get("args"),
+        a.get("output"),
+        a.get("max_parallel"),
+        notify,
+        timeout,
+        cancel,
+    )
+
+
+# 可以放到后台跑的工具: (arguments, notify, timeout, cancel) -> result
+_JOB_TOOLS = {
+    "ffmpeg": lambda a, notify, timeout, cancel: run_ffmpeg(
+        a.get("args", []), notify, a.get("cache"), timeout=timeout, cancel=cancel, stage=a.get("stage"),
+        tier=a.get("tier")),
+    "imagemagick": lambda a, notify, timeout, cancel: run_imagemagick(
+        a.get("args", ""), a.get("cache"), timeout=timeout, cancel=cancel),
+    "ffmpeg_batch": lambda a, notify, timeout, cancel: ffmpeg_batch(
+        list(a.get("jobs") or []), a.get("max_parallel"), bool(a.get("single_container")), a.get("cache"),
+        notify, timeout=timeout, cancel=cancel, stage=a.get("stage"), tier=a.get("tier")),
+    "ffmpeg_parallel_transcode": lambda a, notify, timeout, cancel: _parallel_transcode_call(
+        a, notify, timeout, cancel),
+    "imagemagick_batch": _imagemagick_batch_call,
+    "trim": _trim_call,
+    "pipeline": lambda a, notify, timeout, cancel: pipeline(
+        list(a.get("steps") or []), int(a.get("timeout") or timeout), notify, cancel),
+}
+
+JOBS = JobTable(_JOB_TOOLS, SCHEDULER)
+atexit.register(JOBS.shutdown)
+
+
+def call_tool(tool_name: str, arguments: dict, notify=None) -> dict | None:
+    if tool_name == "ffmpeg":
+        return run_ffmpeg(arguments.get("args", []), notify, arguments.get("cache"), stage=arguments.get("stage"),
+                          tier=arguments.get("tier"))
+    if tool_name == "ffmpeg_batch":
+        return ffmpeg_batch(
+            list(arguments.get("jobs") or []),
+            arguments.get("max_parallel"),
+            bool(arguments.get("single_container")),
+            arguments.get("cache"),
+            notify,
+            stage=arguments.get("stage"),
+            tier=arguments.get("tier"),
+        )
+    if tool_name == "ffmpeg_renditions":
+        return ffmpeg_renditions(
+            arguments.get("input", ""),
+            list(arguments.get("outputs") or []),
+            bool(arguments.get("compare")),
+            notify,
+        )
+    if tool_name == "ffmpeg_parallel_transcode":
+        return _parallel_transcode_call(arguments, notify)
+    if tool_name == "trim":
+        return _trim_call(arguments, notify)
+    if tool_name == "pipeline":
+        return pipeline(list(arguments.get("steps") or []), int(arguments.get("timeout") or 3600), notify)
+    if tool_name == "imagemagick":
+        return run_imagemagick(arguments.get("args", ""), arguments.get("cache"))
+    if tool_name == "imagemagick_batch":
+        return _imagemagick_batch_call(arguments, notify)
+    if tool_name == "extract_frames":
+        return extract_frames(
+            arguments.get("input", ""),
+            arguments.get("output_dir", ""),
+            arguments.get("timestamps"),
+            arguments.get("count"),
+            arguments.get("scene"),
+            int(arguments.get("max_frames") or 100),
+            arguments.get("width"),
+            arguments.get("format") or "jpg",
+            arguments.get("contact_sheet"),
+            notify,
+        )
+    if tool_name == "probe":
+        paths = list(arguments.get("paths") or []) if "paths" in arguments else [arguments.get("path", "")]
+        return probe(paths, bool(arguments.get("keyframes")))
+    if tool_name == "job_submit":
+        return JOBS.tool_submit(arguments.get("tool", ""), arguments.get("arguments") or {}, arguments.get("timeout"))
+    if tool_name == "job_status":
+        return JOBS.tool_status(arguments.get("job_id"))
+    if tool_name == "job_cancel":
+        return JOBS.tool_cancel(arguments.get("job_id", ""))
+    if tool_name == "job_result":
+        return JOBS.tool_result(arguments.get("job_id", ""))
+    if tool_name == "server_stats":
+        report = METRICS.snapshot()
+        if arguments.get("format") == "prometheus":
+            report["prometheus"] = METRICS.prometheus()
+        return dict(report, success=True)
+    if tool_name == "server_status":
+        return dict(DISPATCH.status(), coalescing=FLIGHTS.stats(), success=True)
+    if tool_name == "file_exists":
+        if "paths" in arguments:
+            return stat_paths(list(arguments.get("paths") or []))
+        return file_exists(arguments.get("path", ""))
+    return None
+
+
 def handle_request(request: dict) -> None:
     method = request.get("method")
     rid = request.get("id")
     params = request.get("params", {})
 
     if method == "initialize":
+        DISPATCH.start_preflight()
         send_result(rid, {
             "protocolVersion": "2024-11-05",
             "capabilities": {"tools": {}},
@@ -153,23 +2305,42 @@ def handle_request(request: dict) -> None:
         tool_name = params.get("name")
         arguments = params.get("arguments", {}) or {}
 
-        if tool_name == "ffmpeg":
-            result = run_ffmpeg(arguments.get("args", []))
-        elif tool_name == "imagemagick":
-            result = run_imagemagick(arguments.get("args", ""))
-        elif tool_name == "file_exists":
-            result = file_exists(arguments.get("path", ""))
-        else:
+        if tool_name not in {tool["name"] for tool in TOOLS}:
             send_error(rid, -32601, f"Unknown tool: {tool_name}")
             return
 
-        send_result(rid, {"content": [{"type": "text", "text": json.dumps(result, indent=2, ensure_ascii=False)}]})
+        notify = _progress_notifier((params.get("_meta") or {}).get("progressToken"))
+        queued = time.monotonic()
+        with SCHEDULER.slot(tool_name):
+            queue = time.monotonic() - queued
+            result = call_tool(tool_name, arguments, notify)
+        if tool_name not in ("server_stats", "server_status"):
+            if isinstance(result, dict) and "metrics" in result:
+                result["metrics"] = dict(queue_s=round(queue, 4), **result["metrics"])
+            METRICS.observe(tool_name, result, time.monotonic() - queued, queue)
+            if METRICS_FILE:
+                METRICS.write_file(METRICS_FILE)
+
+        send_tool_result(rid, result)
         return
 
     send_error(rid, -32601, f"Method not found: {method}")
 
 
+def _handle_safely(request: dict) -> None:
+    try:
+        handle_request(request)
+    except Exception as e:
+        _log(f"handler error: {e}")
+        if request.get("id") is not None:
+            send_error(request.get("id"), -32603, f"Internal error: {e}")
+
+
 def main() -> None:
+    # tools/call 每个请求一个线程并发执行 (最多 MAX_INFLIGHT 个), 响应按 id 乱序返回; 其余方法都很轻, 直接在读循环里处理
+    if METRICS_PORT:
+        _serve_metrics(METRICS_PORT)
+    gate = CallGate(MAX_INFLIGHT)
     for line in sys.stdin:
         line = line.strip()
         if not line:
@@ -178,11 +2349,12 @@ def main() -> None:
             request = json.loads(line)
         except json.JSONDecodeError:
             continue
-        try:
-            handle_request(request)
-        except Exception as e:
-            sys.stderr.write(f"handler error: {e}\n")
-            sys.stderr.flush()
+        if request.get("method") == "tools/call":
+            gate.start(request, _handle_safely)
+        else:
+            _handle_safely(request)
+    # stdin 关闭后等在跑的任务把响应写完再退出
+    gate.join()
 
 
 if __name__ == "__main__":
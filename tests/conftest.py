@@ -0,0 +1,96 @@
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# server.py / server_linux.py 是仓库根目录下的单文件脚本, 不是包
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    """server_linux 的 MEDIA_ROOT 换成临时目录, 里面放几个输入文件."""
+    import server_linux
+
+    root = str(tmp_path)
+    monkeypatch.setattr(server_linux, "MEDIA_ROOT", root)
+    monkeypatch.setattr(server_linux, "_MEDIA_PATH_RE", re.compile(re.escape(root) + r"/[^\s'\",;\[\]|]+"))
+    for name in ("a.png", "b.png", "in.mp4", "logo.png"):
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(b"version1")
+    return root
+
+
+class FakeDocker:
+    """PATH 里的 docker 换成 fake_docker.py; 状态目录里记着每条命令和还活着的 worker 容器."""
+
+    def __init__(self, state: str):
+        self.state = state
+        self.host = None
+
+    def calls(self, verb: str | None = None) -> list:
+        path = os.path.join(self.state, "calls.log")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            calls = [json.loads(line) for line in f]
+        return [argv for argv in calls if verb is None or argv[0] == verb]
+
+    def kill(self, cid: str) -> None:
+        """模拟容器自己挂掉: 之后 inspect 报不在, exec 报 No such container."""
+        os.remove(os.path.join(self.state, cid))
+
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    """一台走 fake_docker.py CLI 的 DockerHost (不连 Engine API), 测完收掉它的 worker 池."""
+    import mcp_common
+
+    bindir = tmp_path / "bin"
+    state = tmp_path / "docker-state"
+    bindir.mkdir()
+    state.mkdir()
+    script = bindir / "docker"
+    script.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(REPO, "fake_docker.py")}" "$@"\n')
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ.get('PATH', '')}")
+    monkeypatch.setenv("FAKE_DOCKER_STATE", str(state))
+    monkeypatch.setenv("FAKE_DOCKER_LATENCY_MS", "0")
+    monkeypatch.setenv("FAKE_DOCKER_STDERR_KB", "0")
+    fake = FakeDocker(str(state))
+    fake.host = mcp_common.DockerHost(f"fake://{tmp_path.name}", address="")
+    yield fake
+    with mcp_common._POOLS_LOCK:
+        keys = [key for key in mcp_common._POOLS if key[0] == fake.host.name]
+        pools = [mcp_common._POOLS.pop(key) for key in keys]
+    for pool in pools:
+        mcp_common._remove_containers(pool.shutdown(), fake.host)
+
+
+@pytest.fixture
+def fake_docker_api(fake_docker, monkeypatch):
+    """fake_docker_api.py 的 Engine API 起在一个临时 unix socket 上, host 走 API; CLI 仍是 fake_docker, 用来确认没被 fork."""
+    import fake_docker as emulator
+    import fake_docker_api
+    import mcp_common
+
+    # fake_docker 的参数在 import 时就从环境变量读好了, 进程内的假 daemon 直接改模块属性
+    monkeypatch.setattr(emulator, "LATENCY", 0.0)
+    monkeypatch.setattr(emulator, "STDERR_KB", 0)
+    monkeypatch.setattr(mcp_common, "DOCKER_API", True)
+    # unix socket 路径有 108 字节的上限, tmp_path 太长
+    sockdir = tempfile.mkdtemp(prefix="fake-docker-")
+    address = os.path.join(sockdir, "docker.sock")
+    server = fake_docker_api.Server(address, fake_docker_api.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake_docker.host = mcp_common.DockerHost(f"unix://{address}", address=address)
+    yield fake_docker
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(sockdir, ignore_errors=True)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+import mcp_common
+import server_linux
+from mcp_common import JobScheduler
+
+
+class _Tracker:
+    """假的 run_ffmpeg: 记录同时在跑的个数, 按 argv 里的时长睡一会儿."""
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.order = []
+        self._lock = threading.Lock()
+
+    def __call__(self, argv, **kwargs):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(float(argv[1]))
+        with self._lock:
+            self.running -= 1
+            self.order.append(argv[0])
+        return {"success": argv[0] != "bad", "error": "boom", "runner": "warm", "command": " ".join(argv)}
+
+
+@pytest.fixture(autouse=True)
+def many_cpus(monkeypatch):
+    monkeypatch.setattr(mcp_common, "_cpu_count", lambda: 16)
+
+
+def _jobs(durations):
+    return [{"name": f"job{i}", "args": [f"job{i}" if d >= 0 else "bad", str(abs(d))]}
+            for i, d in enumerate(durations)]
+
+
+def test_batch_results_keep_input_order():
+    run = _Tracker()
+    durations = [0.15, 0.01, 0.1, 0.0, 0.05, 0.02]
+    notes = []
+    report = mcp_common._run_batch(_jobs(durations), 3, run, notify=lambda done, total, msg: notes.append(done))
+    assert report["parallel"] == 3
+    assert [r["index"] for r in report["results"]] == list(range(6))
+    assert [r["name"] for r in report["results"]] == [f"job{i}" for i in range(6)]
+    assert run.order != [f"job{i}" for i in range(6)]  # 完成顺序和输入顺序不同
+    assert sorted(notes) == list(range(1, 7))
+
+
+def test_batch_failure_does_not_stop_other_jobs():
+    report = mcp_common._run_batch(_jobs([0.0, -0.001, 0.0]) + [["bad-argv", 1]], 2, _Tracker())
+    assert (report["succeeded"], report["failed"]) == (2, 2)
+    assert report["results"][1]["error"] == "boom"
+    assert "argv list" in report["results"][3]["error"]
+
+
+@pytest.mark.parametrize("limit, max_parallel, lanes", [(2, 8, 2), (4, 3, 3), (0, 5, 5)])
+def test_batch_lanes_respect_the_tool_limit(limit, max_parallel, lanes):
+    scheduler = JobScheduler({"ffmpeg": limit})
+    run = _Tracker()
+    report = mcp_common._run_batch(_jobs([0.05] * 8), max_parallel, run, scheduler=scheduler, tool="ffmpeg")
+    assert report["parallel"] == lanes
+    assert run.peak == lanes
+
+
+def test_batch_jobs_share_the_limit_with_direct_calls():
+    # 一个直接调用占着一个槽时, 批量里的任务最多同时跑 limit - 1 个
+    scheduler = JobScheduler({"ffmpeg": 3})
+    run = _Tracker()
+    with scheduler.slot("ffmpeg"):
+        worker = threading.Thread(target=mcp_common._run_batch, args=(_jobs([0.05] * 6), 8, run),
+                                  kwargs={"scheduler": scheduler, "tool": "ffmpeg"})
+        worker.start()
+        time.sleep(0.2)
+        assert run.peak == 2
+    worker.join(10)
+    assert run.peak <= 3 and len(run.order) == 6
+
+
+def test_ffmpeg_batch_counts_each_job_against_the_ffmpeg_limit(monkeypatch):
+    run = _Tracker()
+    monkeypatch.setattr(server_linux, "SCHEDULER", JobScheduler({"ffmpeg": 2, "ffmpeg_batch": 1}))
+    monkeypatch.setattr(server_linux, "run_ffmpeg", run)
+    report = server_linux.ffmpeg_batch(_jobs([0.05] * 6), max_parallel=6)
+    assert report["success"] and report["parallel"] == 2 and run.peak == 2
+
+
+def test_cancelled_batch_skips_jobs_that_have_not_started():
+    cancel = mcp_common.CancelToken()
+    run = _Tracker()
+
+    def first_cancels(argv, **kwargs):
+        cancel.cancel()
+        return run(argv)
+
+    report = mcp_common._run_batch(_jobs([0.0] * 4), 1, first_cancels, cancel=cancel)
+    assert [r.get("cancelled", False) for r in report["results"]] == [False, True, True, True]
@@ -0,0 +1,20 @@
+import pytest
+
+import mcp_common
+
+
+@pytest.mark.parametrize("limit, chunks", [
+    (10, [b"abcdefgh"] * 3),
+    (10, [b"0123456789"] * 2),
+    (10, [b"x"] * 25),
+    (10, [b"a" * 30]),
+    (10, [b"abc", b"0123456789abcdef", b"zz"]),
+    (64, [b"short", b"line\n"]),
+])
+def test_tail_buffer_keeps_exactly_the_last_limit_bytes(limit, chunks):
+    buf = mcp_common._TailBuffer(limit)
+    for chunk in chunks:
+        buf.write(chunk)
+    data = b"".join(chunks)
+    assert buf.getvalue() == data[-limit:].decode()
+    assert buf.dropped == max(0, len(data) - limit)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+import mcp_common
+import server_linux
+from mcp_common import CallGate, JobScheduler
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """send 的 payload 都记下来, 不写 stdout."""
+    out = []
+    monkeypatch.setattr(mcp_common, "send", out.append)
+    return out
+
+
+@pytest.fixture
+def tools(monkeypatch):
+    """call_tool 换成假的: 记录同时在跑的个数, 放行之前一直卡着."""
+    state = {"running": 0, "peak": 0, "calls": 0, "release": threading.Event()}
+    lock = threading.Lock()
+
+    def call_tool(tool_name, arguments, notify=None):
+        with lock:
+            state["calls"] += 1
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        state["release"].wait(10)
+        with lock:
+            state["running"] -= 1
+        return {"success": True}
+
+    monkeypatch.setattr(server_linux, "call_tool", call_tool)
+    monkeypatch.setattr(server_linux, "SCHEDULER", JobScheduler({"ffmpeg": 2}))
+    monkeypatch.setattr(server_linux, "METRICS_FILE", "")
+    return state
+
+
+def _call(rid, name="ffmpeg"):
+    return {"jsonrpc": "2.0", "id": rid, "method": "tools/call", "params": {"name": name, "arguments": {}}}
+
+
+def test_ffmpeg_limit_holds(sent, tools):
+    gate = CallGate(0)
+    for rid in range(6):
+        assert gate.start(_call(rid), server_linux._handle_safely)
+    _wait_for(lambda: tools["running"] == 2)
+    time.sleep(0.2)
+    # 其余 4 个在 JobScheduler 里排队, 没进 call_tool
+    assert (tools["calls"], tools["peak"]) == (2, 2)
+
+    tools["release"].set()
+    gate.join()
+    assert tools["peak"] == 2 and tools["calls"] == 6
+    assert sorted(p["id"] for p in sent) == list(range(6))
+    assert all("result" in p for p in sent)
+
+
+def test_unknown_tool_is_rejected_without_a_slot(sent, tools):
+    gate = CallGate(0)
+    gate.start(_call(1), server_linux._handle_safely)
+    gate.start(_call(2), server_linux._handle_safely)
+    _wait_for(lambda: tools["running"] == 2)
+
+    # ffmpeg 的两个名额都占着, 不认识的工具也不会排到后面去
+    started = time.monotonic()
+    assert gate.start(_call(3, "no_such_tool"), server_linux._handle_safely)
+    _wait_for(lambda: any(p["id"] == 3 for p in sent), 2)
+    assert time.monotonic() - started < 1
+    error = next(p for p in sent if p["id"] == 3)["error"]
+    assert error["code"] == -32601 and "no_such_tool" in error["message"]
+    assert tools["calls"] == 2
+
+    tools["release"].set()
+    gate.join()
+    assert {p["id"] for p in sent if "result" in p} == {1, 2}
+
+
+def test_gate_rejects_calls_beyond_the_limit(sent, tools):
+    gate = CallGate(3)
+    for rid in range(3):
+        assert gate.start(_call(rid), server_linux._handle_safely)
+    _wait_for(lambda: tools["running"] == 2)
+
+    # 2 个在跑 + 1 个在排队, 第 4 个不起线程, 直接回 busy
+    threads = threading.active_count()
+    assert not gate.start(_call(3), server_linux._handle_safely)
+    assert threading.active_count() == threads
+    assert sent == [{"jsonrpc": "2.0", "id": 3,
+                     "error": {"code": -32000, "message": "Server busy: 3 tool calls already in flight"}}]
+
+    # 跑完的让出名额
+    tools["release"].set()
+    gate.join()
+    assert gate.start(_call(4), server_linux._handle_safely)
+    gate.join()
+    assert tools["calls"] == 4
+    assert sorted(p["id"] for p in sent if "result" in p) == [0, 1, 2, 4]
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_gate_releases_when_the_handler_raises(sent):
+    gate = CallGate(1)
+
+    def boom(request):
+        raise RuntimeError("boom")
+
+    assert gate.start(_call(1), boom)
+    gate.join()
+    assert gate.start(_call(2), lambda request: None)
+    gate.join()
+    assert sent == []
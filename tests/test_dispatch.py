@@ -0,0 +1,116 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import pytest
+
+import mcp_common
+from mcp_common import FFMPEG_IMAGE, CancelToken, DockerHost, WorkerPool
+from server_linux import HostDispatcher
+
+OPTS = ["-v", "/media:/media"]
+
+
+@pytest.fixture(params=["cli", "api"])
+def hosts(request, fake_docker, monkeypatch):
+    """(挂掉的一台, 好的一台), 都走 fake docker; 挂掉的那台 CLI 报连不上, 或者 socket 在但没人 listen."""
+    good = fake_docker.host
+    if request.param == "cli":
+        dead = DockerHost("fake://down", 4.0, address="", env=dict(os.environ, FAKE_DOCKER_DOWN="1"))
+    else:
+        sockdir = tempfile.mkdtemp(prefix="dead-docker-")
+        address = os.path.join(sockdir, "docker.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        request.addfinalizer(lambda: (listener.close(), shutil.rmtree(sockdir, ignore_errors=True)))
+        monkeypatch.setattr(mcp_common, "DOCKER_API", True)
+        dead = DockerHost(f"unix://{address}", 4.0, address=address)
+        assert dead.engine.enabled
+    # 不起常驻 worker, 每次都是冷启动, 调用次数好数
+    for host in (dead, good):
+        monkeypatch.setitem(mcp_common._POOLS, (host.name, FFMPEG_IMAGE, tuple(OPTS)),
+                            WorkerPool(FFMPEG_IMAGE, OPTS, host, size=0))
+    return dead, good
+
+
+def _ffmpeg(host):
+    return mcp_common._docker_exec_or_run(host, FFMPEG_IMAGE, ["-version"], OPTS, None, 30, None, None, None, None)
+
+
+def test_unreachable_host_fails_over_to_the_next(hosts):
+    dead, good = hosts
+    dispatch = HostDispatcher([dead, good])
+    result = dispatch.run(FFMPEG_IMAGE, _ffmpeg)
+
+    assert result["success"] and "ffmpeg version" in result["output"]
+    assert result["host"] == good.name
+    assert result["failed_over"] == [dead.name]
+    assert (dead.dispatched, good.dispatched) == (1, 1)
+    assert (dead.active, good.active) == (0, 0)
+    assert dead.failures == 1 and dead.down_until > time.monotonic()
+    assert dead.last_error
+    assert good.down_until == 0.0
+
+
+def test_down_host_is_skipped_until_retry(hosts, monkeypatch):
+    dead, good = hosts
+    dispatch = HostDispatcher([dead, good])
+    dispatch.run(FFMPEG_IMAGE, _ffmpeg)
+    result = dispatch.run(FFMPEG_IMAGE, _ffmpeg)
+    assert result["host"] == good.name and "failed_over" not in result
+    assert (dead.dispatched, good.dispatched) == (1, 2)
+
+    # 冷却过了再试一次, 还是连不上就再换
+    dead.down_until = time.monotonic() - 1
+    result = dispatch.run(FFMPEG_IMAGE, _ffmpeg)
+    assert result["failed_over"] == [dead.name] and result["success"]
+    assert dead.failures == 2
+
+
+def test_every_host_down_tries_each_once(hosts):
+    dead, good = hosts
+    other = DockerHost("fake://down-2", 1.0, address="", env=dict(os.environ, FAKE_DOCKER_DOWN="1"))
+    dispatch = HostDispatcher([dead, other])
+    result = dispatch.run(FFMPEG_IMAGE, _ffmpeg)
+    assert not result["success"]
+    assert sorted(result["failed_over"]) == sorted([dead.name, other.name])
+    assert (dead.dispatched, other.dispatched) == (1, 1)
+    assert (dead.active, other.active) == (0, 0)
+    assert good.dispatched == 0
+
+
+def test_slot_released_when_the_call_raises(hosts):
+    dead, good = hosts
+    dispatch = HostDispatcher([good, dead])
+
+    def boom(host):
+        assert host.active == 1
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        dispatch.run(FFMPEG_IMAGE, boom)
+    assert (dead.active, good.active) == (0, 0)
+
+
+def test_cancel_stops_failover(hosts):
+    dead, good = hosts
+    dispatch = HostDispatcher([dead, good])
+    cancel = CancelToken()
+    cancel.cancel()
+    result = dispatch.run(FFMPEG_IMAGE, _ffmpeg, cancel)
+    assert not result["success"] and result["failed_over"] == [dead.name]
+    assert good.dispatched == 0 and dead.active == 0
+
+
+def test_busy_host_loses_to_idle_one(fake_docker):
+    a = fake_docker.host
+    b = DockerHost("fake://b", 1.0, address="")
+    dispatch = HostDispatcher([a, b])
+    first = dispatch.acquire(FFMPEG_IMAGE)
+    second = dispatch.acquire(FFMPEG_IMAGE)
+    assert {first.name, second.name} == {a.name, b.name}
+    dispatch.release(first)
+    dispatch.release(second)
+    assert (a.active, b.active) == (0, 0)
@@ -0,0 +1,143 @@
+import socket
+import threading
+
+import pytest
+
+import fake_docker_api as api_server
+import mcp_common
+from mcp_common import DockerEngine, _Attached
+
+
+def test_spec_maps_run_options():
+    argv = ["docker", "run", "-i", "--rm", "--name", "job1", "--label", "ffmpeg-mcp=worker",
+            "-v", "/home/media:/home/media", "-v", "/scratch:/scratch:ro", "-w", "/home/media",
+            "-e", "MAGICK_THREAD_LIMIT=1", "-e", "FOO=a=b", "--entrypoint", "magick",
+            "--cpus", "2.5", "--cpuset-cpus", "0-3,8", "imagemagick:latest", "a.png", "-resize", "50%", "b.png"]
+    assert DockerEngine.spec(argv) == {
+        "kind": "run", "rm": True, "detach": False, "stdin": True, "name": "job1",
+        "labels": {"ffmpeg-mcp": "worker"}, "binds": ["/home/media:/home/media", "/scratch:/scratch:ro"],
+        "env": ["MAGICK_THREAD_LIMIT=1", "FOO=a=b"], "workdir": "/home/media", "entrypoint": "magick",
+        "cpus": 2.5, "cpuset": "0-3,8", "image": "imagemagick:latest", "cmd": ["a.png", "-resize", "50%", "b.png"],
+    }
+
+
+def test_spec_env_without_value_comes_from_this_process(monkeypatch):
+    monkeypatch.setenv("FFMPEG_MCP_TEST_VAR", "x y")
+    monkeypatch.delenv("FFMPEG_MCP_UNSET_VAR", raising=False)
+    spec = DockerEngine.spec(["docker", "run", "-e", "FFMPEG_MCP_TEST_VAR", "-e", "FFMPEG_MCP_UNSET_VAR", "img"])
+    assert spec["env"] == ["FFMPEG_MCP_TEST_VAR=x y"]
+
+
+def test_spec_detached_worker_and_exec():
+    spec = DockerEngine.spec(["docker", "run", "-d", "--rm", "img", "sleep", "infinity"])
+    assert (spec["detach"], spec["rm"], spec["image"], spec["cmd"]) == (True, True, "img", ["sleep", "infinity"])
+    assert DockerEngine.spec(["docker", "exec", "abc123", "ffmpeg", "-version"]) == {
+        "kind": "exec", "cid": "abc123", "cmd": ["ffmpeg", "-version"]}
+
+
+@pytest.mark.parametrize("argv", [
+    ["docker", "run", "--network", "host", "img"],  # 不认识的选项交给 CLI
+    ["docker", "run", "--rm", "-v"],  # 选项缺值
+    ["docker", "run", "--rm", "--name", "x"],  # 没有镜像
+    ["docker", "exec", "-i", "cid", "sh"],
+    ["docker", "ps", "-a"],
+    ["podman", "run", "img"],
+    ["docker", "run"],
+])
+def test_spec_falls_back_to_cli(argv):
+    assert DockerEngine.spec(argv) is None
+
+
+def test_create_sends_host_config(fake_docker_api):
+    engine = fake_docker_api.host.engine
+    spec = DockerEngine.spec(["docker", "run", "-i", "--name", "cfg-test", "-v", "/a:/b", "-w", "/b", "-e", "K=V",
+                              "--cpus", "1.5", "--cpuset-cpus", "2,3", "--entrypoint", "ffmpeg", "img", "-version"])
+    cid = engine.create(spec)
+    try:
+        config = api_server._CONTAINERS[cid].config
+        assert config["HostConfig"] == {"Binds": ["/a:/b"], "NanoCpus": 1_500_000_000, "CpusetCpus": "2,3"}
+        assert (config["WorkingDir"], config["Env"], config["Entrypoint"]) == ("/b", ["K=V"], ["ffmpeg"])
+        assert (config["Image"], config["Cmd"]) == ("img", ["-version"])
+        assert config["OpenStdin"] and config["StdinOnce"] and config["AttachStdin"]
+    finally:
+        engine.remove(cid)
+
+
+def _frame(stream: int, payload: bytes) -> bytes:
+    return bytes([stream, 0, 0, 0]) + len(payload).to_bytes(4, "big") + payload
+
+
+def _attached(data: bytes, step: int | None = None) -> _Attached:
+    """socketpair 的一头按 step 字节一段段写 data (帧头也会被拆开), 另一头包成 _Attached."""
+    ours, theirs = socket.socketpair()
+
+    def feed():
+        size = step or len(data) or 1
+        for i in range(0, len(data), size):
+            theirs.sendall(data[i:i + size])
+        theirs.close()
+
+    threading.Thread(target=feed, daemon=True).start()
+    return _Attached(ours, ours.makefile("rb"), lambda: 0)
+
+
+FRAMES = [(1, b"frame=1\n"), (2, b"warning\n"), (1, b""), (1, b"x" * 200_000), (2, b"e" * 70_000), (1, b"end\n")]
+
+
+@pytest.mark.parametrize("step", [None, 1, 7, 65536])
+def test_frames_demux_stdout_and_stderr(step):
+    attached = _attached(b"".join(_frame(s, p) for s, p in FRAMES), step)
+    try:
+        got = list(attached.frames())
+    finally:
+        attached.close()
+    # 空帧不交出去, 其余按原顺序, 大帧不拆
+    assert got == [(s, p) for s, p in FRAMES if p]
+
+
+def test_frames_stop_at_truncated_frame():
+    data = _frame(1, b"ok") + _frame(2, b"cut off")[:-3]
+    attached = _attached(data)
+    got = list(attached.frames())
+    attached.close()
+    # 连接断在帧中间: 前面的完整帧照常交出, 之后就结束, 不会卡住
+    assert got[0] == (1, b"ok")
+    assert [stream for stream, _ in got] in ([1], [1, 2])
+
+
+def test_stdout_reader_routes_stderr_frames():
+    attached = _attached(b"".join(_frame(s, p) for s, p in FRAMES), 4096)
+    errors = []
+    read = attached.stdout_reader(errors.append)
+    chunks = list(iter(read, b""))
+    attached.close()
+    assert b"".join(chunks) == b"".join(p for s, p in FRAMES if s == 1)
+    assert b"".join(errors) == b"".join(p for s, p in FRAMES if s == 2)
+    assert read() == b""
+
+
+def test_run_cli_demuxes_exact_output_sizes(fake_docker_api, monkeypatch):
+    import fake_docker as emulator
+
+    monkeypatch.setattr(emulator, "STDOUT_KB", 300)
+    monkeypatch.setattr(emulator, "STDERR_KB", 5)
+    engine = fake_docker_api.host.engine
+    proc = engine.run_cli(["docker", "run", "--rm", "ffmpeg:latest", "-i", "in.mp4", "out.mp4"], 30)
+    assert proc.returncode == 0
+    assert len(proc.stdout) == 300 * 1024 and set(proc.stdout) == {"o", "\n"}
+    assert proc.stderr.startswith("  Duration: ")
+    assert proc.stderr.count("\n") == 1 + 5
+    assert fake_docker_api.calls() == []
+
+
+def test_control_connections_are_reused(fake_docker_api):
+    engine = fake_docker_api.host.engine
+    for _ in range(5):
+        assert engine.run_cli(["docker", "info", "-f", "{{.NCPU}}"], 10).returncode == 0
+    assert len(engine._idle) == 1
+
+
+def test_missing_socket_disables_engine(tmp_path):
+    engine = DockerEngine(str(tmp_path / "nope.sock"), True)
+    assert not engine.enabled
+    assert mcp_common.DockerHost("unix:///nope", address="").engine.enabled is False
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import server_linux
+from mcp_common import ShowinfoTimes
+
+SHOWINFO = ("[Parsed_showinfo_1 @ 0x55d0c8a3c0] n:{n} pts:{pts} pts_time:{t} duration:1 fmt:yuv420p "
+            "cl:left sar:1/1 s:1920x1080 i:P iskey:0 type:P checksum:9A3C2E1F plane_checksum:[A1 B2 C3]\n")
+
+
+def _stderr(times, filler_kb):
+    # 每个 showinfo 行前面塞一大段别的日志, 总长远超 stderr 首尾缓冲
+    noise = "[h264 @ 0x55d0c8a3c0] decode_slice_header error\n" * (filler_kb * 1024 // 47 + 1)
+    return "".join(noise + SHOWINFO.format(n=i, pts=int(t * 90000), t=t) for i, t in enumerate(times)).encode()
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096, 65536])
+def test_showinfo_times_survive_any_chunking(size):
+    data = _stderr([1.5, 12.04, 3601.2], 2)
+    showinfo = ShowinfoTimes()
+    for i in range(0, len(data), size):
+        showinfo.feed(data[i:i + size])
+    assert showinfo.times() == [1.5, 12.04, 3601.2]
+
+
+def test_showinfo_times_reads_an_unterminated_last_line():
+    showinfo = ShowinfoTimes()
+    showinfo.feed(SHOWINFO.format(n=0, pts=0, t=0.5).rstrip("\n").encode())
+    assert showinfo.times() == [0.5]
+
+
+def test_scene_mode_keeps_existing_files_and_all_timestamps(media, monkeypatch):
+    out_dir = os.path.join(media, "previews")
+    os.makedirs(out_dir)
+    mine = os.path.join(out_dir, "scene_001.jpg")
+    with open(mine, "wb") as f:
+        f.write(b"user file")
+    times = [round(7.5 * i + 0.04, 2) for i in range(40)]
+    calls = []
+
+    def fake_run(image, cmd_args, entrypoint=None, timeout=600, on_stdout_line=None, on_stderr=None, worker=None,
+                 cancel=None):
+        calls.append(cmd_args)
+        pattern = cmd_args[-1]
+        for i in range(len(times)):
+            with open(pattern % (i + 1), "wb") as f:
+                f.write(b"jpg")
+        data = _stderr(times, 8)
+        for i in range(0, len(data), 3000):
+            on_stderr(data[i:i + 3000])
+        # 结果里的 stderr 和真的一样只剩尾部
+        return {"success": True, "output": "", "error": data[-2048:].decode(), "command": "docker run",
+                "runner": "warm", "metrics": {}}
+
+    monkeypatch.setattr(server_linux, "_docker_run", fake_run)
+    report = server_linux.extract_frames(f"{media}/in.mp4", out_dir, scene=0.3, max_frames=len(times))
+    assert report["success"], report
+    with open(mine, "rb") as f:
+        assert f.read() == b"user file"
+    assert [frame["time"] for frame in report["frames"]] == times
+    paths = [frame["path"] for frame in report["frames"]]
+    assert mine not in paths and all(os.path.exists(p) for p in paths)
+    prefix = os.path.basename(calls[0][-1]).split("_%")[0]
+    assert prefix.startswith("scene_") and prefix != "scene"
+    assert all(os.path.basename(p).startswith(prefix + "_") for p in paths)
+
+
+def test_scene_mode_uses_a_new_prefix_each_call(media, monkeypatch):
+    patterns = []
+
+    def fake_run(image, cmd_args, *args, **kwargs):
+        patterns.append(cmd_args[-1])
+        return {"success": True, "output": "", "error": "", "command": "docker run", "runner": "warm", "metrics": {}}
+
+    monkeypatch.setattr(server_linux, "_docker_run", fake_run)
+    for _ in range(2):
+        assert server_linux.extract_frames(f"{media}/in.mp4", media, scene=0.3)["success"]
+    assert len(set(patterns)) == 2
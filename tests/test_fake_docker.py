@@ -0,0 +1,20 @@
+import io
+
+import pytest
+
+import fake_docker
+
+
+@pytest.mark.parametrize("text", [
+    "o",
+    "p",
+    "frame=  100 fps=250 q=28.0 size=    1024kB time=00:00:04.00 ",
+    "x" * 2000,
+])
+@pytest.mark.parametrize("kb", [0, 1, 7])
+def test_filler_writes_exactly_kb_kibibytes(text, kb):
+    stream = io.StringIO()
+    fake_docker._filler(stream, kb, text)
+    data = stream.getvalue()
+    assert len(data) == kb * 1024
+    assert data.count("\n") == kb
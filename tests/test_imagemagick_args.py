@@ -0,0 +1,78 @@
+import pytest
+
+import mcp_common
+import server
+import server_linux
+
+
+@pytest.mark.parametrize("args, expected", [
+    ("a.png -resize 50% b.png", ["a.png", "-resize", "50%", "b.png"]),
+    ("  a.png\t-resize   50%\nb.png ", ["a.png", "-resize", "50%", "b.png"]),
+    ('"/home/media/my pics/a.png" -resize 50% \'/home/media/out 1.png\'',
+     ["/home/media/my pics/a.png", "-resize", "50%", "/home/media/out 1.png"]),
+    ("D:\\photos\\a.png -flip D:\\photos\\b.png", ["D:\\photos\\a.png", "-flip", "D:\\photos\\b.png"]),
+    ('"D:\\my pics\\a.png" b.png', ["D:\\my pics\\a.png", "b.png"]),
+    ("a.png -fill '#ff0000' -annotate +10+10 'hello world' b.png",
+     ["a.png", "-fill", "#ff0000", "-annotate", "+10+10", "hello world", "b.png"]),
+    (["/home/media/my pics/a.png", "-resize", "50%"], ["/home/media/my pics/a.png", "-resize", "50%"]),
+    ("", []),
+])
+def test_split_args(args, expected):
+    assert mcp_common._split_args(args) == expected
+
+
+@pytest.mark.parametrize("args", ['a.png "b.png', ["a.png", 3], None])
+def test_split_args_rejects(args):
+    with pytest.raises(ValueError):
+        mcp_common._split_args(args)
+
+
+def _recorder(calls):
+    def run(image, argv, *rest, **kwargs):
+        calls.append(list(argv))
+        return {"success": True, "output": "", "error": "", "command": "docker run", "runner": "cold", "metrics": {}}
+    return run
+
+
+@pytest.mark.parametrize("args", [
+    '"{root}/my pics/a.png" -resize 50% "{root}/out 1.png"',
+    ["{root}/my pics/a.png", "-resize", "50%", "{root}/out 1.png"],
+])
+def test_linux_run_imagemagick_keeps_paths_with_spaces(media, monkeypatch, args):
+    calls = []
+    monkeypatch.setattr(server_linux, "_docker_run", _recorder(calls))
+    args = args.format(root=media) if isinstance(args, str) else [a.format(root=media) for a in args]
+    result = server_linux.run_imagemagick(args, cache=False)
+    assert result["success"]
+    assert calls == [[f"{media}/my pics/a.png", "-resize", "50%", f"{media}/out 1.png"]]
+
+
+def test_linux_run_imagemagick_reports_bad_quoting(monkeypatch):
+    calls = []
+    monkeypatch.setattr(server_linux, "_docker_run", _recorder(calls))
+    result = server_linux.run_imagemagick('"/home/media/a.png -resize 50% b.png', cache=False)
+    assert not result["success"] and "closing quotation" in result["error"]
+    assert calls == []
+
+
+@pytest.mark.parametrize("args", [
+    '"D:/my pics/a.png" -resize 50% "D:/out 1.png"',
+    ["D:/my pics/a.png", "-resize", "50%", "D:/out 1.png"],
+])
+def test_windows_run_imagemagick_keeps_paths_with_spaces(monkeypatch, args):
+    calls = []
+    monkeypatch.setattr(server, "_docker_run", _recorder(calls))
+    assert server._imagemagick_basedir({"args": args}) == "D:/"
+    result = server.run_imagemagick(args, "D:/")
+    assert result["success"]
+    assert calls == [["/work/my pics/a.png", "-resize", "50%", "/work/out 1.png"]]
+
+
+def test_pipeline_imagemagick_string_uses_shell_quoting():
+    parsed = mcp_common._pipeline_steps([
+        {"tool": "ffmpeg", "args": ["-i", "a.mp4", "-f", "image2pipe", "pipe:1"]},
+        {"tool": "imagemagick", "args": "ppm:- -annotate +10+10 'hello world' ppm:-"},
+    ])
+    assert parsed[1][3] == ["ppm:-", "-annotate", "+10+10", "hello world", "ppm:-"]
+    with pytest.raises(ValueError, match="step 1"):
+        mcp_common._pipeline_steps([{"tool": "ffmpeg", "args": ["x"]}, {"tool": "imagemagick", "args": "'unterminated"}])
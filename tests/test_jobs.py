@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+import mcp_common
+from mcp_common import FFMPEG_IMAGE, JobScheduler, JobTable, WorkerPool
+
+OPTS = ["-v", "/media:/media"]
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def jobs(fake_docker, monkeypatch):
+    """后台任务表, 唯一的工具在 fake docker 上跑 ffmpeg; 每次 run / exec 都卡 5 秒, 足够在中途取消."""
+
+    def ffmpeg(arguments, notify, timeout, cancel):
+        return mcp_common._docker_exec_or_run(fake_docker.host, FFMPEG_IMAGE, list(arguments["args"]), OPTS, None,
+                                              timeout, None, None, None, cancel)
+
+    def pool(size):
+        pool = WorkerPool(FFMPEG_IMAGE, OPTS, fake_docker.host, size=size)
+        monkeypatch.setitem(mcp_common._POOLS, (fake_docker.host.name, FFMPEG_IMAGE, tuple(OPTS)), pool)
+        if size:
+            pool.release(pool.acquire(wait=30))
+        # 常驻 worker 起好之后再让 run / exec 变慢 (run -d 不受影响)
+        monkeypatch.setenv("FAKE_DOCKER_LATENCY_MS", "5000")
+        return pool
+
+    table = JobTable({"ffmpeg": ffmpeg}, JobScheduler({"ffmpeg": 1}))
+    table.pool = pool
+    yield table
+    table.shutdown()
+
+
+def _finish(jobs, job, timeout=5):
+    _wait_for(lambda: job.status in JobTable.FINAL, timeout)
+    return jobs.tool_result(job.id)
+
+
+def test_cancel_removes_the_warm_worker(jobs, fake_docker):
+    pool = jobs.pool(1)
+    cid = pool._idle[0].cid
+    job = jobs.submit("ffmpeg", {"args": ["-i", "/media/in.mp4", "/media/out.mp4"]}, 60)
+    _wait_for(lambda: fake_docker.calls("exec"))
+    assert job.status == "running"
+
+    started = time.monotonic()
+    assert jobs.tool_cancel(job.id)["success"]
+    report = _finish(jobs, job)
+    assert time.monotonic() - started < 4
+    assert report["status"] == "cancelled"
+    assert report["result"]["cancelled"] and report["result"]["runner"] == "warm"
+    assert ["rm", "-f", cid] in fake_docker.calls("rm")
+    assert cid not in [w.cid for w in pool._idle]
+    # 没有退回冷启动重跑一遍
+    assert [argv for argv in fake_docker.calls("run") if "-d" not in argv] == []
+
+
+def test_cancel_removes_the_cold_container(jobs, fake_docker):
+    jobs.pool(0)
+    job = jobs.submit("ffmpeg", {"args": ["-i", "/media/in.mp4", "/media/out.mp4"]}, 60)
+    _wait_for(lambda: fake_docker.calls("run"))
+    name = fake_docker.calls("run")[0][3]
+    assert name.startswith("ffmpeg-mcp-run-")
+
+    jobs.tool_cancel(job.id)
+    report = _finish(jobs, job)
+    assert report["status"] == "cancelled"
+    assert report["result"]["cancelled"] and report["result"]["runner"] == "cold"
+    assert ["rm", "-f", name] in fake_docker.calls("rm")
+
+
+def test_cancel_queued_job_never_starts(jobs, fake_docker):
+    jobs.pool(0)
+    running = jobs.submit("ffmpeg", {"args": ["first"]}, 60)
+    queued = jobs.submit("ffmpeg", {"args": ["second"]}, 60)
+    _wait_for(lambda: fake_docker.calls("run"))
+    assert queued.status == "queued"
+
+    assert jobs.tool_cancel(queued.id)["status"] == "cancelled"
+    jobs.tool_cancel(running.id)
+    _finish(jobs, running)
+    time.sleep(0.2)
+    assert queued.result is None
+    assert [argv[-1] for argv in fake_docker.calls("run")] == ["first"]
+
+
+def test_timeout_is_a_terminal_state(jobs, fake_docker):
+    jobs.pool(0)
+    job = jobs.submit("ffmpeg", {"args": ["-version"]}, 1)
+    report = _finish(jobs, job)
+    assert report["status"] == "timeout"
+    assert ["rm", "-f", fake_docker.calls("run")[0][3]] in fake_docker.calls("rm")
+
+
+def test_result_of_running_job_is_refused(jobs, fake_docker):
+    jobs.pool(0)
+    job = jobs.submit("ffmpeg", {"args": ["-version"]}, 60)
+    _wait_for(lambda: job.status == "running")
+    report = jobs.tool_result(job.id)
+    assert not report["success"] and "still running" in report["error"]
+    jobs.tool_cancel(job.id)
+    assert _finish(jobs, job)["status"] == "cancelled"
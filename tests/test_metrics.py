@@ -0,0 +1,149 @@
+import socket
+import urllib.error
+import urllib.request
+
+import pytest
+
+import mcp_common
+import server_linux
+
+
+@pytest.mark.parametrize("args, inputs, outputs", [
+    (["-i", "a.mp4", "out.mp4"], ["a.mp4"], ["out.mp4"]),
+    (["-i", "a.mp4", "o1.mp4", "-map", "0:a", "o2.m4a"], ["a.mp4"], ["o1.mp4", "o2.m4a"]),
+    (["-i", "a.mp4", "-i", "b.png", "-filter_complex", "overlay", "o.mp4"], ["a.mp4", "b.png"], ["o.mp4"]),
+    (["-y", "-i", "a.mp4", "-c:v", "libx264", "o.mp4", "-t", "5"], ["a.mp4"], ["o.mp4"]),
+    (["-i", "a.mp4", "-f", "null", "-"], ["a.mp4"], []),
+    (["-i", "pipe:0", "-f", "mp4", "pipe:1"], [], []),
+])
+def test_ffmpeg_files_counts_every_input_and_output(args, inputs, outputs):
+    assert server_linux._ffmpeg_files(args) == (inputs, outputs)
+
+
+def _result(success=True, runner="pool", **metrics):
+    return {"success": success, "runner": runner, "metrics": metrics}
+
+
+def test_observe_aggregates_calls_errors_runners_and_totals():
+    m = mcp_common.Metrics()
+    m.observe("ffmpeg", _result(run_s=1.0, input_bytes=100, output_bytes=40, cpu_user_s=0.5, max_rss_kb=900), 1.2, 0.01)
+    m.observe("ffmpeg", _result(success=False, runner="run", input_bytes=50, max_rss_kb=300), 0.3, 0.0)
+    m.observe("ffmpeg", {"success": True, "cache": {"hit": True}}, 0.001, 0.0)
+    m.observe("probe", "not a dict", 0.1, 0.0)
+
+    tools = m.snapshot()["tools"]
+    ff = tools["ffmpeg"]
+    assert (ff["calls"], ff["errors"]) == (3, 1)
+    assert ff["runners"] == {"pool": 1, "run": 1, "cache": 1}
+    assert ff["totals"]["input_bytes"] == 150
+    assert ff["totals"]["output_bytes"] == 40
+    assert ff["totals"]["cpu_user_s"] == 0.5
+    assert ff["max_rss_kb"] == 900
+    assert ff["phases"]["total"]["count"] == 3
+    assert ff["phases"]["run"]["count"] == 1
+    assert "stage_in" not in ff["phases"]
+    assert (tools["probe"]["calls"], tools["probe"]["errors"], tools["probe"]["runners"]) == (1, 1, {})
+
+
+def test_snapshot_quantiles_are_bucket_upper_bounds():
+    m = mcp_common.Metrics()
+    for total in (0.2, 0.2, 0.2, 7.0):
+        m.observe("t", _result(), total, 0.0)
+    total = m.snapshot()["tools"]["t"]["phases"]["total"]
+    assert total["p50_s"] == 0.25
+    assert total["p95_s"] == 10.0
+    assert total["avg_s"] == pytest.approx(1.9)
+
+
+def _samples(text: str) -> dict:
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            key, value = line.rsplit(" ", 1)
+            samples[key] = float(value)
+    return samples
+
+
+def test_prometheus_histogram_is_cumulative_and_ends_at_inf():
+    m = mcp_common.Metrics()
+    m.observe("ffmpeg", _result(run_s=0.004), 0.004, 0.0)
+    m.observe("ffmpeg", _result(run_s=2.0), 2.0, 0.0)
+    m.observe("ffmpeg", _result(run_s=5000.0), 5000.0, 0.0)
+    text = m.prometheus()
+    s = _samples(text)
+    labels = 'tool="ffmpeg",phase="total"'
+
+    buckets = [s[f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="{b}"}}'] for b in m.BUCKETS]
+    assert buckets == sorted(buckets)
+    assert s[f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="0.005"}}'] == 1
+    assert s[f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="2.5"}}'] == 2
+    # 超过最大桶的只算进 +Inf
+    assert s[f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="3600.0"}}'] == 2
+    assert s[f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="+Inf"}}'] == 3
+    assert s[f"ffmpeg_mcp_phase_seconds_count{{{labels}}}"] == 3
+    assert s[f"ffmpeg_mcp_phase_seconds_sum{{{labels}}}"] == pytest.approx(5002.004)
+
+    # +Inf 紧跟在 3600 之后, 后面是 sum 和 count
+    lines = text.splitlines()
+    at = lines.index(f'ffmpeg_mcp_phase_seconds_bucket{{{labels},le="+Inf"}} 3')
+    assert "le=\"3600.0\"" in lines[at - 1]
+    assert lines[at + 1].startswith("ffmpeg_mcp_phase_seconds_sum{")
+    assert lines[at + 2].startswith("ffmpeg_mcp_phase_seconds_count{")
+
+
+def test_prometheus_counters_and_labels():
+    m = mcp_common.Metrics()
+    m.observe("b_tool", _result(runner="exec", input_bytes=10, output_bytes=20, stdout_bytes=3, stderr_bytes=4,
+                                cpu_user_s=1.25, cpu_sys_s=0.5, max_rss_kb=2048), 1.0, 0.0)
+    m.observe("a_tool", _result(success=False), 0.1, 0.0)
+    text = m.prometheus()
+    s = _samples(text)
+
+    assert text.endswith("\n")
+    assert text.index('tool="a_tool"') < text.index('tool="b_tool"')
+    assert s['ffmpeg_mcp_calls_total{tool="a_tool"}'] == 1
+    assert s['ffmpeg_mcp_errors_total{tool="a_tool"}'] == 1
+    assert s['ffmpeg_mcp_errors_total{tool="b_tool"}'] == 0
+    assert s['ffmpeg_mcp_runs_total{tool="b_tool",runner="exec"}'] == 1
+    assert s['ffmpeg_mcp_cpu_seconds_total{tool="b_tool",mode="user"}'] == 1.25
+    assert s['ffmpeg_mcp_cpu_seconds_total{tool="b_tool",mode="system"}'] == 0.5
+    for direction, value in (("input", 10), ("output", 20), ("stdout", 3), ("stderr", 4)):
+        assert s[f'ffmpeg_mcp_bytes_total{{tool="b_tool",direction="{direction}"}}'] == value
+    assert s['ffmpeg_mcp_max_rss_kb{tool="b_tool"}'] == 2048
+    # 没有观测值的阶段不输出
+    assert 'phase="stage_in"' not in text
+    for line in text.splitlines():
+        if line.startswith("# TYPE"):
+            assert line.split()[3] in ("counter", "histogram", "gauge")
+
+
+def test_write_file_replaces_atomically(tmp_path):
+    m = mcp_common.Metrics()
+    m.observe("ffmpeg", _result(), 1.0, 0.0)
+    path = tmp_path / "ffmpeg_mcp.prom"
+    path.write_text("stale\n")
+    m.write_file(str(path))
+    assert path.read_text() == m.prometheus()
+    assert [p.name for p in tmp_path.iterdir()] == ["ffmpeg_mcp.prom"]
+
+
+def test_write_file_logs_instead_of_raising(tmp_path):
+    mcp_common.Metrics().write_file(str(tmp_path / "missing" / "m.prom"))
+
+
+def test_serve_metrics_exposes_only_the_metrics_path(monkeypatch):
+    m = mcp_common.Metrics()
+    m.observe("ffmpeg", _result(), 1.0, 0.0)
+    monkeypatch.setattr(mcp_common, "METRICS", m)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    mcp_common._serve_metrics(port)
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics?x=1", timeout=5) as resp:
+        assert resp.status == 200
+        assert resp.headers["Content-Type"].startswith("text/plain")
+        assert resp.read().decode() == m.prometheus()
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5)
+    assert e.value.code == 404
@@ -0,0 +1,43 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("args, expected", [
+    (["-i", "D:/a.mp4", "D:/b.mp4"], {"D"}),
+    (["-i", "d:/a.mp4", "-vf", "movie=E\\:/logo.png", "D:/b.mp4"], {"D", "E"}),
+    (["-i", "/work/a.mp4", "-c:v", "libx264", "out.mp4"], set()),
+])
+def test_referenced_drives(args, expected):
+    assert server.referenced_drives(args) == expected
+
+
+@pytest.mark.parametrize("basedir, drives, expected", [
+    ("D:/", set(), ("D:/:/work", False)),
+    ("D:/", {"D"}, ("D:/:/work", False)),
+    ("", {"E"}, ("", False)),
+    ("D:/", {"E"}, (("D:/:/work/d", "E:/:/work/e"), True)),
+    ("", {"E", "C"}, (("C:/:/work/c", "E:/:/work/e"), True)),
+])
+def test_plan_mounts(basedir, drives, expected):
+    assert server.plan_mounts(basedir, drives) == expected
+
+
+def test_translate_ffmpeg_args_cross_drive():
+    args = ["-i", "E:/clips/a.mp4", "-vf", "movie=E\\:/logo.png", "/work/out.mp4"]
+    out, _, volume_mount = server.translate_ffmpeg_args(args, "D:/")
+    assert out == ["-i", "/work/e/clips/a.mp4", "-vf", "movie=/work/e/logo.png", "/work/d/out.mp4"]
+    assert volume_mount == ("D:/:/work/d", "E:/:/work/e")
+
+
+def test_translate_ffmpeg_args_extra_drives():
+    out, _, volume_mount = server.translate_ffmpeg_args(["-i", "D:/a.mp4", "D:/b.mp4"], "D:/", drives=("F",))
+    assert out == ["-i", "/work/d/a.mp4", "/work/d/b.mp4"]
+    assert volume_mount == ("D:/:/work/d", "F:/:/work/f")
+
+
+def test_single_drive_translation_is_not_polluted_by_a_cross_drive_call():
+    server.translate_ffmpeg_args(["-i", "E:/a.mp4", "D:/b.mp4"], "D:/")
+    out, _, volume_mount = server.translate_ffmpeg_args(["-i", "E:/a.mp4", "E:/b.mp4"], "E:/")
+    assert out == ["-i", "/work/a.mp4", "/work/b.mp4"]
+    assert volume_mount == "E:/:/work"
@@ -0,0 +1,32 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("arg, expected", [
+    ("-c:v", "-c:v"),
+    ("libx264", "libx264"),
+    ("D:/videos/in.mp4", "/work/videos/in.mp4"),
+    ("D:/", "/work"),
+    ("C:\\Users\\test.jpg", "/work/Users/test.jpg"),
+    ("D:/my videos/in put.mp4", "/work/my videos/in put.mp4"),
+    ("movie=D\\:/logo.png", "movie=/work/logo.png"),
+    ("movie=D\\\\:/logo.png", "movie=/work/logo.png"),
+    ("subtitles='D\\:/my subs/a.srt'", "subtitles='/work/my subs/a.srt'"),
+    ("file:D:/x.mp4", "file:/work/x.mp4"),
+    ("[0:v]movie=D\\:/a.png[l];[l]scale=2:2,amovie=E\\:/b.wav[o]",
+     "[0:v]movie=/work/a.png[l];[l]scale=2:2,amovie=/work/b.wav[o]"),
+    ("http://example.com/a.mp4", "http://example.com/a.mp4"),
+    ("/work/already.mp4", "/work/already.mp4"),
+])
+def test_convert_any_windows_path(arg, expected):
+    assert server.convert_any_windows_path(arg) == expected
+
+
+def test_translate_ffmpeg_args_single_drive():
+    args = ["-y", "-i", "D:/in.mp4", "-vf", "movie=D\\:/logo.png [l]; [in][l] overlay", "-c:v", "libx264", "D:/out.mp4"]
+    out, temp_files, volume_mount = server.translate_ffmpeg_args(args, "D:/")
+    assert out == ["-y", "-i", "/work/in.mp4", "-vf", "movie=/work/logo.png [l]; [in][l] overlay",
+                   "-c:v", "libx264", "/work/out.mp4"]
+    assert temp_files == []
+    assert volume_mount == "D:/:/work"
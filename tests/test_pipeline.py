@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+import fake_docker_api
+import mcp_common
+
+STEPS = [
+    {"tool": "ffmpeg", "args": ["-i", "in.mp4", "-f", "image2pipe", "-c:v", "ppm", "pipe:1"]},
+    {"tool": "imagemagick", "args": ["ppm:-", "-modulate", "105,130", "ppm:-"]},
+    {"tool": "ffmpeg", "args": ["-y", "-f", "image2pipe", "-i", "pipe:0", "out.mp4"]},
+]
+
+
+def _parsed(steps=STEPS):
+    return [step + ([],) for step in mcp_common._pipeline_steps(steps)]
+
+
+@pytest.fixture(params=["cli", "api"])
+def backend(request, fake_docker, monkeypatch):
+    """同一组测试 CLI 和 Engine API 两条路径各跑一遍; 返回 (host, 设置假容器参数的函数, FakeDocker)."""
+    if request.param == "cli":
+        return fake_docker.host, lambda name, value: monkeypatch.setenv(f"FAKE_DOCKER_{name}", str(value)), fake_docker
+    fake = request.getfixturevalue("fake_docker_api")
+    import fake_docker as emulator
+
+    def configure(name, value):
+        # 环境变量名 -> fake_docker 模块里 import 时读好的属性
+        attr = {"LATENCY_MS": "LATENCY", "EXIT": "EXIT_CODE"}.get(name, name)
+        monkeypatch.setattr(emulator, attr, value / 1000 if name == "LATENCY_MS" else value)
+
+    return fake.host, configure, fake
+
+
+def test_pipeline_streams_every_byte_through_each_link(backend):
+    host, configure, fake = backend
+    configure("PIPE_KB", 512)
+    progress = []
+    report = mcp_common._run_pipeline(host, _parsed(), 60, lambda *a: progress.append(a), None)
+
+    assert report["success"], report
+    assert report["runner"] == ("api" if host.name.startswith("unix://") else "cli")
+    assert [link["bytes"] for link in report["links"]] == [512 * 1024, 512 * 1024]
+    assert [link["broken"] for link in report["links"]] == [False, False]
+    assert [st["returncode"] for st in report["stages"]] == [0, 0, 0]
+    assert report["stages"][2]["stderr"] == f"ffmpeg: piped {512 * 1024} bytes in"
+    assert sorted(p[0] for p in progress) == [1, 2, 3]
+    # 第一步没有上游, 不开 stdin
+    assert report["command"].split(" | ")[0].startswith("docker run --rm ")
+    assert all(cmd.startswith("docker run -i --rm ") for cmd in report["command"].split(" | ")[1:])
+    if report["runner"] == "api":
+        assert fake.calls("run") == []
+    else:
+        assert len(fake.calls("run")) == 3
+
+
+def test_pipeline_reports_the_failing_step(backend):
+    host, configure, _ = backend
+    configure("EXIT", 1)
+    report = mcp_common._run_pipeline(host, _parsed(), 60, None, None)
+    assert not report["success"]
+    assert report["error"].startswith("step ")
+    assert all(st["returncode"] == 1 for st in report["stages"])
+
+
+def test_pipeline_cancel_removes_every_container(backend):
+    host, configure, fake = backend
+    configure("LATENCY_MS", 5000)
+    cancel = mcp_common.CancelToken()
+    reports = []
+    worker = threading.Thread(target=lambda: reports.append(mcp_common._run_pipeline(host, _parsed(), 60, None,
+                                                                                      cancel)))
+    started = time.monotonic()
+    worker.start()
+    time.sleep(0.5)
+    cancel.cancel()
+    worker.join(10)
+
+    assert not worker.is_alive()
+    assert time.monotonic() - started < 4
+    report = reports[0]
+    assert report["cancelled"] and not report["success"]
+    names = [cmd.split("--name ")[1].split()[0] for cmd in report["command"].split(" | ")]
+    if report["runner"] == "api":
+        alive = {c.name for c in fake_docker_api._CONTAINERS.values()}
+        assert not alive & set(names)
+    else:
+        removed = [arg for argv in fake.calls("rm") for arg in argv]
+        assert set(names) <= set(removed)
+
+
+def test_pipeline_timeout_kills_the_pipeline(backend):
+    host, configure, _ = backend
+    configure("LATENCY_MS", 5000)
+    started = time.monotonic()
+    report = mcp_common._run_pipeline(host, _parsed(), 1, None, None)
+    assert time.monotonic() - started < 4
+    assert report["timeout"] and not report["success"]
+
+
+class _SlowSink:
+    """下游: 每次只收一小块, 收一次睡一会; 记录上游最多比下游多读了几块."""
+
+    def __init__(self, chunks: int, delay: float):
+        self.pending = [b"x" * 4096] * chunks
+        self.delay = delay
+        self.reads = 0
+        self.writes = 0
+        self.ahead = 0
+        self.closed = []
+
+    def read(self) -> bytes:
+        if not self.pending:
+            return b""
+        self.reads += 1
+        self.ahead = max(self.ahead, self.reads - self.writes)
+        return self.pending.pop()
+
+    def write(self, data) -> int:
+        time.sleep(self.delay)
+        n = min(len(data), 1024)
+        if n == len(data):
+            self.writes += 1
+        return n
+
+    def close_stdin(self) -> None:
+        self.closed.append("stdin")
+
+    def close_stdout(self) -> None:
+        self.closed.append("stdout")
+
+
+def test_pipe_link_backpressure_holds_one_chunk():
+    stage = _SlowSink(chunks=5, delay=0.01)
+    link = mcp_common._PipeLink(stage, stage)
+    link.run()
+    stats = link.stats()
+
+    assert stats["bytes"] == 5 * 4096
+    # 下游没收完这一块之前不会再读上游
+    assert stage.ahead == 1
+    assert stats["consumer_wait_s"] >= 5 * 4 * 0.01 * 0.8
+    assert stats["producer_wait_s"] < stats["consumer_wait_s"]
+    assert stage.closed == ["stdin", "stdout"]
+
+
+def test_pipe_link_stops_reading_when_the_consumer_dies():
+    stage = _SlowSink(chunks=5, delay=0)
+
+    def broken(data):
+        raise BrokenPipeError
+
+    stage.write = broken
+    link = mcp_common._PipeLink(stage, stage)
+    link.run()
+    assert link.broken and link.bytes == 0
+    assert stage.reads == 1
+    assert stage.closed == ["stdin", "stdout"]
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import mcp_common
+import server
+import server_linux
+from mcp_common import FFMPEG_IMAGE, IMAGEMAGICK_IMAGE
+from server_linux import HostDispatcher
+
+
+@pytest.fixture
+def slow_pull(fake_docker, monkeypatch):
+    """镜像都不在, docker pull 要 3 秒 (10 倍启动延迟); 预检打开."""
+    monkeypatch.setenv("FAKE_DOCKER_NO_IMAGES", "1")
+    monkeypatch.setenv("FAKE_DOCKER_LATENCY_MS", "300")
+    monkeypatch.setattr(mcp_common, "PREFLIGHT", True)
+    monkeypatch.setattr(mcp_common, "PREFLIGHT_PULL", True)
+    return fake_docker
+
+
+def _wait_state(preflight, image, states, timeout=10):
+    deadline = time.monotonic() + timeout
+    while preflight.status()["images"][image]["state"] not in states:
+        assert time.monotonic() < deadline, preflight.status()
+        time.sleep(0.02)
+    return preflight.status()["images"][image]
+
+
+def test_linux_initialize_does_not_wait_for_pull(slow_pull, monkeypatch):
+    sent = []
+    monkeypatch.setattr(server_linux, "DISPATCH", HostDispatcher([slow_pull.host]))
+    monkeypatch.setattr(server_linux, "send_result", lambda rid, result: sent.append((rid, result)))
+
+    started = time.monotonic()
+    server_linux.handle_request({"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {}})
+    assert time.monotonic() - started < 0.5
+    assert sent[0][0] == 1 and sent[0][1]["serverInfo"]["name"] == "ffmpeg-mcp-cloud"
+
+    preflight = slow_pull.host.preflight
+    assert preflight.status()["preflight"] == "started"
+    assert _wait_state(preflight, FFMPEG_IMAGE, ("pulling",))["state"] == "pulling"
+    # 第二次 initialize 不会再起一轮
+    assert not preflight.start()
+    info = _wait_state(preflight, FFMPEG_IMAGE, ("ready",))
+    assert info["pulled"] and info["pull_s"] >= 2
+    assert ["pull", FFMPEG_IMAGE] in slow_pull.calls("pull")
+
+
+def test_windows_initialize_does_not_wait_for_pull(slow_pull, monkeypatch):
+    sent = []
+    monkeypatch.setattr(server, "DOCKER", slow_pull.host)
+    monkeypatch.setattr(server, "send_result", lambda rid, result: sent.append((rid, result)))
+
+    started = time.monotonic()
+    server.handle_request({"jsonrpc": "2.0", "id": 7, "method": "initialize", "params": {}})
+    assert time.monotonic() - started < 0.5
+    assert sent[0][0] == 7
+    _wait_state(slow_pull.host.preflight, IMAGEMAGICK_IMAGE, ("pulling", "ready"))
+
+
+def test_calls_wait_for_preflight_at_most_preflight_wait(slow_pull, monkeypatch):
+    monkeypatch.setattr(mcp_common, "PREFLIGHT_WAIT", 0.3)
+    preflight = slow_pull.host.preflight
+    preflight.start()
+    _wait_state(preflight, FFMPEG_IMAGE, ("pulling",))
+
+    started = time.monotonic()
+    preflight.wait(FFMPEG_IMAGE)
+    assert 0.25 <= time.monotonic() - started < 1.5
+    assert preflight.status()["images"][FFMPEG_IMAGE]["state"] == "pulling"
+    # 还在拉的 daemon 排在后面
+    assert preflight.image_missing(FFMPEG_IMAGE)
+
+
+def test_pull_timeout_ends_preflight_with_an_error(slow_pull, monkeypatch):
+    monkeypatch.setattr(mcp_common, "PREFLIGHT_PULL_TIMEOUT", 1)
+    preflight = slow_pull.host.preflight
+    started = time.monotonic()
+    preflight.start()
+    info = _wait_state(preflight, FFMPEG_IMAGE, ("error", "missing", "ready"))
+    assert info["state"] == "error" and "timed out" in info["error"]
+    assert time.monotonic() - started < 2.5
+
+    # 预检结束了, 调用不再等
+    started = time.monotonic()
+    preflight.wait(FFMPEG_IMAGE)
+    assert time.monotonic() - started < 0.1
+    assert not preflight.status()["ready"]
+
+
+def test_preflight_disabled_never_blocks(slow_pull, monkeypatch):
+    monkeypatch.setattr(mcp_common, "PREFLIGHT", False)
+    preflight = slow_pull.host.preflight
+    assert not preflight.start()
+    started = time.monotonic()
+    preflight.wait(FFMPEG_IMAGE)
+    assert time.monotonic() - started < 0.1
+    assert preflight.status()["preflight"] == "disabled"
+    assert slow_pull.calls() == []
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import server_linux
+
+
+@pytest.mark.parametrize("argv, output", [
+    (["{m}/a.png", "-resize", "50%", "{m}/out.png"], 3),
+    (["convert", "{m}/a.png", "{m}/b.png", "+append", "{m}/out.png"], 4),
+    (["{m}/a.png", "-resize", "800x600", "out.jpg"], 3),
+    (["identify", "{m}/a.png"], None),
+    (["identify", "-verbose", "{m}/a.png"], None),
+    (["mogrify", "-resize", "50%", "{m}/a.png"], None),
+    (["compare", "-metric", "AE", "{m}/a.png", "{m}/b.png", "{m}/diff.png"], None),
+    (["{m}/a.png", "-resize", "50%", "{m}/a.png"], None),
+    (["a.png", "-resize", "50%", "{m}/a.png"], None),
+    (["{m}/a.png", "-write", "{m}/x.png", "{m}/y.png"], None),
+    (["-list", "format"], None),
+    (["{m}/a.png"], None),
+])
+def test_magick_output(media, argv, output):
+    argv = [a.format(m=media) for a in argv]
+    assert server_linux._magick_output(argv) == output
+
+
+@pytest.mark.parametrize("argv, inputs, outputs", [
+    (["{m}/a.png", "-resize", "50%", "{m}/out.png"], ["a.png"], ["out.png"]),
+    (["{m}/a.png", "{m}/logo.png", "-composite", "{m}/out.png"], ["a.png", "logo.png"], ["out.png"]),
+    (["identify", "{m}/a.png"], None, None),
+    (["mogrify", "-resize", "50%", "{m}/a.png"], None, None),
+    (["{m}/a.png", "-resize", "50%", "{m}/a.png"], None, None),
+    (["{m}/a.png", "-resize", "50%", "png:-"], None, None),
+])
+def test_magick_io(media, argv, inputs, outputs):
+    argv = [a.format(m=media) for a in argv]
+    io = server_linux._magick_io(argv)
+    if inputs is None:
+        assert io is None
+    else:
+        assert io[0] == [os.path.join(media, p) for p in inputs]
+        assert io[2] == [os.path.join(media, p) for p in outputs]
+
+
+@pytest.mark.parametrize("argv, cacheable", [
+    (["-y", "-i", "{m}/in.mp4", "-c:v", "libx264", "{m}/out.mp4"], True),
+    (["-y", "-i", "{m}/in.mp4", "-vf", "movie={m}/logo.png[l];[in][l]overlay", "{m}/out.mp4"], True),
+    (["-y", "-i", "{m}/in.mp4", "-c", "copy", "{m}/in.mp4"], False),
+    (["-y", "-i", "{m}/in.mp4", "-vf", "movie={m}/logo.png[l];[in][l]overlay", "{m}/logo.png"], False),
+    (["-n", "-i", "{m}/in.mp4", "{m}/out.mp4"], False),
+    (["-y", "-i", "{m}/in.mp4", "{m}/frame_%03d.png"], False),
+    (["-y", "-i", "rtmp://example/live", "{m}/out.mp4"], False),
+])
+def test_ffmpeg_io_never_caches_over_an_input(media, argv, cacheable):
+    argv = [a.format(m=media) for a in argv]
+    assert (server_linux._ffmpeg_io(argv) is not None) == cacheable
@@ -0,0 +1,163 @@
+import os
+
+import pytest
+
+import server_linux
+from mcp_common import CancelToken
+from server_linux import ScratchStage
+
+
+@pytest.fixture
+def scratch(media, tmp_path, monkeypatch):
+    """MEDIA_ROOT 和 SCRATCH_DIR 都在 tmp_path 里; 多小的文件都中转."""
+    stage = ScratchStage(str(tmp_path / "scratch"), 1 << 20, 0)
+    monkeypatch.setattr(server_linux, "SCRATCH", stage)
+    return stage
+
+
+class _FFmpeg:
+    """假的 _run_ffmpeg: 记下收到的 argv, 把输入倒过来写到输出 (可以写一半就失败)."""
+
+    def __init__(self, success=True):
+        self.success = success
+        self.calls = []
+
+    def __call__(self, argv):
+        self.calls.append(list(argv))
+        src = argv[argv.index("-i") + 1]
+        with open(src, "rb") as f:
+            data = f.read()
+        with open(argv[-1], "wb") as f:
+            f.write(data[::-1] if self.success else data[:2])
+        return {"success": self.success, "error": "" if self.success else "boom", "metrics": {}}
+
+
+def _leftovers(stage):
+    jobs = os.listdir(stage.jobs_dir) if os.path.isdir(stage.jobs_dir) else []
+    tmps = [n for n in os.listdir(stage.inputs_dir) if n.startswith(".tmp-")] if os.path.isdir(stage.inputs_dir) else []
+    return jobs, tmps, dict(stage._pins)
+
+
+def test_inputs_and_outputs_go_through_scratch(media, scratch):
+    ffmpeg = _FFmpeg()
+    args = ["-y", "-i", f"{media}/in.mp4", "-c", "copy", f"{media}/out/o.mp4"]
+    result = server_linux._run_staged(args, ffmpeg)
+
+    staged = ffmpeg.calls[0]
+    assert staged[2].startswith(scratch.inputs_dir + "/") and staged[2].endswith(".mp4")
+    assert staged[-1].startswith(scratch.jobs_dir + "/") and staged[-1].endswith("-o.mp4")
+    assert staged[:2] + staged[3:5] == args[:2] + args[3:5]
+    assert result["success"]
+    assert result["staging"] == {"inputs": 1, "input_hits": 0, "input_bytes": 8, "outputs": 1, "output_bytes": 8}
+    with open(f"{media}/out/o.mp4", "rb") as f:
+        assert f.read() == b"1noisrev"
+    assert result["metrics"]["input_bytes"] == 8 and result["metrics"]["output_bytes"] == 8
+    assert "stage_in_s" in result["metrics"] and "stage_out_s" in result["metrics"]
+    assert _leftovers(scratch) == ([], [], {})
+    assert not [n for n in os.listdir(f"{media}/out") if n.endswith(".partial")]
+
+
+def test_input_copy_is_reused_until_the_source_changes(media, scratch):
+    args = ["-y", "-i", f"{media}/in.mp4", f"{media}/o.mp4"]
+    first = server_linux._run_staged(args, _FFmpeg())
+    second = server_linux._run_staged(args, _FFmpeg())
+    assert (first["staging"]["input_hits"], second["staging"]["input_hits"]) == (0, 1)
+    assert second["staging"]["input_bytes"] == 0
+
+    with open(f"{media}/in.mp4", "wb") as f:
+        f.write(b"version22")
+    third = server_linux._run_staged(args, _FFmpeg())
+    assert third["staging"]["input_hits"] == 0 and third["staging"]["input_bytes"] == 9
+    with open(f"{media}/o.mp4", "rb") as f:
+        assert f.read() == b"22noisrev"
+
+
+def test_failed_ffmpeg_publishes_nothing_and_cleans_up(media, scratch):
+    ffmpeg = _FFmpeg(success=False)
+    result = server_linux._run_staged(["-y", "-i", f"{media}/in.mp4", f"{media}/out.mp4"], ffmpeg)
+
+    assert not result["success"] and result["error"] == "boom"
+    assert os.path.exists(ffmpeg.calls[0][-1]) is False  # job 目录整个删掉了
+    assert not os.path.exists(f"{media}/out.mp4")
+    assert result["staging"]["outputs"] == 0 and result["metrics"]["output_bytes"] == 0
+    assert _leftovers(scratch) == ([], [], {})
+
+
+def test_failed_ffmpeg_keeps_the_existing_output(media, scratch):
+    with open(f"{media}/out.mp4", "wb") as f:
+        f.write(b"old")
+    server_linux._run_staged(["-y", "-i", f"{media}/in.mp4", f"{media}/out.mp4"], _FFmpeg(success=False))
+    with open(f"{media}/out.mp4", "rb") as f:
+        assert f.read() == b"old"
+
+
+def test_run_raising_oserror_still_cleans_up(media, scratch):
+    def run(argv):
+        open(argv[-1], "wb").close()
+        raise OSError("disk full")
+
+    result = server_linux._run_staged(["-y", "-i", f"{media}/in.mp4", f"{media}/out.mp4"], run)
+    assert not result["success"] and "disk full" in result["error"]
+    assert _leftovers(scratch) == ([], [], {})
+
+
+@pytest.mark.parametrize("output", ["{media}/frames/%04d.png", "-", "pipe:1", "/elsewhere/out.mp4"])
+def test_outputs_that_are_not_staged(media, scratch, output):
+    output = output.format(media=media)
+    seen = []
+    args = ["-y", "-i", f"{media}/in.mp4", "-f", "null", output]
+    server_linux._run_staged(args, lambda argv: seen.append(argv) or {"success": True, "metrics": {}})
+    assert seen[0][-1] == output
+
+
+def test_existing_output_without_overwrite_is_left_to_ffmpeg(media, scratch):
+    seen = []
+    args = ["-i", f"{media}/a.png", f"{media}/b.png"]
+    server_linux._run_staged(args, lambda argv: seen.append(argv) or {"success": False, "metrics": {}})
+    assert seen[0][-1] == f"{media}/b.png"
+    assert seen[0][1].startswith(scratch.inputs_dir)
+
+
+def test_input_outside_media_root_is_not_staged(media, scratch):
+    seen = []
+    args = ["-y", "-i", "/etc/hostname", "-i", "https://example.com/a.mp4", f"{media}/o.mp4"]
+    server_linux._run_staged(args, lambda argv: seen.append(argv) or {"success": True, "metrics": {}})
+    assert seen[0][2] == "/etc/hostname" and seen[0][4] == "https://example.com/a.mp4"
+
+
+def test_cancel_during_copy(media, scratch):
+    cancel = CancelToken()
+    cancel.cancel()
+    result = server_linux._run_staged(["-y", "-i", f"{media}/in.mp4", f"{media}/o.mp4"],
+                                      lambda argv: pytest.fail("ffmpeg must not run"), cancel)
+    assert result["cancelled"] and not result["success"]
+    assert _leftovers(scratch) == ([], [], {})
+    assert not [n for n in os.listdir(scratch.inputs_dir)]
+
+
+def test_lru_eviction_skips_pinned_copies(media, scratch):
+    scratch.max_bytes = 20
+    paths = []
+    for name in ("x.mp4", "y.mp4", "z.mp4"):
+        paths.append(os.path.join(media, name))
+        with open(paths[-1], "wb") as f:
+            f.write(b"0123456789")
+    x = scratch.stage_input(paths[0])
+    y = scratch.stage_input(paths[1])
+    scratch.release([y[1]])
+    os.utime(x[0], (1, 1))  # x 最旧, 但还 pin 着
+    z = scratch.stage_input(paths[2])
+    assert os.path.exists(x[0]) and os.path.exists(z[0])
+    assert not os.path.exists(y[0])
+    scratch.release([x[1], z[1]])
+    assert scratch._pins == {}
+
+
+def test_run_ffmpeg_stages_when_asked(media, scratch, monkeypatch):
+    ffmpeg = _FFmpeg()
+    monkeypatch.setattr(server_linux, "_run_ffmpeg", lambda argv, *rest: ffmpeg(argv))
+    result = server_linux.run_ffmpeg(["-y", "-i", f"{media}/in.mp4", f"{media}/o.mp4"], cache=False, stage=True)
+    assert result["success"] and result["staging"]["outputs"] == 1
+    plain = server_linux.run_ffmpeg(["-y", "-i", f"{media}/in.mp4", f"{media}/p.mp4"], cache=False, stage=False)
+    assert "staging" not in plain
+    assert ffmpeg.calls[1][2] == f"{media}/in.mp4"
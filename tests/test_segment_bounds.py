@@ -0,0 +1,64 @@
+import pytest
+
+import server_linux
+
+
+@pytest.mark.parametrize("keyframes, duration, count, expected", [
+    # 每 2 秒一个关键帧, 切点正好落在关键帧上
+    ([float(t) for t in range(0, 60, 2)], 60.0, 3, [(0.0, 20.0), (20.0, 40.0), (40.0, None)]),
+    # 目标 15 / 30 / 45 吸到最近的关键帧
+    ([0.0, 9.0, 14.0, 31.0, 44.5, 58.0], 60.0, 4, [(0.0, 14.0), (14.0, 31.0), (31.0, 44.5), (44.5, None)]),
+    # 关键帧太稀, 几个目标吸到同一帧上只切一次
+    ([0.0, 30.0], 60.0, 4, [(0.0, 30.0), (30.0, None)]),
+    # 只有开头一个关键帧: 不切
+    ([0.0], 60.0, 4, [(0.0, None)]),
+    # 离结尾不到 1 秒的切点丢掉
+    ([0.0, 59.5], 60.0, 2, [(0.0, None)]),
+    ([0.0, 10.0], 20.0, 1, [(0.0, None)]),
+])
+def test_segment_bounds(keyframes, duration, count, expected):
+    assert server_linux._segment_bounds(keyframes, duration, count) == expected
+
+
+def test_segment_bounds_cut_on_keyframes_after_start_time_offset():
+    # MPEG-TS 常见 start_time=1.4: 减掉偏移后切点仍然正好是关键帧
+    start_time = 1.4
+    absolute = [start_time + t for t in range(0, 40, 4)]
+    keyframes = [k - start_time for k in absolute]
+    bounds = server_linux._segment_bounds(keyframes, 40.0, 2)
+    assert bounds == [(0.0, 20.0), (20.0, None)]
+    assert all(start in keyframes for start, _ in bounds)
+
+
+BOUNDS = [(0.0, 20.0), (20.0, 40.0), (40.0, None)]
+SEGS = ["/m/seg_0000.mkv", "/m/seg_0001.mkv", "/m/seg_0002.mkv"]
+
+
+@pytest.mark.parametrize("video_args", [
+    ["-c:v", "libx264", "-crf", "23"],
+    ["-c:v", "libx265", "-preset", "slow"],
+    ["-vcodec", "h264_nvenc"],
+    ["-c:v:0", "hevc_qsv"],
+    # 不指定编码器时 mkv 默认 libx264
+    ["-crf", "20"],
+])
+def test_segment_jobs_carry_parameter_sets_in_band(video_args):
+    jobs = server_linux._segment_jobs("/m/in.mp4", BOUNDS, SEGS, video_args)
+    assert [job["name"] for job in jobs] == ["seg_0000.mkv", "seg_0001.mkv", "seg_0002.mkv"]
+    for job, (start, end), seg in zip(jobs, BOUNDS, SEGS):
+        argv = job["args"]
+        assert argv[:5] == ["-y", "-ss", f"{start:.6f}", "-i", "/m/in.mp4"]
+        assert ("-t" in argv) == (end is not None)
+        i = argv.index("-map")
+        assert argv[i:i + 2 + len(video_args) + 2] == ["-map", "0:v:0"] + video_args + ["-bsf:v", "dump_extra"]
+        assert argv[-3:] == ["-an", "-sn", seg]
+
+
+@pytest.mark.parametrize("video_args", [
+    ["-c:v", "libsvtav1"],
+    ["-c:v", "libvpx-vp9", "-b:v", "0", "-crf", "31"],
+    ["-c:v", "libx264", "-bsf:v", "h264_metadata=level=4.1"],
+])
+def test_segment_jobs_leave_other_codecs_and_user_filters_alone(video_args):
+    for job in server_linux._segment_jobs("/m/in.mp4", BOUNDS, SEGS, video_args):
+        assert "dump_extra" not in job["args"]
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+import server_linux
+from server_linux import FFMPEG_IMAGE, IMAGEMAGICK_IMAGE, SingleFlight
+
+
+def _replaced(argv, new):
+    return [i for i, (a, b) in enumerate(zip(argv, new)) if a != b]
+
+
+@pytest.mark.parametrize("image, entrypoint, argv, replaced", [
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "-c:v", "libx264", "{m}/out.mp4"], [5]),
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "{m}/o1.mp4", "-map", "0:a", "{m}/o2.m4a"], [3, 6]),
+    # 原地改写: 输出就是输入
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "-c", "copy", "{m}/in.mp4"], []),
+    (FFMPEG_IMAGE, None, ["-y", "-i", "in.mp4", "-c", "copy", "{m}/in.mp4"], []),
+    # 滤镜里读的文件也是输出
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "-vf", "movie={m}/logo.png[l];[in][l]overlay",
+                          "{m}/logo.png"], []),
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "-f", "hls", "{m}/out.m3u8"], []),
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "{m}/thumb_%03d.jpg"], []),
+    (FFMPEG_IMAGE, None, ["-y", "-i", "{m}/in.mp4", "-f", "null", "-"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["{m}/a.png", "-resize", "50%", "{m}/out.png"], [3]),
+    (IMAGEMAGICK_IMAGE, "magick", ["identify", "{m}/a.png"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["identify", "-verbose", "{m}/a.png"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["mogrify", "-resize", "50%", "{m}/a.png"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["{m}/a.png", "-resize", "50%", "{m}/a.png"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["{m}/a.png", "+adjoin", "{m}/out.png"], []),
+    (IMAGEMAGICK_IMAGE, "magick", ["{m}/a.png", "-write", "{m}/x.png", "{m}/y.png"], []),
+])
+def test_atomic_outputs(media, image, entrypoint, argv, replaced):
+    argv = [a.format(m=media) for a in argv]
+    new, moves = server_linux._atomic_outputs(image, entrypoint, argv)
+    assert _replaced(argv, new) == replaced
+    assert [dest for _, dest in moves] == [argv[i] for i in replaced]
+    for tmp, dest in moves:
+        assert tmp.startswith(media + "/.") and ".partial" in tmp and tmp.endswith(dest[-4:])
+
+
+def test_atomic_outputs_keeps_existing_output_without_overwrite_flag(media):
+    argv = ["-i", f"{media}/in.mp4", f"{media}/a.png"]
+    assert server_linux._atomic_outputs(FFMPEG_IMAGE, None, argv) == (argv, [])
+
+
+def _key(argv, stdout=None, stderr=None):
+    return SingleFlight.key(FFMPEG_IMAGE, None, argv, stdout, stderr)
+
+
+def test_single_flight_key_ignores_banner_and_overwrite_position():
+    base = ["-i", "in.mp4", "-c:v", "libx264", "out.mp4"]
+    assert _key(["-y"] + base) == _key(["-hide_banner"] + base[:-1] + ["-y", base[-1]])
+
+
+@pytest.mark.parametrize("extra", [
+    ["-loglevel", "debug"],
+    ["-v", "error"],
+    ["-progress", "/media/progress.txt"],
+    ["-stats_period", "5"],
+    ["-nostdin"],
+])
+def test_single_flight_key_keeps_logging_and_progress_options(extra):
+    # 跟随者拿到的是领头那次的 stderr / 进度文件, 这些不同就不能合并
+    base = ["-i", "in.mp4", "-c:v", "libx264", "out.mp4"]
+    assert _key(base) != _key(extra + base)
+
+
+@pytest.mark.parametrize("a, b", [
+    (["-y", "-i", "in.mp4", "out.mp4"], ["-i", "in.mp4", "out.mp4"]),
+    (["-n", "-i", "in.mp4", "out.mp4"], ["-i", "in.mp4", "out.mp4"]),
+    (["-y", "-i", "in.mp4", "out.mp4"], ["-n", "-i", "in.mp4", "out.mp4"]),
+])
+def test_single_flight_key_keeps_overwrite_flags(a, b):
+    assert _key(a) != _key(b)
+
+
+def test_single_flight_key_depends_on_callbacks():
+    argv = ["-i", "in.mp4", "out.mp4"]
+    assert _key(argv) != _key(argv, stdout=print)
+    assert _key(argv) != _key(argv, stderr=print)
+
+
+def test_calls_differing_only_in_loglevel_both_execute(monkeypatch):
+    started, release = [], threading.Event()
+
+    def run(image, cmd_args, *rest):
+        started.append(cmd_args)
+        release.wait(10)
+        return {"success": True, "output": "", "error": " ".join(cmd_args)}
+
+    monkeypatch.setattr(server_linux, "COALESCE", True)
+    monkeypatch.setattr(server_linux, "_docker_run_atomic", run)
+    base = ["-i", "in.mp4", "-f", "null", "-"]
+    calls = [["-loglevel", "info"] + base, ["-loglevel", "debug"] + base, ["-loglevel", "debug"] + base]
+    results = [None] * len(calls)
+
+    def call(i):
+        results[i] = server_linux._docker_run(FFMPEG_IMAGE, calls[i], on_stderr=lambda chunk: None)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(calls))]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 10
+    while (len(started) < 2 or server_linux.FLIGHTS.stats()["waiting"] < 3) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(10)
+    assert sorted(started) == sorted(calls[:2])
+    assert [r["error"] for r in results] == [" ".join(c) for c in calls]
+    assert [bool(r.get("coalesced")) for r in results].count(True) == 1
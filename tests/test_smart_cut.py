@@ -0,0 +1,63 @@
+import pytest
+
+import mcp_common
+
+KEYFRAMES = [0.0, 2.0, 4.0, 6.0, 8.0]
+HALF_FRAME = 0.02
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    # 两头都在 GOP 中间: 头尾重编码, 中间整 GOP copy
+    (1.3, 7.7, [("encode", 1.3, 2.0), ("copy", 2.0, 6.0), ("encode", 6.0, 7.7)]),
+    # 正好落在关键帧上 (差不到半帧) 的切点不重编码
+    (2.0, 6.0, [("copy", 2.0, 6.0)]),
+    (1.99, 6.01, [("copy", 2.0, 6.0)]),
+    # 切到结尾: 尾部 copy 到文件结束
+    (3.0, 10.0, [("encode", 3.0, 4.0), ("copy", 4.0, None)]),
+    # 区间里没有完整 GOP: 整段重编码
+    (2.5, 3.5, [("encode", 2.5, 3.5)]),
+    (4.5, 7.5, [("encode", 4.5, 7.5)]),
+])
+def test_smart_cut_plan(start, end, expected):
+    assert mcp_common._smart_cut_plan(KEYFRAMES, start, end, 10.0, HALF_FRAME) == expected
+
+
+def test_smart_cut_plan_without_keyframes():
+    assert mcp_common._smart_cut_plan([], 1.0, 3.0, 10.0, HALF_FRAME) == [("encode", 1.0, 3.0)]
+
+
+@pytest.mark.parametrize("ranges, expected", [
+    ([[1, 2]], [(1.0, 2.0)]),
+    ([{"start": 1.5}], [(1.5, 10.0)]),
+    ([[-3, 4], [5, 99]], [(0.0, 4.0), (5.0, 10.0)]),
+    ([[8]], [(8.0, 10.0)]),
+])
+def test_parse_ranges(ranges, expected):
+    assert mcp_common._parse_ranges(ranges, 10.0) == expected
+
+
+@pytest.mark.parametrize("ranges", [[], [[3, 3]], [[5, 2]], [{"start": 11}]])
+def test_parse_ranges_rejects(ranges):
+    with pytest.raises(ValueError):
+        mcp_common._parse_ranges(ranges, 10.0)
+
+
+@pytest.mark.parametrize("stream, expected", [
+    ({"avg_frame_rate": "30000/1001"}, 1001 / 30000),
+    ({"avg_frame_rate": "0/0", "r_frame_rate": "50/1"}, 1 / 50),
+    ({"avg_frame_rate": "24"}, 1 / 24),
+    ({}, 1 / 25),
+])
+def test_frame_duration(stream, expected):
+    assert mcp_common._frame_duration(stream) == pytest.approx(expected)
+
+
+def test_smart_cut_encode_args_follow_the_source():
+    stream = {"codec_name": "hevc", "pix_fmt": "yuv420p10le", "profile": "Main 10", "color_primaries": "bt2020",
+              "color_transfer": "unknown"}
+    args = mcp_common._smart_cut_encode_args(stream, None)
+    assert args[:2] == ["-c:v", "libx265"]
+    assert args[args.index("-pix_fmt") + 1] == "yuv420p10le"
+    assert args[args.index("-profile:v") + 1] == "main10"
+    assert args[args.index("-color_primaries") + 1] == "bt2020"
+    assert "-color_trc" not in args
@@ -0,0 +1,68 @@
+import pytest
+
+import mcp_common
+import server_linux
+
+GLOBAL = ["-filter_threads", "2", "-filter_complex_threads", "2"]
+
+
+@pytest.mark.parametrize("args, expected", [
+    (["-i", "in.mp4", "-c:v", "libx264", "out.mp4"],
+     GLOBAL + ["-threads", "2", "-i", "in.mp4", "-c:v", "libx264", "-threads", "2", "out.mp4"]),
+    (["-y", "-i", "a.mp4", "-i", "b.wav", "-map", "0:v", "-map", "1:a", "-shortest", "out.mp4"],
+     GLOBAL + ["-y", "-threads", "2", "-i", "a.mp4", "-threads", "2", "-i", "b.wav", "-map", "0:v", "-map", "1:a",
+               "-shortest", "-threads", "2", "out.mp4"]),
+    # 表里补上的无值开关
+    (["-i", "in.mp4", "-vstats", "-c:v", "libx264", "out.mp4"],
+     GLOBAL + ["-threads", "2", "-i", "in.mp4", "-vstats", "-c:v", "libx264", "-threads", "2", "out.mp4"]),
+    (["-fix_sub_duration", "-i", "in.mkv", "-copyinkf", "-psnr", "-c:v", "libx264", "out.mkv"],
+     GLOBAL + ["-fix_sub_duration", "-threads", "2", "-i", "in.mkv", "-copyinkf", "-psnr", "-c:v", "libx264",
+               "-threads", "2", "out.mkv"]),
+    # 负数的值不是选项名
+    (["-itsoffset", "-1.5", "-i", "in.mp4", "-af", "volume=-3dB", "out.mp4"],
+     GLOBAL + ["-itsoffset", "-1.5", "-threads", "2", "-i", "in.mp4", "-af", "volume=-3dB", "-threads", "2", "out.mp4"]),
+    # 不认识的无值开关把 -c:v 当成了值: 位置不可信, 只补全局参数
+    (["-i", "in.mp4", "-some_new_flag", "-c:v", "libx264", "out.mp4"],
+     GLOBAL + ["-i", "in.mp4", "-some_new_flag", "-c:v", "libx264", "out.mp4"]),
+    # 用户自己写了的不动
+    (["-threads", "8", "-i", "in.mp4", "out.mp4"], GLOBAL + ["-threads", "8", "-i", "in.mp4", "out.mp4"]),
+    (["-filter_threads", "4", "-i", "in.mp4", "out.mp4"],
+     ["-filter_complex_threads", "2", "-filter_threads", "4", "-threads", "2", "-i", "in.mp4", "-threads", "2", "out.mp4"]),
+])
+def test_thread_args(args, expected):
+    assert mcp_common._thread_args(args, 2) == expected
+
+
+def test_thread_args_never_splits_an_option_from_its_value():
+    args = ["-i", "in.mp4", "-vstats", "-qphist", "-print_graphs", "-c:v", "libx264", "-crf", "20", "out.mp4"]
+    out = mcp_common._thread_args(args, 3)
+    for opt in ("-c:v", "-crf"):
+        assert out[out.index(opt) + 1] == args[args.index(opt) + 1]
+
+
+class _NoWorkerPool:
+    def acquire(self, wait=None):
+        return None
+
+
+class _BrokenPool:
+    def acquire(self, wait=None):
+        raise RuntimeError("daemon went away")
+
+
+def test_ffmpeg_batch_releases_host_when_no_worker(monkeypatch):
+    host = server_linux.DISPATCH.primary
+    before = host.active
+    monkeypatch.setattr(server_linux, "_pool_for", lambda *a: _NoWorkerPool())
+    result = server_linux.ffmpeg_batch([], single_container=True)
+    assert result["single_container"] is None
+    assert host.active == before
+
+
+def test_ffmpeg_batch_releases_host_when_pool_fails(monkeypatch):
+    host = server_linux.DISPATCH.primary
+    before = host.active
+    monkeypatch.setattr(server_linux, "_pool_for", lambda *a: _BrokenPool())
+    with pytest.raises(RuntimeError):
+        server_linux.ffmpeg_batch([], single_container=True)
+    assert host.active == before
@@ -0,0 +1,84 @@
+import time
+
+import mcp_common
+from mcp_common import BUSYBOX_IMAGE, FFMPEG_IMAGE, WorkerPool
+
+OPTS = ["-v", "/media:/media"]
+
+
+def _pool(fake_docker, monkeypatch, size=1):
+    """预先放进 _POOLS, 再起满 worker."""
+    pool = WorkerPool(FFMPEG_IMAGE, OPTS, fake_docker.host, size=size)
+    monkeypatch.setitem(mcp_common._POOLS, (fake_docker.host.name, FFMPEG_IMAGE, tuple(OPTS)), pool)
+    workers = [pool.acquire(wait=30) for _ in range(size)]
+    assert all(workers)
+    for worker in workers:
+        pool.release(worker)
+    return pool
+
+
+def _run(fake_docker, image=FFMPEG_IMAGE, args=("-version",), entrypoint=None):
+    return mcp_common._docker_exec_or_run(fake_docker.host, image, list(args), OPTS, entrypoint, 30,
+                                          None, None, None, None)
+
+
+def _idle_cids(pool):
+    with pool._lock:
+        return [w.cid for w in pool._idle]
+
+
+def _wait_idle(pool, n, timeout=30):
+    deadline = time.monotonic() + timeout
+    while len(_idle_cids(pool)) < n and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return _idle_cids(pool)
+
+
+def test_warm_worker_is_reused(fake_docker, monkeypatch):
+    pool = _pool(fake_docker, monkeypatch)
+    cid = _idle_cids(pool)[0]
+    first, second = _run(fake_docker), _run(fake_docker)
+    assert (first["runner"], second["runner"]) == ("warm", "warm")
+    assert first["success"] and "ffmpeg version" in second["output"]
+    assert [argv[:3] for argv in fake_docker.calls("exec")] == [["exec", cid, "ffmpeg"]] * 2
+    assert len(fake_docker.calls("run")) == 1
+    assert _idle_cids(pool) == [cid]
+
+
+def test_exec_into_dead_worker_falls_back_to_cold_run(fake_docker, monkeypatch):
+    pool = _pool(fake_docker, monkeypatch)
+    fake_docker.kill(_idle_cids(pool)[0])
+    result = _run(fake_docker)
+    assert result["success"] and result["runner"] == "cold"
+    assert "ffmpeg version" in result["output"]
+    cold = [argv for argv in fake_docker.calls("run") if "-d" not in argv]
+    assert len(cold) == 1
+    assert cold[0][:4] == ["run", "--rm", "--name", cold[0][3]] and cold[0][3].startswith("ffmpeg-mcp-run-")
+    assert cold[0][4:6] == OPTS and FFMPEG_IMAGE in cold[0]
+
+
+def test_dead_worker_is_replaced_after_failed_exec(fake_docker, monkeypatch):
+    pool = _pool(fake_docker, monkeypatch)
+    dead = _idle_cids(pool)[0]
+    fake_docker.kill(dead)
+    _run(fake_docker)
+    replacement = _wait_idle(pool, 1)
+    assert len(replacement) == 1 and replacement[0] != dead
+    assert ["rm", "-f", dead] in fake_docker.calls("rm")
+    assert _run(fake_docker)["runner"] == "warm"
+    assert fake_docker.calls("exec")[-1][1] == replacement[0]
+
+
+def test_health_check_replaces_dead_idle_worker(fake_docker, monkeypatch):
+    pool = _pool(fake_docker, monkeypatch, size=2)
+    dead, alive = _idle_cids(pool)
+    fake_docker.kill(dead)
+    pool.health_check()
+    cids = _wait_idle(pool, 2)
+    assert dead not in cids and alive in cids and len(cids) == 2
+
+
+def test_empty_pool_runs_cold_without_exec(fake_docker):
+    result = _run(fake_docker, BUSYBOX_IMAGE, ["sh", "-c", "true", "sh", "/media/a"])
+    assert result["success"] and result["runner"] == "cold"
+    assert not fake_docker.calls("exec")